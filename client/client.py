@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Personal DDNS Client daemon
+
+Long-running alternative to client.sh. Instead of asking the IP provider on
+every cron run, it sleeps until the kernel announces a change of the host's
+global addresses via netlink (RTM_NEWADDR and RTM_DELADDR), and only then
+checks the public IP and updates the server, over a kept-alive connection.
+A check also runs every --interval seconds, as a NAT router may change the
+public IP without any local change. Where netlink is not available, such as
+outside Linux, it simply checks every --interval seconds.
+
+Config, cache and log files are the same as client.sh, so both can be used
+interchangeably. Only the Python standard library is required.
+"""
+
+import argparse
+import base64
+import datetime
+import getpass
+import http.client
+import logging
+import os
+import select
+import shlex
+import socket
+import ssl
+import struct
+import sys
+import time
+import typing as t
+import urllib.parse
+
+__version__ = '1.0'
+
+log = logging.getLogger(os.path.basename(__file__))
+
+SLUG = 'ddnsp-client'
+CONFIG_HOME = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+CACHE_HOME  = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+CONFIG  = os.path.join(CONFIG_HOME, f'{SLUG}.conf')
+CACHE   = os.path.join(CACHE_HOME, f'{SLUG}.lastip.txt')
+LOGFILE = os.path.join(CACHE_HOME, f'{SLUG}.log')
+
+TIMEOUT = 30
+MAX_REDIRECTS = 5
+
+# Netlink, from linux/netlink.h, linux/rtnetlink.h and linux/if_addr.h
+NLMSG_HEADER  = struct.Struct('=IHHII')  # length, type, flags, seq, pid
+IFADDRMSG     = struct.Struct('=BBBBI')  # family, prefixlen, flags, scope, index
+RTATTR        = struct.Struct('=HH')     # length, type
+NLMSG_ERROR   = 2
+NLMSG_DONE    = 3
+NLM_F_REQUEST = 0x001
+NLM_F_DUMP    = 0x300
+RTM_NEWADDR   = 20
+RTM_DELADDR   = 21
+RTM_GETADDR   = 22
+RTMGRP_IPV4_IFADDR = 0x010
+RTMGRP_IPV6_IFADDR = 0x100
+IFA_ADDRESS   = 1
+IFA_LOCAL     = 2
+IFA_F_TEMPORARY = 0x01
+IFA_F_TENTATIVE = 0x40
+RT_SCOPE_UNIVERSE = 0
+
+Address: 't.TypeAlias' = t.Tuple[int, int, bytes]  # family, interface, address
+
+
+def defaults() -> t.Dict[str, str]:
+    return {
+        'ip_provider': 'https://api.ipify.org',
+        'server_url':  'https://dyndns.example.com:1234/update',
+        'username':    os.environ.get('USER') or os.environ.get('LOGUSER') or getpass.getuser(),
+        'password':    'PASSWORD',
+        'hostname':    socket.gethostname(),
+    }
+
+
+# -----------------------------------------------------------------------------
+# Files, compatible with client.sh
+
+def read_config(path:str) -> t.Dict[str, str]:
+    """Read the shell-style config file, as written by client.sh --setup"""
+    config = defaults()
+    with open(path) as f:
+        for line in f:
+            key, sep, value = line.strip().partition('=')
+            if not sep or key.startswith('#'):
+                continue
+            try:
+                words = shlex.split(value, comments=True)
+            except ValueError as e:
+                log.warning("Ignoring config %s in %s: %s", key, path, e)
+                continue
+            config[key.strip()] = words[0] if words else ''
+    return config
+
+
+def write_config(path:str) -> None:
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    with open(path, 'a') as f:
+        f.write("# Personal DDNS client config file\n"
+                "# See https://github.com/MestreLion/ddnsp\n\n")
+        for key, value in defaults().items():
+            f.write(f"{key}={shlex.quote(value)}\n")
+    os.chmod(path, 0o600)
+
+
+def read_ip(cache:str) -> str:
+    try:
+        with open(cache) as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+
+def write_ip(cache:str, ip:str) -> None:
+    os.makedirs(os.path.dirname(cache), exist_ok=True)
+    with open(cache, 'w') as f:
+        f.write(f"{ip}\n")
+
+
+def write_log(logfile:str, action:str, ip:str, reply:str) -> None:
+    """Append a tab-separated line: timestamp, action, IP and server reply"""
+    # Same as `date --rfc-3339=seconds`
+    now = datetime.datetime.now().astimezone().isoformat(sep=' ', timespec='seconds')
+    line = '\t'.join(filter(None, (now, action or 'nochange', ip or '-', reply))) + '\n'
+    if not logfile:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+        return
+    os.makedirs(os.path.dirname(logfile), exist_ok=True)
+    with open(logfile, 'a') as f:
+        f.write(line)
+
+
+# -----------------------------------------------------------------------------
+# HTTP
+
+class HTTPClient:
+    """Kept-alive HTTP(S) connections, one per server, reconnecting as needed
+
+    Redirects are followed, re-sending credentials, as curl --location-trusted.
+    """
+    def __init__(self, timeout:float=TIMEOUT, family:int=socket.AF_UNSPEC):
+        self.timeout: float = timeout
+        self.family:  int   = family
+        self.context = ssl.create_default_context()
+        # Same as client.sh workaround for OpenSSL 3 'unexpected eof while reading'
+        self.context.options |= getattr(ssl, 'OP_IGNORE_UNEXPECTED_EOF', 0)
+        self._connections: t.Dict[t.Tuple[str, str], http.client.HTTPConnection] = {}
+
+    def _create_connection(self, address, timeout=TIMEOUT, source_address=None) -> socket.socket:
+        """socket.create_connection(), restricted to family, as curl -4"""
+        host, port = address
+        error: t.Optional[OSError] = None
+        for family, socktype, proto, _, sockaddr in socket.getaddrinfo(
+                host, port, self.family, socket.SOCK_STREAM):
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                return sock
+            except OSError as e:
+                sock.close()
+                error = e
+        raise error or OSError(f"No address found for {host}")
+
+    def connection(self, scheme:str, netloc:str) -> http.client.HTTPConnection:
+        conn = self._connections.get((scheme, netloc))
+        if conn is None:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout,
+                                                   context=self.context)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            conn._create_connection = self._create_connection  # type: ignore
+            self._connections[(scheme, netloc)] = conn
+        return conn
+
+    def close(self) -> None:
+        for conn in self._connections.values():
+            conn.close()
+        self._connections.clear()
+
+    def get(self, url:str, query:t.Optional[dict]=None,
+            headers:t.Optional[dict]=None) -> t.Tuple[int, str]:
+        """GET url, return status and body"""
+        if query:
+            url += ('&' if '?' in url else '?') + urllib.parse.urlencode(query)
+        headers = {'User-Agent': f'{SLUG}/{__version__}', **(headers or {})}
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise ValueError(f"Unsupported URL: {url}")
+            path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            response = self._request(parts.scheme, parts.netloc, path, headers)
+            body = response.read().decode(errors='replace')
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            return response.status, body
+        raise http.client.HTTPException(f"Too many redirects: {url}")
+
+    def _request(self, scheme:str, netloc:str, path:str,
+                 headers:dict) -> http.client.HTTPResponse:
+        conn = self.connection(scheme, netloc)
+        for attempt in (1, 2):
+            try:
+                conn.request('GET', path, headers=headers)
+                return conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError) as e:
+                # A kept-alive connection may have been closed by the server
+                conn.close()
+                if attempt == 2:
+                    raise
+                log.debug("Reconnecting to %s after: %s", netloc, e)
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                raise
+        raise AssertionError("unreachable")
+
+
+# -----------------------------------------------------------------------------
+# Netlink
+
+class AddressMonitor:
+    """Global addresses of this host, kept current with netlink notifications
+
+    Only changes of the set of addresses count: the kernel also re-announces
+    existing IPv6 addresses whenever their lifetimes are refreshed. Temporary
+    (privacy) and tentative IPv6 addresses are ignored.
+    """
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.sock.bind((0, RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+        self.addresses: t.Set[Address] = set()
+        self._dump()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def _dump(self) -> None:
+        """Load current addresses with an RTM_GETADDR request"""
+        seq = int(time.time()) & 0xFFFFFFFF
+        payload = IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        self.sock.send(NLMSG_HEADER.pack(NLMSG_HEADER.size + len(payload), RTM_GETADDR,
+                                         NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + payload)
+        while True:
+            for mtype, mseq, data in self._messages(self.sock.recv(65536)):
+                if mseq == seq and mtype in (NLMSG_DONE, NLMSG_ERROR):
+                    log.debug("Global addresses: %s", len(self.addresses))
+                    return
+                self._apply(mtype, data)
+
+    def read(self) -> bool:
+        """Process pending notifications, return True if addresses changed"""
+        changed = False
+        for mtype, _, data in self._messages(self.sock.recv(65536)):
+            changed = self._apply(mtype, data) or changed
+        return changed
+
+    @staticmethod
+    def _messages(data:bytes) -> t.Iterator[t.Tuple[int, int, bytes]]:
+        offset = 0
+        while offset + NLMSG_HEADER.size <= len(data):
+            length, mtype, _, seq, _ = NLMSG_HEADER.unpack_from(data, offset)
+            if length < NLMSG_HEADER.size:
+                return
+            yield mtype, seq, data[offset + NLMSG_HEADER.size:offset + length]
+            offset += (length + 3) & ~3
+
+    def _apply(self, mtype:int, data:bytes) -> bool:
+        if mtype not in (RTM_NEWADDR, RTM_DELADDR) or len(data) < IFADDRMSG.size:
+            return False
+        family, _, flags, scope, index = IFADDRMSG.unpack_from(data)
+        if scope != RT_SCOPE_UNIVERSE:
+            return False
+        attrs: t.Dict[int, bytes] = {}
+        offset = IFADDRMSG.size
+        while offset + RTATTR.size <= len(data):
+            length, rtype = RTATTR.unpack_from(data, offset)
+            if length < RTATTR.size:
+                break
+            attrs[rtype] = data[offset + RTATTR.size:offset + length]
+            offset += (length + 3) & ~3
+        # IFA_LOCAL is the local address of point-to-point interfaces
+        address = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+        if address is None:
+            return False
+        key = (family, index, address)
+        if mtype == RTM_DELADDR:
+            if key not in self.addresses:
+                return False
+            self.addresses.discard(key)
+        else:
+            if (family == socket.AF_INET6 and flags & (IFA_F_TEMPORARY | IFA_F_TENTATIVE)
+                    or key in self.addresses):
+                return False
+            self.addresses.add(key)
+        log.debug("%s %s", 'Added' if mtype == RTM_NEWADDR else 'Removed',
+                  socket.inet_ntop(family, address))
+        return True
+
+
+# -----------------------------------------------------------------------------
+
+class Client:
+    def __init__(self, config:t.Dict[str, str], cache:str=CACHE, logfile:str=LOGFILE):
+        self.config:  t.Dict[str, str] = config
+        self.cache:   str = cache
+        self.logfile: str = logfile
+        self.server   = HTTPClient()
+        self.provider = HTTPClient(family=socket.AF_INET)
+
+    def public_ip(self) -> str:
+        """Public IPv4 from the IP provider, or empty if none or on errors"""
+        if not self.config['ip_provider']:
+            return ''
+        try:
+            status, body = self.provider.get(self.config['ip_provider'])
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            log.error("Failed querying IP provider %s: %s", self.config['ip_provider'], e)
+            return ''
+        if status != 200:
+            log.error("IP provider %s replied %s: %s", self.config['ip_provider'],
+                      status, body.strip())
+            return ''
+        return body.strip()
+
+    def update(self, ip:str) -> str:
+        """Send the update to the server, return its reply"""
+        config = self.config
+        creds = f"{config['username']}:{config['password']}".encode()
+        headers = {'Authorization': 'Basic ' + base64.b64encode(creds).decode()}
+        query = {'hostname': config['hostname']}
+        if ip:
+            query['myip'] = ip
+        reply = ''
+        try:
+            status, reply = self.server.get(config['server_url'], query, headers)
+            reply = reply.strip()
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            log.error("Failed updating %s: %s", config['server_url'], e)
+            error = f"fail ({e or type(e).__name__})"
+            reply = f"{reply} [{error}]" if reply else error
+        return reply
+
+    def check(self, force:bool=False) -> str:
+        """Update the server if the public IP changed, as a run of client.sh"""
+        ip = self.public_ip()
+        reply = ''
+        if not ip or ip != read_ip(self.cache):
+            action = 'update'
+            write_ip(self.cache, ip)
+        elif force:
+            action = 'forced'
+        else:
+            action = ''
+        if action:
+            reply = self.update(ip)
+            code, _, new_ip = reply.partition(' ')
+            new_ip = new_ip.strip() or ip
+            if code == 'good' and new_ip:
+                write_ip(self.cache, new_ip)
+        write_log(self.logfile, action or 'nochg', ip, reply)
+        return reply
+
+    def close(self) -> None:
+        self.server.close()
+        self.provider.close()
+
+
+def watch(client:Client, interval:float, settle:float, force:bool=False) -> None:
+    """Check on startup, on address changes and every interval seconds"""
+    monitor: t.Optional[AddressMonitor] = None
+    try:
+        monitor = AddressMonitor()
+    except (AttributeError, OSError) as e:
+        # No AF_NETLINK outside Linux
+        log.warning("Address monitoring not available, checking every %s seconds: %s",
+                    interval, e)
+        interval = interval or 3600
+
+    client.check(force)
+    while True:
+        deadline = time.monotonic() + interval if interval > 0 else None
+        changed = False
+        while not changed:
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                break
+            if monitor is None:
+                time.sleep(timeout)
+                break
+            if select.select([monitor], [], [], timeout)[0]:
+                changed = monitor.read()
+        if changed:
+            # Let a burst of changes, such as from DHCP or SLAAC, settle down
+            end = time.monotonic() + settle
+            while select.select([monitor], [], [], max(0, end - time.monotonic()))[0]:
+                monitor.read()
+            log.debug("Local addresses changed")
+        client.check()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="Force IP update on the first check,"
+                             " even if it did not change since last run.")
+    parser.add_argument('-S', '--setup', action='store_true',
+                        help="Create the config file if missing, print its path, and exit.")
+    parser.add_argument('-c', '--config', default=CONFIG,
+                        help="Use FILE for configuration instead of the default location"
+                             " %(default)s")
+    parser.add_argument('-L', '--no-log', dest='logfile', action='store_const', const='',
+                        default=LOGFILE,
+                        help="Output to stdout instead of the default log file at"
+                             f" {LOGFILE}")
+    parser.add_argument('-1', '--once', action='store_true',
+                        help="Check once and exit, like client.sh, for use in cron.")
+    parser.add_argument('-i', '--interval', type=float, default=3600,
+                        help="Seconds between checks with no local address change,"
+                             " 0 for none. [Default: %(default)s]")
+    parser.add_argument('--settle', type=float, default=2,
+                        help="Seconds to wait for further address changes before"
+                             " checking. [Default: %(default)s]")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="Log debug messages to stderr.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(name)s: %(levelname)s: %(message)s')
+
+    if not os.access(args.config, os.R_OK):
+        write_config(args.config)
+        log.warning("A blank configuration file was created,"
+                    " please edit it before using %s", log.name)
+        args.setup = True
+    if args.setup:
+        print(args.config)
+        return
+
+    client = Client(read_config(args.config), logfile=args.logfile)
+    try:
+        if args.once:
+            client.check(args.force)
+        else:
+            watch(client, args.interval, args.settle, args.force)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,12 +9,13 @@ bin=${XDG_BIN_HOME:-$HOME/.local/bin}/${slug}
 log=${XDG_CACHE_HOME:-$HOME/.cache}/${slug}.stderr.log
 
 bin_rel=client/client.sh
-url=https://raw.githubusercontent.com/MestreLion/ddnsp/main/${bin_rel}
 myself=${0##*/}
 here=$(dirname "$(readlink -f "$0")")
 
 default_config=${XDG_CONFIG_HOME:-"$HOME"/.config}/${slug}.conf
 config=$default_config
+unit=${XDG_CONFIG_HOME:-$HOME/.config}/systemd/user/${slug}.service
+daemon=0
 cron_opts=''
 opts=()
 verbose=1
@@ -47,11 +48,15 @@ usage() {
 	- Download or symlink executable to '${bin}'
 	- Create the configuration file and invoke 'editor' to edit it.
 	- Set a crontab task, logging errors to '${log}'
+	  or, with --daemon, a systemd user service, replacing any such task,
+	  and enable lingering so it runs even when not logged in
 
 	Options:
 	  -h|--help         - show this page.
 	  -c|--config FILE  - use FILE for configuration instead of the default:
 	                      ${default_config}
+	  -d|--daemon       - install the Python client daemon, which updates
+	                      when local addresses change, instead of the cron task
 
 	Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
 	License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
@@ -63,6 +68,7 @@ for arg in "$@"; do [[ "$arg" == "-h" || "$arg" == "--help" ]] && usage; done
 while (($#)); do
 	case "$1" in
 	-c | --config) shift; config=${1:-};;
+	-d | --daemon) daemon=1;;
 	--config=*) config=${1#*=};;
 	-*) invalid "$1" ;;
 	*) argerr "$1" ;;
@@ -70,11 +76,18 @@ while (($#)); do
 	shift || break
 done
 
+if ((daemon)); then
+	bin_rel=client/client.py
+fi
+url=https://raw.githubusercontent.com/MestreLion/ddnsp/main/${bin_rel}
+
 if [[ "$config" != "$default_config" ]]; then
 	opts+=(-c "$config")
 	cron_opts=" -c $(escape "$(readlink -f "$config")")"
 fi
 
+cron_bin=$(escape "$bin")
+cron_bin=${cron_bin//"$HOME"/'~'}
 cron_opts="@hourly $(escape "$bin")${cron_opts} 2>> $(escape "$log")"
 cron_opts=${cron_opts//"$HOME"/'~'}
 
@@ -83,7 +96,11 @@ cron_opts=${cron_opts//"$HOME"/'~'}
 message "Installing Personal DDNS Client: ${slug}"
 
 # Install dependencies
-if ! exists curl; then
+if ((daemon)); then
+	if ! exists python3; then
+		sudo apt install -y python3
+	fi
+elif ! exists curl; then
 	sudo apt install -y curl
 fi
 
@@ -111,6 +128,38 @@ fi
 "$bin" "${opts[@]}" --setup >/dev/null
 "${EDITOR:-editor}" -- "$config"
 
+if ((daemon)); then
+	# Add and start the systemd user service
+	mkdir -p -- "$(dirname "$unit")"
+	cat > "$unit" <<-EOF
+		[Unit]
+		Description=Personal DDNS Client
+		Wants=network-online.target
+		After=network-online.target
+
+		[Service]
+		ExecStart="${bin}"${opts[*]:+ -c "$(readlink -f "$config")"}
+		Restart=on-failure
+		RestartSec=60
+
+		[Install]
+		WantedBy=default.target
+	EOF
+	systemctl --user daemon-reload
+	systemctl --user enable --now -- "${slug}.service"
+	# Keep the user service running while logged out, and after boot
+	if [[ "$(loginctl show-user "$USER" --property=Linger --value 2>/dev/null)" != yes ]]; then
+		loginctl enable-linger "$USER" 2>/dev/null ||
+		sudo loginctl enable-linger "$USER"
+	fi
+	# Remove the cron task of a previous install, it would run the daemon too
+	if crontab -l 2>/dev/null | grep -Fq -- "$cron_bin"; then
+		crontab -l | grep -Fv -- "$cron_bin" | crontab -
+	fi
+	message "Done!"
+	exit
+fi
+
 # Add task to crontab
 if ! crontab -l 2>/dev/null | grep -Fxq "$cron_opts"; then
 	( (exec 2>/dev/null; crontab -l || EDITOR='cat' crontab -e) &&
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Cold-start benchmark: import time and time-to-first-response of a worker
+
+Each trial runs in a fresh interpreter, timing the import of the package,
+create_app(), and the first / and /update requests. In fresh mode a worker
+does all of it, as gunicorn without --preload. In preload mode the app is
+created first and the worker is forked from it, as gunicorn --preload, so
+only the first requests are timed in the worker. Also lists which heavy
+modules got imported at each step, and optionally the slowest imports:
+
+    python bench/bench_startup.py --trials 20 --output bench-startup.json
+    python bench/bench_startup.py --backend godaddy --importtime 15
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing as t
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+sys.path.insert(0, HERE)
+from bench_update import git_commit  # noqa: E402
+
+
+# Modules that are costly to import, and only needed by some setups
+HEAVY = ('requests', 'urllib3', 'argon2', 'ddnsp.backends.bind9',
+         'ddnsp.backends.builtin', 'ddnsp.backends.godaddy', 'ddnsp.backends.null')
+
+STEPS = ('import', 'create_app', 'first_index', 'first_update')
+
+# Run in each trial's interpreter, printing a JSON report to stdout
+TRIAL = r'''
+import base64, json, os, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+import ddnsp
+timings = {{'import': time.perf_counter() - start}}
+heavy = {heavy!r}
+loaded = {{'import': [m for m in heavy if m in sys.modules]}}
+
+step = time.perf_counter()
+app = ddnsp.create_app({config!r})
+timings['create_app'] = time.perf_counter() - step
+loaded['create_app'] = [m for m in heavy if m in sys.modules]
+
+if {preload!r}:
+    r, w = os.pipe()
+    if os.fork():
+        os.close(w)
+        with os.fdopen(r) as pipe:
+            sys.stdout.write(pipe.read())
+        os.wait()
+        sys.stdout.flush()
+        os._exit(0)
+    os.close(r)
+    out = os.fdopen(w, 'w')
+else:
+    out = sys.stdout
+
+forked = time.perf_counter()
+client = app.test_client()
+step = time.perf_counter()
+client.get('/')
+timings['first_index'] = time.perf_counter() - step
+auth = base64.b64encode(b'bench:benchpass').decode()
+step = time.perf_counter()
+res = client.get('/update', query_string={{'hostname': 'bench', 'myip': '192.0.2.1'}},
+                 headers={{'Authorization': 'Basic ' + auth}})
+timings['first_update'] = time.perf_counter() - step
+timings['worker_ready'] = time.perf_counter() - (forked if {preload!r} else start)
+loaded['first_update'] = [m for m in heavy if m in sys.modules]
+out.write(json.dumps({{'timings': timings, 'loaded': loaded,
+                       'reply': res.get_data(as_text=True)}}))
+out.flush()
+os._exit(0)  # skip interpreter teardown and background threads
+'''
+
+
+def summary(samples:t.List[float]) -> dict:
+    """Median, min and max, in milliseconds"""
+    return {
+        'median': round(1000 * statistics.median(samples), 3),
+        'min':    round(1000 * min(samples), 3),
+        'max':    round(1000 * max(samples), 3),
+    }
+
+
+def trial_config(args, instance:str) -> dict:
+    config = dict(
+        DATABASE=os.path.join(instance, 'bench.db'),
+        DNS_BACKEND=args.backend,
+        DNS_DOMAIN='example.com',
+        DNS_SUBDOMAIN='d',
+        RATELIMIT_ENABLED=False,
+    )
+    if args.backend == 'godaddy':
+        # Never reached, DNS changes stay queued in the outbox
+        config.update(DNS_GODADDY_HOST='http://127.0.0.1:9')
+    return config
+
+
+def run_trial(args, preload:bool, importtime:bool=False) -> t.Tuple[dict, str]:
+    """Run a trial in a fresh interpreter, return its report and stderr"""
+    with tempfile.TemporaryDirectory(prefix='ddnsp-bench-') as instance:
+        code = TRIAL.format(root=ROOT, heavy=HEAVY, preload=preload,
+                            config=trial_config(args, instance))
+        cmd = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+        start = time.perf_counter()
+        proc = subprocess.run(cmd, capture_output=True, text=True, cwd=instance)
+        wall = time.perf_counter() - start
+    if proc.returncode or not proc.stdout:
+        raise RuntimeError(f"Trial failed:\n{proc.stderr}")
+    report = json.loads(proc.stdout)
+    report['timings']['process'] = wall
+    return report, proc.stderr
+
+
+def slowest_imports(stderr:str, count:int) -> t.List[dict]:
+    """Top imports by cumulative time, from -X importtime output"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        imports.append({'module': name.strip(), 'self_ms': int(own) / 1000,
+                        'cumulative_ms': int(cumulative) / 1000})
+    imports.sort(key=lambda item: item['cumulative_ms'], reverse=True)
+    return imports[:count]
+
+
+def run(args) -> dict:
+    modes: t.Dict[str, dict] = {}
+    for mode in args.modes:
+        trials = [run_trial(args, preload=(mode == 'preload'))[0]
+                  for _ in range(args.trials)]
+        keys = list(STEPS) + ['worker_ready', 'process']
+        modes[mode] = {
+            'timings': {key: summary([trial['timings'][key] for trial in trials])
+                        for key in keys},
+            'loaded':  trials[-1]['loaded'],
+            'replies': sorted({trial['reply'] for trial in trials}),
+        }
+    report = {
+        'meta': {
+            'commit':    git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python':    platform.python_version(),
+            'platform':  platform.platform(),
+            'args':      {k: v for k, v in vars(args).items() if k != 'output'},
+        },
+        'modes': modes,
+    }
+    if args.importtime:
+        _, stderr = run_trial(args, preload=False, importtime=True)
+        report['slowest_imports'] = slowest_imports(stderr, args.importtime)
+    return report
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument('--trials', '-n', type=int, default=10,
+                        help="Fresh interpreters per mode")
+    parser.add_argument('--modes', nargs='+', choices=('fresh', 'preload'),
+                        default=['fresh', 'preload'])
+    parser.add_argument('--backend', choices=('null', 'bind9', 'godaddy'), default='null',
+                        help="DNS backend, changes are queued in the outbox")
+    parser.add_argument('--importtime', type=int, default=0, metavar='COUNT',
+                        help="Also report the COUNT slowest imports, using -X importtime")
+    parser.add_argument('--output', '-o', default='bench-startup.json',
+                        help="JSON results file, '-' for stdout")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(text)
+        return
+    with open(args.output, 'w') as f:
+        f.write(text + '\n')
+    for mode, data in report['modes'].items():
+        timings = data['timings']
+        print(f"{mode}: import={timings['import']['median']}ms"
+              f" create_app={timings['create_app']['median']}ms"
+              f" first_update={timings['first_update']['median']}ms"
+              f" worker_ready={timings['worker_ready']['median']}ms")
+    print(f"-> {args.output}")
+
+
+if __name__ == '__main__':
+    main()
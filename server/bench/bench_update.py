@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Load test of the update path, driving create_app() with dyndns2 traffic
+
+Simulates a fleet of ddclient/inadyn-like clients: a mix of new
+registrations, unchanged IPs (nochg), IP changes and bad passwords, sent
+concurrently through the WSGI app. Reports throughput and p50/p95/p99
+latency per request kind and per phase (check_args, Argon2, storage and
+DNS backend), and writes them as JSON to compare between commits:
+
+    python bench/bench_update.py --requests 2000 --output bench-results.json
+    python bench/bench_update.py --backend godaddy --inline-dns --dns-delay 0.05
+    python bench/bench_update.py --engine memory
+"""
+
+import argparse
+import base64
+import collections
+import contextlib
+import functools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing as t
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import ddnsp  # noqa: E402
+from ddnsp import dao, dns, hasher, methods  # noqa: E402
+
+from fake_godaddy import FakeGodaddy  # noqa: E402
+
+
+# Functions timed for each phase. Nested calls within a phase count once.
+PHASES: t.Dict[str, t.List[t.Tuple[t.Any, str]]] = {
+    'check_args': [(methods, 'check_args')],
+    'argon2':     [(hasher, name) for name in ('verify', 'hash_password')],
+    'sqlite':     [(dao, name) for name in ('get_host', 'get_hosts', 'add_host',
+                                            'add_hosts', 'update_host',
+                                            'update_hosts', 'update_ip',
+                                            'update_password', 'update_timestamp')],
+    'dns':        [(dns, name) for name in ('update_ip', 'update_ips', 'delete_ips')],
+}
+
+KINDS = ('new', 'nochg', 'change', 'badauth')
+EXPECTED = {'new': 'good', 'nochg': 'nochg', 'change': 'good', 'badauth': 'badauth'}
+PASSWORD = 'benchpass'
+
+
+class PhaseTimer:
+    """Accumulate time spent in each phase, per request thread
+
+    Calls made outside a request, such as by the outbox dispatcher, are
+    recorded as background samples.
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.background: t.Dict[str, t.List[float]] = collections.defaultdict(list)
+        self._lock = threading.Lock()
+        self._originals: t.List[t.Tuple[t.Any, str, t.Callable]] = []
+
+    def wrap(self, phase:str, func:t.Callable) -> t.Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            depth = self.local.__dict__.setdefault('depth', collections.Counter())
+            if depth[phase]:
+                return func(*args, **kwargs)
+            depth[phase] += 1
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                depth[phase] -= 1
+                phases = getattr(self.local, 'phases', None)
+                if phases is not None:
+                    phases[phase] += elapsed
+                else:
+                    with self._lock:
+                        self.background[phase].append(elapsed)
+        return wrapper
+
+    def install(self) -> None:
+        for phase, targets in PHASES.items():
+            for module, name in targets:
+                func = getattr(module, name)
+                self._originals.append((module, name, func))
+                setattr(module, name, self.wrap(phase, func))
+
+    def uninstall(self) -> None:
+        for module, name, func in reversed(self._originals):
+            setattr(module, name, func)
+        self._originals.clear()
+
+    @contextlib.contextmanager
+    def request(self) -> t.Iterator[t.Counter[str]]:
+        self.local.phases = collections.Counter()
+        try:
+            yield self.local.phases
+        finally:
+            self.local.phases = None
+
+
+def summary(samples:t.List[float]) -> dict:
+    """Count, mean and percentiles, in milliseconds"""
+    if not samples:
+        return {'count': 0}
+    data = sorted(samples)
+
+    def pct(q):
+        return round(1000 * data[min(len(data) - 1, int(q * len(data)))], 3)
+
+    return {
+        'count': len(data),
+        'mean':  round(1000 * sum(data) / len(data), 3),
+        'p50':   pct(0.50),
+        'p95':   pct(0.95),
+        'p99':   pct(0.99),
+        'max':   round(1000 * data[-1], 3),
+    }
+
+
+def git_commit() -> t.Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# -----------------------------------------------------------------------------
+class Fleet:
+    """Simulated clients, each thread owning a disjoint set of hosts"""
+    def __init__(self, app, hosts:int, concurrency:int, mix:t.Dict[str, float]):
+        self.app = app
+        self.concurrency = concurrency
+        self.kinds, self.weights = zip(*mix.items())
+        self.hosts: t.List[t.Dict[str, str]] = [{} for _ in range(concurrency)]
+        self.counter = 0
+        self.lock = threading.Lock()
+        for i in range(hosts):
+            self.hosts[i % concurrency][self.new_hostname()] = self.random_ip()
+
+    def new_hostname(self) -> str:
+        with self.lock:
+            self.counter += 1
+            return f'bench{self.counter}'
+
+    @staticmethod
+    def random_ip() -> str:
+        return '.'.join(str(random.randint(1, 254)) for _ in range(4))
+
+    def request(self, client, hostname:str, ip:str, password:str=PASSWORD) -> str:
+        auth = base64.b64encode(f'{hostname}:{password}'.encode()).decode()
+        res = client.get('/update', query_string={'hostname': hostname, 'myip': ip},
+                         headers={'Authorization': f'Basic {auth}'})
+        return res.get_data(as_text=True)
+
+    def register_all(self) -> None:
+        client = self.app.test_client()
+        for hosts in self.hosts:
+            for hostname, ip in hosts.items():
+                self.request(client, hostname, ip)
+
+    def next_request(self, worker:int) -> t.Tuple[str, str, str, str]:
+        hosts = self.hosts[worker]
+        kind = random.choices(self.kinds, self.weights)[0]
+        if kind == 'new' or not hosts:
+            kind = 'new'
+            hostname, ip = self.new_hostname(), self.random_ip()
+            hosts[hostname] = ip
+            return kind, hostname, ip, PASSWORD
+        hostname = random.choice(list(hosts))
+        if kind == 'change':
+            hosts[hostname] = self.random_ip()
+        password = 'wrong' + PASSWORD if kind == 'badauth' else PASSWORD
+        return kind, hostname, hosts[hostname], password
+
+
+def run(args) -> dict:
+    instance = tempfile.mkdtemp(prefix='ddnsp-bench-')
+    config = dict(
+        DATABASE=os.path.join(instance, 'bench.db'),
+        JOURNAL=os.path.join(instance, 'bench.journal'),
+        STORAGE_ENGINE=args.engine,
+        DNS_BACKEND=args.backend,
+        DNS_DOMAIN='example.com',
+        DNS_SUBDOMAIN='d',
+        DNS_NULL_DELAY=args.dns_delay,
+        OUTBOX_ENABLED=not args.inline_dns,
+        RATELIMIT_ENABLED=False,
+        USERNAME_MAX_LENGTH=100,
+    )
+    for key in ('time_cost', 'memory_cost', 'parallelism'):
+        value = getattr(args, f'argon2_{key}')
+        if value:
+            config[f'ARGON2_{key.upper()}'] = value
+    fake = None
+    if args.backend == 'godaddy':
+        fake = FakeGodaddy(delay=args.dns_delay).start()
+        config.update(DNS_GODADDY_HOST=fake.url, DNS_GODADDY_KEY='bench',
+                      DNS_GODADDY_SECRET='bench')
+
+    app = ddnsp.create_app(config)
+    fleet = Fleet(app, args.hosts, args.concurrency, args.mix)
+    setup_start = time.perf_counter()
+    fleet.register_all()
+    setup_time = time.perf_counter() - setup_start
+
+    timer = PhaseTimer()
+    timer.install()
+    latencies: t.Dict[str, t.List[float]] = collections.defaultdict(list)
+    phases: t.Dict[str, t.List[float]] = collections.defaultdict(list)
+    results: t.Counter[str] = collections.Counter()
+    mismatches: t.Counter[str] = collections.Counter()
+    lock = threading.Lock()
+    per_worker = [args.requests // args.concurrency] * args.concurrency
+    for i in range(args.requests % args.concurrency):
+        per_worker[i] += 1
+
+    def worker(i):
+        client = app.test_client()
+        for _ in range(per_worker[i]):
+            kind, hostname, ip, password = fleet.next_request(i)
+            with timer.request() as spent:
+                start = time.perf_counter()
+                res = fleet.request(client, hostname, ip, password)
+                elapsed = time.perf_counter() - start
+            code = res.split(' ', 1)[0]
+            with lock:
+                latencies['total'].append(elapsed)
+                latencies[kind].append(elapsed)
+                for phase, seconds in spent.items():
+                    phases[phase].append(seconds)
+                results[code] += 1
+                if code != EXPECTED[kind]:
+                    mismatches[f'{kind}:{code}'] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    timer.uninstall()
+    if fake is not None:
+        fake.shutdown()
+
+    return {
+        'meta': {
+            'commit':      git_commit(),
+            'timestamp':   time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python':      platform.python_version(),
+            'platform':    platform.platform(),
+            'args':        {k: v for k, v in vars(args).items() if k != 'output'},
+            'setup_seconds': round(setup_time, 3),
+        },
+        'requests':   sum(results.values()),
+        'seconds':    round(duration, 3),
+        'throughput': round(sum(results.values()) / duration, 2),
+        'results':    dict(results),
+        'mismatches': dict(mismatches),
+        'latency':    {kind: summary(samples) for kind, samples in latencies.items()},
+        'phases':     {phase: summary(phases[phase]) for phase in PHASES},
+        'background': {phase: summary(samples) for phase, samples in timer.background.items()},
+        'dns_requests': dict(fake.requests) if fake is not None else None,
+    }
+
+
+def parse_mix(value:str) -> t.Dict[str, float]:
+    mix = dict.fromkeys(KINDS, 0.0)
+    for item in value.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in mix:
+            raise argparse.ArgumentTypeError(f"invalid kind {kind!r}, choose from {KINDS}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument('--requests', '-n', type=int, default=2000)
+    parser.add_argument('--concurrency', '-c', type=int, default=8)
+    parser.add_argument('--hosts', type=int, default=200,
+                        help="Hosts registered before the run")
+    parser.add_argument('--mix', type=parse_mix,
+                        default='new=0.02,nochg=0.85,change=0.08,badauth=0.05',
+                        help="Weights of each request kind")
+    parser.add_argument('--backend', choices=('null', 'godaddy'), default='null',
+                        help="DNS backend: in-memory stub or fake GoDaddy HTTP server")
+    parser.add_argument('--engine', choices=tuple(dao.ENGINES), default='sqlite',
+                        help="Storage engine")
+    parser.add_argument('--dns-delay', type=float, default=0,
+                        help="Simulated DNS backend latency, in seconds")
+    parser.add_argument('--inline-dns', action='store_true',
+                        help="Update DNS within the request instead of the outbox")
+    parser.add_argument('--argon2-time-cost', type=int)
+    parser.add_argument('--argon2-memory-cost', type=int, help="in KiB")
+    parser.add_argument('--argon2-parallelism', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', '-o', default='bench-results.json',
+                        help="JSON results file, '-' for stdout")
+    args = parser.parse_args(argv)
+    if isinstance(args.mix, str):
+        args.mix = parse_mix(args.mix)
+    random.seed(args.seed)
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+        print(f"{report['requests']} requests in {report['seconds']}s:"
+              f" {report['throughput']} req/s, p50={report['latency']['total']['p50']}ms"
+              f" p99={report['latency']['total']['p99']}ms -> {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Local stand-in for the GoDaddy Domains API, keeping records in memory
+
+Implements the record endpoints used by the godaddy backend, with optional
+latency and rate limiting (429 with Retry-After), so the backend can be
+exercised and benchmarked without network access. Point it with:
+
+    DNS_GODADDY_HOST = 'http://127.0.0.1:<port>'
+"""
+
+import argparse
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import typing as t
+
+
+RECORDS_RE = re.compile(r'^/v1/domains/(?P<domain>[^/]+)/records'
+                        r'(?:/(?P<type>[^/]+)(?:/(?P<name>[^/]+))?)?/?$')
+
+
+class FakeGodaddy(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), delay:float=0, rate_limit:float=0):
+        super().__init__(address, Handler)
+        self.delay:      float = delay       # seconds per request
+        self.rate_limit: float = rate_limit  # probability of a 429 reply
+        self.records: t.Dict[str, t.List[dict]] = {}  # {domain: [record, ...]}
+        self.requests: t.Dict[str, int] = {}         # {method: count}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def start(self) -> 'FakeGodaddy':
+        threading.Thread(target=self.serve_forever, name='fake-godaddy', daemon=True).start()
+        return self
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    server: FakeGodaddy
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def reply(self, status:int, data=None, headers:dict=None) -> None:
+        body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_records(self) -> None:
+        srv = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'null')
+        with srv.lock:
+            srv.requests[self.command] = srv.requests.get(self.command, 0) + 1
+        if srv.delay:
+            time.sleep(srv.delay)
+        if srv.rate_limit and random.random() < srv.rate_limit:
+            self.reply(429, {'code': 'TOO_MANY_REQUESTS'}, {'Retry-After': '1'})
+            return
+        match = RECORDS_RE.match(self.path.split('?', 1)[0])
+        if not match:
+            self.reply(404, {'code': 'NOT_FOUND'})
+            return
+        domain, rtype, name = match.group('domain', 'type', 'name')
+
+        def selected(rec):
+            return ((not rtype or rec['type'] == rtype) and
+                    (not name or rec['name'] == name))
+
+        with srv.lock:
+            zone = srv.records.setdefault(domain, [])
+            if self.command == 'GET':
+                self.reply(200, [rec for rec in zone if selected(rec)])
+                return
+            if self.command == 'PATCH':
+                zone.extend(body)
+            elif self.command == 'PUT':
+                kept = [rec for rec in zone if not selected(rec)]
+                for rec in body:
+                    rec.setdefault('type', rtype)
+                    rec.setdefault('name', name)
+                srv.records[domain] = kept + body
+            elif self.command == 'DELETE':
+                srv.records[domain] = [rec for rec in zone if not selected(rec)]
+            else:
+                self.reply(405, {'code': 'METHOD_NOT_ALLOWED'})
+                return
+        self.reply(200)
+
+    do_GET = do_PATCH = do_PUT = do_DELETE = handle_records
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--delay', type=float, default=0, help="Seconds per request")
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help="Probability of replying 429")
+    args = parser.parse_args(argv)
+    server = FakeGodaddy(('127.0.0.1', args.port), args.delay, args.rate_limit)
+    print(f"Fake GoDaddy API listening on {server.url}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,22 +3,42 @@
 # License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
 """
 Personal DDNS Server
+
+The app factory only does work that can be shared by forked workers, so the
+app may be preloaded by a pre-fork server, such as with gunicorn --preload.
+Threads, sockets and database connections are started once per process, see
+start_services(): at the end of create_app(), or right after the fork in the
+workers of a PRELOAD app.
 """
 
 import logging
 import pprint
 import os
+import threading
+import time
+import typing as t
 
+import click
 import flask
 import flask.logging
+import werkzeug.serving
 
+from . import cli
 from . import dao
 from . import dns
+from . import expiry
+from . import flight
+from . import hasher
+from . import logs
 from . import methods
+from . import metrics
+from . import outbox
+from . import ratelimit
+from . import rehash
 from . import util as u
 
 
-__all__ = ['CONFIG_DEFAULTS', 'create_app']
+__all__ = ['CONFIG_DEFAULTS', 'create_app', 'handle_update', 'start_services']
 
 SLUG = __name__  # ddnsp
 
@@ -27,12 +47,72 @@ CONFIG_DEFAULTS = dict(
     DNS_DOMAIN = '',
     DNS_SUBDOMAIN = '',
     DNS_TTL = 0,
+    DNS_BATCH_WINDOW = 0.5,
+    DNS_BATCH_SIZE = 100,
+    DNS_SNAPSHOT_TTL = 300,
     HOSTNAME_MAX_LENGTH = 50,
+    HOSTNAME_MAX_COUNT = 20,
     USERNAME_MAX_LENGTH = 100,
     PASSWORD_MAX_LENGTH = 100,
     PASSWORD_MIN_LENGTH = 6,
+    AUTH_CACHE_TTL = 300,
+    AUTH_CACHE_SIZE = 10000,
+    HASH_WORKERS = 0,
+    HASH_MEMORY_BUDGET = 256,
+    HASH_QUEUE_SIZE = 32,
+    HASH_QUEUE_TIMEOUT = 10,
+    HASH_CALIBRATE_MS = 0,
+    HASH_CALIBRATE_MEMORY = 65536,
+    HASH_REHASH_QUEUE_SIZE = 1000,
+    HASH_REHASH_INTERVAL = 30,
+    STORAGE_ENGINE = 'sqlite',
+    MEMORY_FSYNC = True,
+    MEMORY_COMPACT_INTERVAL = 300,
+    MEMORY_COMPACT_RATIO = 4,
+    MEMORY_TIMEOUT = 5,
+    SQLITE_POOL_SIZE = 8,
+    SQLITE_TIMEOUT = 5,
+    SQLITE_CACHED_STATEMENTS = 128,
+    SQLITE_JOURNAL_MODE = 'WAL',
+    SQLITE_SYNCHRONOUS = 'NORMAL',
+    SQLITE_MMAP_SIZE = 64 * 1024 * 1024,
+    SQLITE_CACHE_SIZE = -8000,
+    TIMESTAMP_FLUSH_INTERVAL = 30,
+    TIMESTAMP_FLUSH_BATCH = 1000,
+    OUTBOX_ENABLED = True,
+    OUTBOX_INTERVAL = 5,
+    OUTBOX_BATCH_SIZE = 100,
+    OUTBOX_LEASE = 60,
+    OUTBOX_BACKOFF_MAX = 600,
+    HOST_EXPIRE_DAYS = 0,
+    HOST_EXPIRE_INTERVAL = 3600,
+    HOST_EXPIRE_BATCH_SIZE = 100,
+    RATELIMIT_ENABLED = True,
+    RATELIMIT_MAX_KEYS = 100000,
+    RATELIMIT_IP_PER_MINUTE = 60,
+    RATELIMIT_IP_BURST = 120,
+    RATELIMIT_HOSTNAME_PER_MINUTE = 2,
+    RATELIMIT_HOSTNAME_BURST = 10,
+    RATELIMIT_USERNAME_PER_MINUTE = 10,
+    RATELIMIT_USERNAME_BURST = 30,
+    UPDATE_SINGLE_FLIGHT = True,
+    UPDATE_LOCK = False,
+    UPDATE_LOCK_SLOTS = 1024,
+    PRELOAD = False,
+    ASGI_THREADS = 16,
+    ASGI_QUEUE_SIZE = 64,
+    LOG_QUEUE = False,
+    LOG_STRUCTURED = False,
+    LOG_NOCHG_INTERVAL = 60,
+    METRICS_ENABLED = False,
+    METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1, 2.5, 5, 10),
 )
 
+_app: t.Optional[flask.Flask] = None
+_services_pid: int = 0  # PID of the process running the services of _app
+_services_lock = threading.Lock()
+
 flask.logging.default_handler.setFormatter(
     logging.Formatter("[%(asctime)s] %(levelname)-8s: %(name)s: %(message)s",
                       "%Y-%m-%d %H:%M:%S")
@@ -40,6 +120,8 @@ flask.logging.default_handler.setFormatter(
 
 
 def create_app(config=None) -> flask.Flask:
+    global _app, _services_pid
+
     def ipath(*paths):
         return os.path.join(app.instance_path, *paths)
 
@@ -47,6 +129,9 @@ def create_app(config=None) -> flask.Flask:
     app = flask.Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
         DATABASE=ipath(f'{SLUG}.db'),
+        JOURNAL=ipath(f'{SLUG}.journal'),
+        HASH_CALIBRATION=ipath('argon2.json'),
+        UPDATE_LOCK_FILE=ipath(f'{SLUG}.lock'),
         **CONFIG_DEFAULTS,
     )
     if config is None:
@@ -55,7 +140,8 @@ def create_app(config=None) -> flask.Flask:
     else:
         app.config.from_mapping(config)
 
-    app.logger.debug("App config: \n%s", pprint.pformat(app.config, indent=2))
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug("App config: \n%s", pprint.pformat(app.config, indent=2))
     validate_config(app.config)
 
     try:
@@ -63,13 +149,45 @@ def create_app(config=None) -> flask.Flask:
     except OSError:
         pass
 
+    logs.init_app(app)
     dao.init_app(app)
+    hasher.init_app(app)
     dns.init_app(app)
+    outbox.init_app(app)
+    expiry.init_app(app)
+    rehash.init_app(app)
+    flight.init_app(app)
+    ratelimit.init_app(app)
+    metrics.init_app(app)
+    cli.init_app(app)
+    _app = app
+    _services_pid = 0
 
     @app.route('/')
     def index():
         return "Welcome to <b>ddnsp</b> - Personal Self-Hosted Dynamic DNS\n"
 
+    @app.route('/status')
+    def status():
+        return {'outbox': outbox.status() if outbox.enabled() else None}
+
+    @app.route('/metrics')
+    def prometheus():
+        if not metrics.enabled():
+            flask.abort(404)
+        gauges = {}
+        if outbox.enabled():
+            status = outbox.status()
+            gauges['ddnsp_outbox_depth'] = ("DNS changes pending in the outbox",
+                                            status['depth'])
+            gauges['ddnsp_outbox_lag_seconds'] = ("Age of the oldest pending DNS change",
+                                                  status['lag'])
+        if hasher.executor is not None:
+            gauges['ddnsp_argon2_pending'] = ("Argon2 calls running or waiting",
+                                              hasher.executor.pending)
+        return flask.Response(metrics.render(gauges),
+                              mimetype='text/plain; version=0.0.4')
+
     @app.route('/nic/update')
     def legacy():
         return flask.redirect(flask.url_for('update'), 301)  # Moved Permanently
@@ -77,20 +195,102 @@ def create_app(config=None) -> flask.Flask:
     @app.route('/update')
     def update():
         req = flask.request
-        auth = req.authorization
-        app.logger.debug('%s, %s', auth, req.args)
-        params = {
-            'username': req.args.get('username', auth.get('username', '')),
-            'password': req.args.get('password', auth.get('password', '')),
-            'hostname': req.args.get('hostname', ''),
-            'ip': req.args.get('myip', req.remote_addr or ''),
-        }
+        return handle_update(req.args, req.authorization or {}, req.remote_addr)
+
+    if _serving(app):
+        start_services()
+    return app
+
+
+def _serving(app:flask.Flask) -> bool:
+    """If this process serves the app, so it should start its services now
+
+    Not for a PRELOAD app, whose workers start them after fork, nor for flask
+    commands other than run, such as hosts import, or the reloader watcher.
+    """
+    if app.config['PRELOAD']:
+        return False
+    ctx = click.get_current_context(silent=True)
+    if ctx is None:
+        return True
+    if ctx.info_name != 'run':
+        return False
+    reload = ctx.params.get('reload')
+    if reload is None:
+        reload = app.debug
+    return not reload or werkzeug.serving.is_running_from_reloader()
+
+
+def start_services() -> None:
+    """Start the background threads of the app, once in each process
+
+    Runs when the app is created, or right after the fork for workers of a
+    preloaded app, so none of them are ever shared by processes.
+    """
+    global _services_pid
+    pid = os.getpid()
+    if _app is None or _services_pid == pid:
+        return
+    with _services_lock:
+        if _services_pid == pid:
+            return
+        logs.start(_app)
+        dao.start(_app)
+        dns.start(_app)
+        outbox.start(_app)
+        expiry.start(_app)
+        rehash.start(_app)
+        flight.start(_app)
+        _services_pid = pid
+        _app.logger.debug("Services started in process %s", pid)
+
+
+def _after_fork() -> None:
+    global _services_lock
+    _services_lock = threading.Lock()
+    logs.after_fork()
+    dao.after_fork()
+    hasher.after_fork()
+    rehash.after_fork()
+    flight.after_fork()
+    # An app created but never started is one preloaded by a pre-fork master
+    if _app is not None and _services_pid == 0:
+        start_services()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def handle_update(args:t.Mapping[str, str], auth:t.Mapping[str, str],
+                  remote_addr:t.Optional[str]) -> str:
+    """Update request, given query args and basic auth, for any front-end"""
+    app: flask.Flask = flask.current_app
+    app.logger.debug('%s, %s', auth, args)
+    params = {
+        'username': args.get('username', auth.get('username', '')),
+        'password': args.get('password', auth.get('password', '')),
+        'hostname': args.get('hostname', ''),
+        'ip': args.get('myip', remote_addr or ''),
+    }
+    structured = logs.structured()
+    if not structured and app.logger.isEnabledFor(logging.INFO):
         app.logger.info("REQ: %s", u.obfuscate(params))
+    start = time.perf_counter()
+    # Hostnames as checked by the update, so variants of one share its limit
+    hostnames = methods.split_hostnames(params['hostname'])[:app.config['HOSTNAME_MAX_COUNT']]
+    if ratelimit.allow(ip=remote_addr,
+                       hostname=hostnames,
+                       username=params['username']):
         res = methods.update_ip(**params)
+    else:
+        res = 'abuse'
+    elapsed = time.perf_counter() - start
+    metrics.observe_update(res, elapsed)
+    if structured:
+        logs.log_update(params, res, elapsed)
+    else:
         app.logger.info("RES: %s", res)
-        return res
-
-    return app
+    return res
 
 
 def validate_config(config) -> None:
@@ -98,7 +298,45 @@ def validate_config(config) -> None:
     config['DNS_SUBDOMAIN'] = config['DNS_SUBDOMAIN'].strip('. ')
     try:
         config['HOSTNAME_MAX_LENGTH'] = int(config['HOSTNAME_MAX_LENGTH'])
+        config['HOSTNAME_MAX_COUNT'] = int(config['HOSTNAME_MAX_COUNT'])
         config['DNS_TTL'] = int(config['DNS_TTL'])
+        config['DNS_BATCH_WINDOW'] = float(config['DNS_BATCH_WINDOW'])
+        config['DNS_BATCH_SIZE'] = int(config['DNS_BATCH_SIZE'])
+        config['DNS_SNAPSHOT_TTL'] = float(config['DNS_SNAPSHOT_TTL'])
+        config['AUTH_CACHE_TTL'] = float(config['AUTH_CACHE_TTL'])
+        config['AUTH_CACHE_SIZE'] = int(config['AUTH_CACHE_SIZE'])
+        config['HASH_WORKERS'] = int(config['HASH_WORKERS'])
+        config['HASH_MEMORY_BUDGET'] = int(config['HASH_MEMORY_BUDGET'])
+        config['HASH_QUEUE_SIZE'] = int(config['HASH_QUEUE_SIZE'])
+        config['HASH_QUEUE_TIMEOUT'] = float(config['HASH_QUEUE_TIMEOUT'])
+        config['HASH_CALIBRATE_MS'] = float(config['HASH_CALIBRATE_MS'])
+        config['HASH_CALIBRATE_MEMORY'] = int(config['HASH_CALIBRATE_MEMORY'])
+        config['HASH_REHASH_QUEUE_SIZE'] = int(config['HASH_REHASH_QUEUE_SIZE'])
+        config['HASH_REHASH_INTERVAL'] = float(config['HASH_REHASH_INTERVAL'])
+        config['MEMORY_COMPACT_INTERVAL'] = float(config['MEMORY_COMPACT_INTERVAL'])
+        config['MEMORY_COMPACT_RATIO'] = float(config['MEMORY_COMPACT_RATIO'])
+        config['MEMORY_TIMEOUT'] = float(config['MEMORY_TIMEOUT'])
+        config['SQLITE_POOL_SIZE'] = int(config['SQLITE_POOL_SIZE'])
+        config['SQLITE_CACHED_STATEMENTS'] = int(config['SQLITE_CACHED_STATEMENTS'])
+        config['TIMESTAMP_FLUSH_INTERVAL'] = float(config['TIMESTAMP_FLUSH_INTERVAL'])
+        config['TIMESTAMP_FLUSH_BATCH'] = int(config['TIMESTAMP_FLUSH_BATCH'])
+        config['OUTBOX_INTERVAL'] = float(config['OUTBOX_INTERVAL'])
+        config['OUTBOX_BATCH_SIZE'] = int(config['OUTBOX_BATCH_SIZE'])
+        config['OUTBOX_LEASE'] = float(config['OUTBOX_LEASE'])
+        config['OUTBOX_BACKOFF_MAX'] = float(config['OUTBOX_BACKOFF_MAX'])
+        config['HOST_EXPIRE_DAYS'] = float(config['HOST_EXPIRE_DAYS'])
+        config['HOST_EXPIRE_INTERVAL'] = float(config['HOST_EXPIRE_INTERVAL'])
+        config['HOST_EXPIRE_BATCH_SIZE'] = int(config['HOST_EXPIRE_BATCH_SIZE'])
+        config['RATELIMIT_MAX_KEYS'] = int(config['RATELIMIT_MAX_KEYS'])
+        config['UPDATE_LOCK_SLOTS'] = int(config['UPDATE_LOCK_SLOTS'])
+        config['ASGI_THREADS'] = int(config['ASGI_THREADS'])
+        config['ASGI_QUEUE_SIZE'] = int(config['ASGI_QUEUE_SIZE'])
+        config['LOG_NOCHG_INTERVAL'] = float(config['LOG_NOCHG_INTERVAL'])
+        config['METRICS_BUCKETS'] = [float(b) for b in config['METRICS_BUCKETS']]
+        for key in ratelimit.KEYS:
+            for opt in ('PER_MINUTE', 'BURST'):
+                opt = f'RATELIMIT_{key.upper()}_{opt}'
+                config[opt] = float(config[opt])
     except ValueError:
         raise u.DDNSPError("Error in config file values, check integer keys")
     if not (
@@ -0,0 +1,205 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+ASGI entry point, for asyncio servers such as uvicorn or hypercorn:
+
+    uvicorn --factory ddnsp.asgi:create_app
+
+Connections are held by the event loop, so thousands of concurrent, slow or
+idle clients need no threads. Updates are not awaited step by step: each one
+runs the very same, synchronous, handle_update() as the WSGI app in a bounded
+pool of ASGI_THREADS threads, holding a thread while it waits for SQLite, the
+Argon2 executor and, without the outbox, the DNS backend. So with
+OUTBOX_ENABLED = False, as many slow DNS calls as threads stall every other
+update, nochg ones included, until one returns. Keep the outbox enabled, its
+dispatcher sends DNS changes off the request path. Any other route is served
+by the Flask app, also in the thread pool. Beyond ASGI_QUEUE_SIZE calls waiting
+for a thread, updates get 911 at once, as when Argon2 is busy, and other
+routes a 503, instead of piling up in the pool's unbounded queue.
+"""
+
+import asyncio
+import base64
+import binascii
+import concurrent.futures
+import io
+import logging
+import sys
+import threading
+import typing as t
+import urllib.parse
+
+import flask
+
+from . import create_app as create_flask_app
+from . import handle_update
+from . import start_services
+from . import util as u
+
+
+log = logging.getLogger(__name__)
+
+Scope:   't.TypeAlias' = t.Dict[str, t.Any]
+Receive: 't.TypeAlias' = t.Callable[[], t.Awaitable[dict]]
+Send:    't.TypeAlias' = t.Callable[[dict], t.Awaitable[None]]
+
+UPDATE_PATHS = ('/update',)
+
+
+class AsyncApp:
+    """ASGI application wrapping the Flask app"""
+    def __init__(self, app:flask.Flask):
+        self.app: flask.Flask = app
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            app.config['ASGI_THREADS'], thread_name_prefix='ddnsp-asgi'
+        )
+        self.limit:   int = app.config['ASGI_THREADS'] + max(0, app.config['ASGI_QUEUE_SIZE'])
+        self.pending: int = 0
+        self._lock = threading.Lock()
+        if not app.config['OUTBOX_ENABLED'] and app.config['DNS_BACKEND'] != 'null':
+            log.warning("DNS changes are sent from the %s ASGI threads, slow DNS"
+                        " calls may stall all updates. Enable OUTBOX_ENABLED.",
+                        app.config['ASGI_THREADS'])
+
+    async def __call__(self, scope:Scope, receive:Receive, send:Send) -> None:
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if scope['path'] in UPDATE_PATHS:
+                await self.update(scope, send)
+            else:
+                await self.wsgi(scope, receive, send)
+
+    def _done(self, _future) -> None:
+        with self._lock:
+            self.pending -= 1
+
+    async def run(self, func:t.Callable, *args):
+        """Run func in the thread pool, or raise DDNSPBusyError if too many are waiting
+
+        Calls are counted until their thread returns, even if the client is gone.
+        """
+        with self._lock:
+            if self.pending >= self.limit:
+                raise u.DDNSPBusyError("ASGI queue full: %s pending", self.pending)
+            self.pending += 1
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(self._done)
+        return await asyncio.wrap_future(future)
+
+    async def lifespan(self, receive:Receive, send:Send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                start_services()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # -------------------------------------------------------------------------
+    async def update(self, scope:Scope, send:Send) -> None:
+        query = urllib.parse.parse_qs(scope['query_string'].decode('latin-1'))
+        args = {k: v[0] for k, v in query.items()}
+        auth = basic_auth(dict(scope['headers']).get(b'authorization', b''))
+        client = scope.get('client')
+
+        def handle() -> str:
+            start_services()  # in case the server does not support lifespan
+            with self.app.app_context():
+                return handle_update(args, auth, client[0] if client else None)
+
+        try:
+            res = await self.run(handle)
+        except u.DDNSPBusyError as e:
+            log.warning(e)
+            res = '911'
+        body = res.encode()
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/html; charset=utf-8'),
+            (b'content-length', str(len(body)).encode()),
+        ]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def wsgi(self, scope:Scope, receive:Receive, send:Send) -> None:
+        """Serve a request with the Flask WSGI app"""
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        environ = wsgi_environ(scope, bytes(body))
+        start: t.Dict[str, t.Any] = {}
+
+        def start_response(status, headers, exc_info=None):
+            start['status'] = int(status.split(' ', 1)[0])
+            start['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                                for k, v in headers]
+
+        def call() -> bytes:
+            result = self.app.wsgi_app(environ, start_response)
+            try:
+                return b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+
+        try:
+            data = await self.run(call)
+        except u.DDNSPBusyError as e:
+            log.warning(e)
+            start['status'], start['headers'] = 503, [(b'retry-after', b'1')]
+            data = b''
+        await send({'type': 'http.response.start', 'status': start['status'],
+                    'headers': start['headers']})
+        await send({'type': 'http.response.body', 'body': data})
+
+
+def basic_auth(header:bytes) -> t.Dict[str, str]:
+    scheme, _, value = header.decode('latin-1').partition(' ')
+    if scheme.lower() != 'basic':
+        return {}
+    try:
+        username, _, password = base64.b64decode(value).decode().partition(':')
+    except (binascii.Error, UnicodeDecodeError):
+        return {}
+    return {'username': username, 'password': password}
+
+
+def wsgi_environ(scope:Scope, body:bytes) -> dict:
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD':    scope['method'],
+        'SCRIPT_NAME':       scope.get('root_path', ''),
+        'PATH_INFO':         scope['path'],
+        'QUERY_STRING':      scope['query_string'].decode('latin-1'),
+        'SERVER_NAME':       server[0],
+        'SERVER_PORT':       str(server[1]),
+        'SERVER_PROTOCOL':   f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR':       client[0],
+        'REMOTE_PORT':       str(client[1]),
+        'wsgi.version':      (1, 0),
+        'wsgi.url_scheme':   scope.get('scheme', 'http'),
+        'wsgi.input':        io.BytesIO(body),
+        'wsgi.errors':       sys.stderr,
+        'wsgi.multithread':  True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once':     False,
+    }
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[key] = value
+            continue
+        key = f'HTTP_{key}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def create_app(config=None) -> AsyncApp:
+    return AsyncApp(create_flask_app(config))
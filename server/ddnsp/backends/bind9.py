@@ -2,12 +2,169 @@
 # Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
 # License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
 """
-BIND9 DNS API
+BIND9 DNS API, using RFC 2136 Dynamic Updates signed with TSIG
+
+Any server supporting dynamic updates should work, not only BIND9.
+Updates are sent over a persistent TCP connection, and several records
+are packed in a single UPDATE message.
 """
 
+import base64
+import logging
+import random
+import socket
+import struct
+import threading
+import typing as t
+
 from .. import dns
+from .. import util as u
+from .. import wire
+
+
+log = logging.getLogger(__name__)
 
 
 class Bind9API(dns.DNSBase):
-    def update_ip(self, hostname, ip):
-        self.log.debug("Updating %s to %s", hostname, ip)
+    SERVER:  str   = '127.0.0.1'
+    PORT:    int   = 53
+    TIMEOUT: float = 10
+    TTL:     int   = 300
+    ALGORITHM: str = 'hmac-sha256'
+
+    batch = True
+
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        self.server:     str = kw.pop('server',    self.config.get("server", self.SERVER))
+        self.port:       int = kw.pop('port',      self.config.get("port", self.PORT))
+        self.zone:       str = kw.pop('zone',      self.config.get("zone", ''))
+        self.key_name:   str = kw.pop('key_name',  self.config.get("key_name", ''))
+        self.key_secret: str = kw.pop('key_secret', self.config.get("key_secret", ''))
+        self.algorithm:  str = kw.pop('algorithm', self.config.get("algorithm", self.ALGORITHM))
+        self.timeout:  float = kw.pop('timeout',   self.config.get("timeout", self.TIMEOUT))
+        self.ttl:        int = kw.pop('ttl',       self.config.get("ttl", self.TTL))
+        self._secret: bytes = base64.b64decode(self.key_secret)
+        self._sock: t.Optional[socket.socket] = None
+        self._lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    def _connect(self) -> socket.socket:
+        if self._sock is None:
+            log.debug("Connecting to %s:%s", self.server, self.port)
+            self._sock = socket.create_connection((self.server, self.port),
+                                                  timeout=self.timeout)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self._sock
+
+    def start(self) -> None:
+        # A connection inherited through fork would be shared with the parent
+        self._lock = threading.Lock()
+        self.close()
+
+    def close(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _recv_exactly(self, size:int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = self._sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Connection closed by server")
+            data += chunk
+        return bytes(data)
+
+    def _exchange(self, message:bytes) -> bytes:
+        """Send a message and read its reply, reconnecting once if needed"""
+        with self._lock:
+            for attempt in (1, 2):
+                try:
+                    sock = self._connect()
+                    sock.sendall(struct.pack('!H', len(message)) + message)
+                    size = struct.unpack('!H', self._recv_exactly(2))[0]
+                    return self._recv_exactly(size)
+                except OSError as e:
+                    self.close()
+                    if attempt == 2:
+                        raise u.DDNSPError("Error talking to %s:%s: %s",
+                                           self.server, self.port, e)
+                    log.debug("Reconnecting after error: %s", e)
+        raise AssertionError("unreachable")
+
+    def send_update(self, zone:str, updates:t.Iterable[bytes]) -> None:
+        """Send a signed UPDATE message with the given update section RRs"""
+        updates = list(updates)
+        msgid = random.getrandbits(16)
+        message = (wire.HEADER.pack(msgid, wire.OPCODE_UPDATE << 11,
+                                    1, 0, len(updates), 0) +
+                   wire.pack_question(zone, wire.TYPE_SOA) +
+                   b''.join(updates))
+        mac = b''
+        if self.key_name:
+            message, mac = wire.tsig_sign(message, self.key_name, self._secret,
+                                          self.algorithm)
+        data = self._exchange(message)
+        reply = wire.parse(data)
+        if reply.id != msgid:
+            self.close()
+            raise wire.DNSWireError("Reply ID mismatch: %s != %s", reply.id, msgid)
+        if self.key_name:
+            # Unsigned replies are refused too, they could be forged
+            wire.tsig_verify(data, reply, self.key_name, self._secret,
+                             self.algorithm, request_mac=mac)
+        if reply.rcode != wire.RCODE_NOERROR:
+            raise u.DDNSPError("Update of zone %s failed: %s",
+                               zone, wire.rcode_text(reply.rcode),
+                               errno=reply.rcode)
+
+    def _replace_rrs(self, fqdn:str, ip:str, ttl:int) -> t.List[bytes]:
+        """Update RRs replacing the RRset of fqdn by a single address"""
+        rtype, rdata = wire.address_rdata(ip)
+        return [wire.pack_rr(fqdn, rtype, wire.CLASS_ANY, 0),  # Delete RRset
+                wire.pack_rr(fqdn, rtype, wire.CLASS_IN, ttl or self.ttl, rdata)]
+
+    # -------------------------------------------------------------------------
+    def update_ip(self, domain:str, name:str, ip:str, ttl:float=0) -> None:
+        error = self.update_ips_batch(domain=domain, records={name: [ip]}, ttl=ttl)[name]
+        if error:
+            raise error
+        self.log.debug("Updated %s.%s to %s", name, domain, ip)
+
+    def update_ips_batch(self, domain:str, records:dns.Records, ttl:float=0) -> dns.Errors:
+        """Update all records in a single UPDATE message
+
+        RFC 2136 updates are atomic, so if the server rejects the message, and
+        it has more than one record, they are retried one by one so each gets
+        its own result. Connection errors are shared by all records.
+        """
+        rrs: t.List[bytes] = []
+        for name, ips in records.items():
+            for ip in ips:
+                rrs.extend(self._replace_rrs(f'{name}.{domain}', ip, int(ttl)))
+        try:
+            self.send_update(self.zone or domain, rrs)
+        except u.DDNSPError as e:
+            if not (e.errno and len(records) > 1):
+                return dict.fromkeys(records, e)
+            log.warning("Bulk update of %s records failed, retrying one by one: %s",
+                        len(records), e)
+            return super().update_ips_batch(domain=domain, records=records, ttl=ttl)
+        return dict.fromkeys(records)
+
+    def delete_ip(self, domain:str, name:str) -> None:
+        error = self.delete_ips_batch(domain=domain, names=[name])[name]
+        if error:
+            raise error
+
+    def delete_ips_batch(self, domain:str, names:t.Iterable[str]) -> dns.Errors:
+        """Remove address records of all names in a single UPDATE message"""
+        names = list(names)
+        rrs = [wire.pack_rr(f'{name}.{domain}', rtype, wire.CLASS_ANY, 0)
+               for name in names for rtype in (wire.TYPE_A, wire.TYPE_AAAA)]
+        try:
+            self.send_update(self.zone or domain, rrs)
+        except u.DDNSPError as e:
+            return dict.fromkeys(names, e)
+        return dict.fromkeys(names)
@@ -0,0 +1,309 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Built-in authoritative DNS server for the DDNS zone
+
+Answers A, AAAA, SOA and NS queries over UDP and TCP straight from an
+in-memory index of the host table, so no external DNS server or provider
+is needed. The zone is DNS_SUBDOMAIN.DNS_DOMAIN, or DNS_DOMAIN if there is
+no subdomain, and should be delegated to this server by the parent zone.
+Nameservers inside the zone are answered with the addresses in ns_ips, and
+their names, as the hostmaster's, are reserved so no client can register them.
+"""
+
+import asyncio
+import logging
+import socket
+import struct
+import threading
+import time
+import typing as t
+
+import flask
+
+from .. import dao
+from .. import dns
+from .. import util as u
+from .. import wire
+
+
+log = logging.getLogger(__name__)
+
+# {fqdn: {rtype: [rdata, ...]}}
+Index: 't.TypeAlias' = t.Dict[str, t.Dict[int, t.List[bytes]]]
+
+
+class BuiltinAPI(dns.DNSBase):
+    ADDRESS: str   = '0.0.0.0'
+    PORT:    int   = 53
+    TTL:     int   = 60
+    RELOAD:  float = 30
+
+    batch = True
+
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        app: flask.Flask = kw.get('app') or flask.current_app
+        domain    = app.config['DNS_DOMAIN']
+        subdomain = app.config['DNS_SUBDOMAIN']
+        self.origin:  str = f'{subdomain}.{domain}' if subdomain else domain
+        self.origin = self.origin.lower()
+        self.subdomain:   str = subdomain
+        self.address:     str = kw.pop('address', self.config.get("address", self.ADDRESS))
+        self.port:        int = kw.pop('port',    self.config.get("port", self.PORT))
+        self.ttl:         int = kw.pop('ttl',     self.config.get("ttl", app.config['DNS_TTL'] or self.TTL))
+        self.reload:    float = kw.pop('reload',  self.config.get("reload", self.RELOAD))
+        self.nameservers: t.List[str] = kw.pop('ns', self.config.get("ns", [f'ns.{self.origin}']))
+        self.hostmaster:  str = kw.pop('hostmaster', self.config.get("hostmaster", f'hostmaster.{self.origin}'))
+        self.ns_ips: t.List[str] = kw.pop('ns_ips', self.config.get("ns_ips", []))
+        self.reserved = frozenset(self._hostname(name)
+                                  for name in self.nameservers + [self.hostmaster]
+                                  if self._hostname(name))
+        # Address records of nameservers in the zone, kept apart from hosts
+        self.glue: Index = {ns.lower().rstrip('.'): self._glue_rrsets()
+                            for ns in self.nameservers if self._hostname(ns)}
+        if self.glue and not self.ns_ips:
+            log.warning("Nameservers %s are in zone %s, but DNS_BUILTIN_NS_IPS is"
+                        " not set, so their addresses are not served",
+                        ', '.join(self.glue), self.origin)
+        self.serial:      int = int(time.time())
+        self.index: Index = self._glue_index()
+        self._lock = threading.Lock()
+
+        self.loop: t.Optional[asyncio.AbstractEventLoop] = None
+        self._transports: t.List[t.Any] = []
+        self._reloader: t.Optional[u.PeriodicThread] = None
+        self._app: flask.Flask = app
+
+    def start(self) -> None:
+        """Load the index and start serving, in this process only"""
+        app = self._app
+        with app.app_context():
+            self.load()
+        dao.subscribe(self.set_host)
+
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(started,),
+                                        name='ddnsp-dns-server', daemon=True)
+        self._thread.start()
+        started.wait()
+        if not self._transports:
+            raise u.DDNSPError("Could not start DNS server on %s:%s",
+                               self.address, self.port)
+        if self.reload > 0:
+            # Catch changes made by other worker processes
+            def reload():
+                with app.app_context():
+                    self.load()
+            self._reloader = u.PeriodicThread(reload, self.reload, name='ddnsp-dns-reload')
+            self._reloader.start()
+
+    # -------------------------------------------------------------------------
+    # Index
+    def fqdn(self, hostname:str) -> str:
+        return f'{hostname}.{self.origin}'.lower()
+
+    def _hostname(self, fqdn:str) -> str:
+        """Hostname of fqdn if it is a host of the zone, empty otherwise"""
+        name, _, domain = fqdn.lower().rstrip('.').partition('.')
+        return name if domain == self.origin else ''
+
+    def _glue_rrsets(self) -> t.Dict[int, t.List[bytes]]:
+        rrsets: t.Dict[int, t.List[bytes]] = {}
+        for ip in self.ns_ips:
+            rtype, rdata = wire.address_rdata(ip)
+            rrsets.setdefault(rtype, []).append(rdata)
+        return rrsets
+
+    def _glue_index(self) -> Index:
+        return {fqdn: rrsets for fqdn, rrsets in self.glue.items() if rrsets}
+
+    def load(self) -> None:
+        index = self._glue_index()
+        for row in dao.get_ips():
+            if self.fqdn(row['hostname']) in self.glue:
+                continue
+            for ip in (row['ip'], row['ip6']):
+                if ip:
+                    rtype, rdata = wire.address_rdata(ip)
+                    index.setdefault(self.fqdn(row['hostname']), {})[rtype] = [rdata]
+        with self._lock:
+            if index != self.index:
+                self.index = index
+                self._bump_serial()
+        log.debug("Loaded %s hosts in DNS index", len(index))
+
+    def _bump_serial(self) -> None:
+        self.serial = max(self.serial + 1, int(time.time())) & 0xFFFFFFFF
+
+    def set_host(self, hostname:str, ip:t.Optional[str]) -> None:
+        """Update the index in place, or remove the host if ip is None"""
+        self._set_fqdn(self.fqdn(hostname), ip)
+
+    def _set_fqdn(self, fqdn:str, ip:t.Optional[str]) -> None:
+        if fqdn in self.glue:
+            return
+        with self._lock:
+            if ip is None:
+                self.index.pop(fqdn, None)
+            else:
+                rtype, rdata = wire.address_rdata(ip)
+                self.index[fqdn] = {**self.index.get(fqdn, {}), rtype: [rdata]}
+            self._bump_serial()
+
+    # -------------------------------------------------------------------------
+    # DNSBase API
+    def update_ip(self, domain:str, name:str, ip:str, ttl:float=0) -> None:
+        self._set_fqdn(f'{name}.{domain}'.lower(), ip)
+
+    def update_ips_batch(self, domain:str, records:dns.Records, ttl:float=0) -> dns.Errors:
+        for name, ips in records.items():
+            for ip in ips:
+                self._set_fqdn(f'{name}.{domain}'.lower(), ip)
+        return dict.fromkeys(records)
+
+    def delete_ip(self, domain:str, name:str) -> None:
+        self._set_fqdn(f'{name}.{domain}'.lower(), None)
+
+    def get_zone(self, domain:str) -> t.Dict[str, t.List[str]]:
+        suffix = f'.{domain}'.lower()
+        zone: t.Dict[str, t.List[str]] = {}
+        with self._lock:
+            for fqdn, rrsets in self.index.items():
+                name = fqdn[:-len(suffix)] if fqdn.endswith(suffix) else fqdn
+                for rtype, rdatas in rrsets.items():
+                    family = socket.AF_INET6 if rtype == wire.TYPE_AAAA else socket.AF_INET
+                    zone.setdefault(name, []).extend(socket.inet_ntop(family, _)
+                                                     for _ in rdatas)
+        return zone
+
+    # -------------------------------------------------------------------------
+    # Server
+    def _serve(self, started:threading.Event) -> None:
+        asyncio.set_event_loop(self.loop)
+        try:
+            udp, _ = self.loop.run_until_complete(
+                self.loop.create_datagram_endpoint(
+                    lambda: _UDPProtocol(self),
+                    local_addr=(self.address, self.port),
+                    reuse_port=hasattr(socket, 'SO_REUSEPORT'),
+                ))
+            # With port 0, bind TCP to the same port the OS picked for UDP
+            self.port = udp.get_extra_info('sockname')[1]
+            tcp = self.loop.run_until_complete(
+                asyncio.start_server(self._handle_tcp, self.address, self.port,
+                                     reuse_port=hasattr(socket, 'SO_REUSEPORT')))
+            self._transports = [udp, tcp]
+            log.info("DNS server for %s listening on %s:%s",
+                     self.origin, self.address, self.port)
+        except OSError as e:
+            log.error("Could not start DNS server: %s", e)
+            return
+        finally:
+            started.set()
+        self.loop.run_forever()
+
+    async def _handle_tcp(self, reader:asyncio.StreamReader,
+                          writer:asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                size = struct.unpack('!H', await reader.readexactly(2))[0]
+                reply = self.answer(await reader.readexactly(size), tcp=True)
+                if reply:
+                    writer.write(struct.pack('!H', len(reply)) + reply)
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self) -> None:
+        dao.unsubscribe(self.set_host)
+        if self._reloader is not None:
+            self._reloader.stop()
+        if self.loop is None:
+            return
+        for transport in self._transports:
+            self.loop.call_soon_threadsafe(transport.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    # -------------------------------------------------------------------------
+    # Responder
+    def _soa(self) -> bytes:
+        rdata = (wire.encode_name(self.nameservers[0]) +
+                 wire.encode_name(self.hostmaster) +
+                 struct.pack('!IIIII', self.serial, 3600, 600, 86400, self.ttl))
+        return wire.pack_rr(self.origin, wire.TYPE_SOA, wire.CLASS_IN, self.ttl, rdata)
+
+    def _ns(self) -> t.List[bytes]:
+        return [wire.pack_rr(self.origin, wire.TYPE_NS, wire.CLASS_IN, self.ttl,
+                             wire.encode_name(ns))
+                for ns in self.nameservers]
+
+    def answer(self, data:bytes, tcp:bool=False) -> t.Optional[bytes]:
+        """Reply to a query message, or None if it should be ignored"""
+        if len(data) < wire.HEADER.size:
+            return None
+        msgid, flags = struct.unpack_from('!HH', data)
+        if flags & wire.FLAG_QR:
+            return None
+        flags = wire.FLAG_QR | wire.FLAG_AA | (flags & (wire.FLAG_RD | 0x7800))
+        if (flags >> 11) & 0xF != wire.OPCODE_QUERY:
+            return wire.HEADER.pack(msgid, flags | wire.RCODE_NOTIMP, 0, 0, 0, 0)
+        try:
+            qname, offset = wire.decode_name(data, wire.HEADER.size)
+            qtype, qclass = struct.unpack_from('!HH', data, offset)
+        except (wire.DNSWireError, struct.error):
+            return wire.HEADER.pack(msgid, flags | wire.RCODE_FORMERR, 0, 0, 0, 0)
+        question = data[wire.HEADER.size:offset + 4]
+        name = qname.lower()
+
+        answers: t.List[bytes] = []
+        authority: t.List[bytes] = []
+        rcode = wire.RCODE_NOERROR
+        if not (name == self.origin or name.endswith('.' + self.origin)):
+            flags &= ~wire.FLAG_AA
+            rcode = wire.RCODE_REFUSED
+        elif name == self.origin:
+            if qtype in (wire.TYPE_SOA, wire.TYPE_ANY):
+                answers.append(self._soa())
+            if qtype in (wire.TYPE_NS, wire.TYPE_ANY):
+                answers.extend(self._ns())
+            if not answers:
+                authority.append(self._soa())
+        else:
+            rrsets = self.index.get(name)  # the one lookup per packet
+            if rrsets is None:
+                rcode = wire.RCODE_NXDOMAIN
+            else:
+                for rtype, rdatas in rrsets.items():
+                    if qtype in (rtype, wire.TYPE_ANY):
+                        answers.extend(wire.pack_rr(qname, rtype, wire.CLASS_IN,
+                                                    self.ttl, rdata)
+                                       for rdata in rdatas)
+            if not answers:
+                authority.append(self._soa())
+
+        reply = (wire.HEADER.pack(msgid, flags | rcode, 1, len(answers),
+                                  len(authority), 0) +
+                 question + b''.join(answers) + b''.join(authority))
+        if not tcp and len(reply) > 512:
+            reply = wire.HEADER.pack(msgid, flags | wire.FLAG_TC | rcode,
+                                     1, 0, 0, 0) + question
+        return reply
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server:BuiltinAPI):
+        self.server = server
+        self.transport: t.Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data:bytes, addr) -> None:
+        reply = self.server.answer(data)
+        if reply:
+            self.transport.sendto(reply, addr)
@@ -6,10 +6,15 @@ GoDaddy DNS API
 """
 
 import logging
+import random
+import threading
+import time
 import typing as t
 import urllib.parse
 
 import requests
+import requests.adapters
+import urllib3.util
 
 from .. import dns
 from .. import util as u
@@ -17,11 +22,32 @@ from .. import util as u
 log = logging.getLogger(__name__)
 
 
+class DDNSPRequestError(u.DDNSPError, requests.RequestException):
+    """HTTP Request error"""
+
+
+class JitterRetry(urllib3.util.Retry):
+    """Retry with randomized exponential backoff, so clients do not sync up.
+
+    Retry-After from the server, if any, still takes precedence.
+    """
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+
 class GodaddyAPI(dns.DNSBase):
     HOST:    str   = 'https://api.godaddy.com'
     OTE:     str   = 'https://api.ote-godaddy.com'  # OTE, Operational Test Environment
     PATH:    str   = '/v1/domains'
     TIMEOUT: float = 10
+    CONNECT_TIMEOUT: float = 3.05
+    RETRY_STATUS: t.Tuple[int, ...] = (429, 500, 502, 503, 504)
+    RATE:    int   = 60  # API limit, calls per minute
+
+    # No bulk call replaces only some names, so batches are sent one call per
+    # name and type, paced by rate
+    batch = False
 
     def __init__(self, **kw):
         super().__init__(**kw)
@@ -31,6 +57,66 @@ class GodaddyAPI(dns.DNSBase):
         self.ote:      bool = kw.pop('ote',       self.config.get("ote", False))
         self.host:      str = kw.pop('host',      self.config.get("host", self.OTE if self.ote else self.HOST))
         self.path:      str = kw.pop('path',      self.config.get("path", self.PATH))
+        self.pool_size: int = kw.pop('pool_size', self.config.get("pool_size", 10))
+        self.retries:   int = kw.pop('retries',   self.config.get("retries", 3))
+        self.backoff: float = kw.pop('backoff',   self.config.get("backoff", 0.5))
+        self.connect_timeout: float = kw.pop('connect_timeout',
+                                             self.config.get("connect_timeout", self.CONNECT_TIMEOUT))
+        self.read_timeout:    float = kw.pop('read_timeout',
+                                             self.config.get("read_timeout", self.TIMEOUT))
+        self.rate:      int = kw.pop('rate',      self.config.get("rate", self.RATE))
+        self._next_call: float = 0  # theoretical time of the next call, for pacing
+        self._rate_lock = threading.Lock()
+        self.session: requests.Session = self.new_session()
+
+    def start(self) -> None:
+        # Never share pooled connections with the process this was forked from
+        self.session.close()
+        self.session = self.new_session()
+        self._rate_lock = threading.Lock()
+
+    def pace(self) -> None:
+        """Wait until a call keeps within rate calls in any minute
+
+        A full minute of calls may be made at once, then one every 60 / rate
+        seconds, instead of sending bursts the API would reply 429 to.
+        """
+        if self.rate <= 0:
+            return
+        interval = 60 / self.rate
+        with self._rate_lock:
+            now = time.monotonic()
+            scheduled = max(self._next_call, now)
+            at = max(now, scheduled - 60 + interval)
+            self._next_call = scheduled + interval
+        if at > now:
+            log.debug("Waiting %.2fs for GoDaddy API rate limit", at - now)
+            time.sleep(at - now)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def new_session(self) -> requests.Session:
+        """Long-lived session, with keep-alive connection pool and retries"""
+        retry = JitterRetry(
+            total=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=self.RETRY_STATUS,
+            respect_retry_after_header=True,
+            raise_on_status=False,  # let raise_for_status() handle the last one
+        )
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=self.pool_size,
+                                                max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)  # for local test servers
+        session.headers.update({
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+        })
+        session.headers.update(self.auth_headers)
+        return session
 
     @property
     def auth_headers(self) -> dict:
@@ -64,36 +150,33 @@ class GodaddyAPI(dns.DNSBase):
         :param path: URL path to append to <base_url>
         :param query: dict to be encoded as querystring in URL
         :param data: data to be sent as JSON
-        :param timeout: in seconds. 0 for default TIMEOUT, None for no timeout.
+        :param timeout: read timeout in seconds. 0 for default read_timeout,
+            None for no timeout. Connect timeout is always connect_timeout.
         :return: object loaded from JSON response
         """
         method = method.upper()
         url = self.abs_url(path)
 
-        headers: dict = {
-            'Accept': 'application/json',
-            'Content-Type': 'application/json',
-        }
-        headers.update(self.auth_headers)
-
         kwargs: dict = {}
         if query:
-            kwargs['query'] = query
+            kwargs['params'] = query
         if data:
             kwargs['json'] = data
         if timeout is not None:
-            kwargs['timeout'] = timeout or self.TIMEOUT
+            timeout = timeout or self.read_timeout
+        kwargs['timeout'] = (self.connect_timeout, timeout)
 
         log_args = tuple(filter(None, (method, url, query, data)))
         log.debug((len(log_args) * "%s ").strip(), *log_args)
 
+        self.pace()
         try:
-            response = requests.request(method.upper(), url, headers=headers, **kwargs)
+            response = self.session.request(method, url, **kwargs)
             response.raise_for_status()
         except requests.HTTPError as e:
-            raise u.DDNSPRequestError(e.response.text or e,
-                                      errno=e.response.status_code,
-                                      response=e.response)
+            raise DDNSPRequestError(e.response.text or e,
+                                    errno=e.response.status_code,
+                                    response=e.response)
         except requests.RequestException as e:
             raise u.DDNSPError(e)
 
@@ -123,8 +206,34 @@ class GodaddyAPI(dns.DNSBase):
         res = self.get_ips(**locals())
         return res[0] if res else ''
 
-    def update_ip(self, domain:str, name:str, ip:str, ttl:int=0, ipv6=False) -> None:
+    def update_ip(self, domain:str, name:str, ip:str, ttl:int=0, ipv6=None) -> None:
+        if ipv6 is None:
+            ipv6 = dns.is_ipv6(ip)
         args = locals().copy()
         args['ips'] = [ip]
         del args['ip'], args['self']
         self.update_ips(**args)
+
+    def get_records(self, domain:str, ipv6=False) -> t.List[u.JsonDict]:
+        rt = 'AAAA' if ipv6 else 'A'
+        return self.request('GET', '{domain}/records/{rt}'.format(**locals()))
+
+    def get_address_records(self, domain:str) -> t.List[u.JsonDict]:
+        """A and AAAA records of domain, in a single call"""
+        return [rec for rec in self.request('GET', f'{domain}/records')
+                if rec.get('type') in ('A', 'AAAA')]
+
+    def get_zone(self, domain:str) -> t.Dict[str, t.List[str]]:
+        zone: t.Dict[str, t.List[str]] = {}
+        for rec in self.get_address_records(domain):
+            zone.setdefault(rec['name'], []).append(rec['data'])
+        return zone
+
+    def delete_ip(self, domain:str, name:str, ipv6=None) -> None:
+        """Remove the A or AAAA records of name, or both if ipv6 is None"""
+        for rt in ('A', 'AAAA') if ipv6 is None else ('AAAA' if ipv6 else 'A',):
+            try:
+                self.request('DELETE', '{domain}/records/{rt}/{name}'.format(**locals()))
+            except DDNSPRequestError as e:
+                if e.errno != 404:  # already gone
+                    raise
@@ -0,0 +1,54 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Null DNS API, for development and benchmarks: records are kept in memory only
+"""
+
+import time
+import typing as t
+
+from .. import dns
+
+
+class NullAPI(dns.DNSBase):
+    batch = True
+
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        # Simulated latency per API call, in seconds
+        self.delay: float = kw.pop('delay', self.config.get("delay", 0))
+        self.zone: t.Dict[str, t.List[str]] = {}
+        self.calls: int = 0
+
+    def _call(self) -> None:
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+
+    def _set(self, name:str, ip:str) -> None:
+        current = self.zone.get(name, [])
+        self.zone[name] = [addr for addr in current if dns.is_ipv6(addr) != dns.is_ipv6(ip)] + [ip]
+
+    def update_ip(self, domain:str, name:str, ip:str, ttl:float=0) -> None:
+        self._call()
+        self._set(name, ip)
+
+    def update_ips_batch(self, domain:str, records:dns.Records, ttl:float=0) -> dns.Errors:
+        self._call()
+        for name, ips in records.items():
+            for ip in ips:
+                self._set(name, ip)
+        return dict.fromkeys(records)
+
+    def delete_ip(self, domain:str, name:str) -> None:
+        self._call()
+        self.zone.pop(name, None)
+
+    def get_zone(self, domain:str) -> t.Dict[str, t.List[str]]:
+        self._call()
+        return dict(self.zone)
+
+    def get_ips(self, domain:str, name:str, ipv6=False) -> t.List[str]:
+        self._call()
+        return [addr for addr in self.zone.get(name, []) if dns.is_ipv6(addr) == ipv6]
@@ -0,0 +1,266 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Command-line tools, as flask commands
+
+    flask --app ddnsp hosts export hosts.csv
+    flask --app ddnsp hosts import hosts.csv
+    flask --app ddnsp hosts import --format jsonl --no-dns - < hosts.jsonl
+    flask --app ddnsp hash calibrate --target-ms 50
+
+Host files are CSV, with a header line, or JSON Lines, with the columns
+hostname, username, password, ip, ip6 and changed. Passwords may be plain
+text or Argon2 hashes, as exported. Only hostname, username and password
+are required.
+"""
+
+import contextlib
+import csv
+import json
+import logging
+import sys
+import time
+import typing as t
+
+import click
+import flask
+import flask.cli
+
+from . import dao
+from . import hasher
+from . import methods
+from . import outbox
+from . import util as u
+
+
+log = logging.getLogger(__name__)
+
+FIELDS = ('hostname', 'username', 'password', 'ip', 'ip6', 'changed')
+FORMATS = ('csv', 'jsonl')
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'  # as SQLite's CURRENT_TIMESTAMP
+
+hosts_cli = flask.cli.AppGroup('hosts', help="Bulk import and export of hosts.")
+hash_cli = flask.cli.AppGroup('hash', help="Password hashing tools.")
+
+
+def init_app(app:flask.Flask) -> None:
+    app.cli.add_command(hosts_cli)
+    app.cli.add_command(hash_cli)
+
+
+def file_format(path:str, fmt:t.Optional[str]) -> str:
+    """Explicit format, or guessed from the file extension"""
+    if fmt:
+        return fmt
+    if path.endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    return 'csv'
+
+
+def open_file(path:str, mode:str='r') -> t.ContextManager[t.TextIO]:
+    if path == '-':
+        return contextlib.nullcontext(sys.stdout if 'w' in mode else sys.stdin)
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def read_hosts(file:t.TextIO, fmt:str) -> t.Iterator[t.Tuple[int, dict]]:
+    """(line number, record) of each host in file"""
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        missing = set(FIELDS[:3]) - set(reader.fieldnames or ())
+        if missing:
+            raise click.ClickException(f"Missing CSV columns: {', '.join(sorted(missing))}")
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for lineno, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            record = {'error': f"invalid JSON: {e}"}
+        yield lineno, record if isinstance(record, dict) else {'error': "not an object"}
+
+
+def check_host(config:flask.Config, record:dict) -> dao.HostData:
+    """Validated host, with password either plain or an Argon2 hash
+
+    Hostname and username follow the same rules as update requests.
+    """
+    if 'error' in record:
+        raise u.DDNSPError(record['error'])
+
+    def get(key):
+        return str(record.get(key) or '').strip()
+
+    hostname = get('hostname').split('.', 1)[0]
+    username = get('username')
+    password = get('password')
+    changed  = get('changed') or None
+
+    if not (0 < len(hostname) <= config['HOSTNAME_MAX_LENGTH'] and
+            methods.HOSTNAME_RE.fullmatch(hostname)):
+        raise u.DDNSPError("invalid hostname: %r", hostname)
+    if not (0 < len(username) <= config['USERNAME_MAX_LENGTH'] and
+            methods.USERNAME_RE.fullmatch(username)):
+        raise u.DDNSPError("invalid username: %r", username)
+    if not (hasher.is_hash(password) or
+            config['PASSWORD_MIN_LENGTH'] <= len(password) <= config['PASSWORD_MAX_LENGTH']):
+        raise u.DDNSPError("invalid password length: %s", len(password))
+    ip, ip6 = None, None
+    ips = ','.join(filter(None, (get('ip'), get('ip6'))))
+    if ips:
+        ip, ip6 = u.parse_ips(ips)
+        if not (ip or ip6):
+            raise u.DDNSPError("invalid IP: %r", ips)
+    if changed is not None:
+        try:
+            time.strptime(changed, TIMESTAMP_FORMAT)
+        except ValueError:
+            raise u.DDNSPError("invalid changed timestamp: %r", changed)
+    return dict(hostname=hostname, username=username, password=password,
+                ip=ip, ip6=ip6, changed=changed)
+
+
+class Importer:
+    """Insert hosts in chunks, each hashed in parallel and written in one transaction
+
+    DNS changes are queued in the outbox along with the hosts, as in
+    registrations, or without it sent right away in batched backend calls.
+    """
+    def __init__(self, chunk_size:int, jobs:int, dns:bool):
+        self.chunk_size: int = chunk_size
+        self.jobs: int = jobs or hasher.max_workers(flask.current_app.config)
+        self.dns: bool = dns
+        self.outbox: bool = dns and outbox.enabled()
+        self.chunk: t.List[dao.HostData] = []
+        self.seen: t.Set[str] = set()
+        self.stats: t.Dict[str, int] = dict.fromkeys(
+            ('read', 'added', 'existing', 'invalid', 'hashed', 'dnserr'), 0)
+        self.start: float = time.perf_counter()
+
+    def add(self, lineno:int, record:dict) -> None:
+        self.stats['read'] += 1
+        try:
+            host = check_host(flask.current_app.config, record)
+            if host['hostname'] in self.seen:
+                raise u.DDNSPError("duplicate hostname: %s", host['hostname'])
+        except u.DDNSPError as e:
+            self.stats['invalid'] += 1
+            log.warning("Skipping line %s: %s", lineno, e)
+            return
+        self.seen.add(host['hostname'])
+        self.chunk.append(host)
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        hosts, self.chunk = self.chunk, []
+        if not hosts:
+            return
+        # Hosts of the same user and password share a hash, as in registrations
+        plain = list({(host['username'], host['password']) for host in hosts
+                      if not hasher.is_hash(host['password'])})
+        hashes = dict(zip(plain, hasher.hash_passwords([pw for _, pw in plain], self.jobs)))
+        for host in hosts:
+            host['password'] = hashes.get((host['username'], host['password']),
+                                          host['password'])
+        self.stats['hashed'] += len(plain)
+
+        added = set(dao.import_hosts(hosts, outbox=self.outbox))
+        self.stats['added'] += len(added)
+        self.stats['existing'] += len(hosts) - len(added)
+        if self.dns and not self.outbox:
+            self.update_dns([host for host in hosts if host['hostname'] in added])
+        self.progress()
+
+    def update_dns(self, hosts:t.List[dao.HostData]) -> None:
+        records = {host['hostname']: [ip for ip in (host['ip'], host['ip6']) if ip]
+                   for host in hosts if host['ip'] or host['ip6']}
+        if not records:
+            return
+        for hostname, error in methods.update_dns(records).items():
+            if error is None:
+                continue
+            # As in registrations, so the next update from its client retries
+            log.error("Failed updating DNS for %s: %s", hostname, error)
+            dao.update_ip(hostname, None, None)
+            self.stats['dnserr'] += 1
+
+    def progress(self) -> None:
+        elapsed = time.perf_counter() - self.start
+        click.echo(", ".join(f"{key}={value}" for key, value in self.stats.items()) +
+                   f", {self.stats['read'] / elapsed:.0f} hosts/s", err=True)
+
+
+@hosts_cli.command('import')
+@click.argument('path', metavar='FILE', default='-')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS),
+              help="File format. Default from FILE extension, or csv.")
+@click.option('--chunk-size', type=click.IntRange(1), default=1000, show_default=True,
+              help="Hosts inserted per transaction.")
+@click.option('--jobs', '-j', type=click.IntRange(0), default=0,
+              help="Parallel Argon2 hashes of plain passwords."
+                   "  [default: from HASH_WORKERS and HASH_MEMORY_BUDGET]")
+@click.option('--dns/--no-dns', default=True, show_default=True,
+              help="Update the DNS records of the hosts with an IP.")
+def import_hosts(path:str, fmt:t.Optional[str], chunk_size:int, jobs:int, dns:bool) -> None:
+    """Import hosts from FILE, or stdin, skipping already registered ones."""
+    importer = Importer(chunk_size=chunk_size, jobs=jobs, dns=dns)
+    with open_file(path) as file:
+        for lineno, record in read_hosts(file, file_format(path, fmt)):
+            importer.add(lineno, record)
+    importer.flush()
+    if importer.outbox and importer.stats['added']:
+        click.echo("DNS changes queued in the outbox, sent by the server", err=True)
+    importer.progress()
+
+
+@hosts_cli.command('export')
+@click.argument('path', metavar='FILE', default='-')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS),
+              help="File format. Default from FILE extension, or csv.")
+def export_hosts(path:str, fmt:t.Optional[str]) -> None:
+    """Export all hosts, with hashed passwords, to FILE or stdout."""
+    fmt = file_format(path, fmt)
+    count = 0
+    with open_file(path, 'w') as file:
+        writer = csv.DictWriter(file, FIELDS) if fmt == 'csv' else None
+        if writer is not None:
+            writer.writeheader()
+        for row in dao.export_hosts():
+            record = {key: row[key] for key in FIELDS}
+            if record['changed'] is not None:
+                record['changed'] = str(record['changed'])
+            if writer is not None:
+                writer.writerow(record)
+            else:
+                file.write(json.dumps(record) + '\n')
+            count += 1
+    click.echo(f"Exported {count} hosts", err=True)
+
+
+@hash_cli.command('calibrate')
+@click.option('--target-ms', type=click.FloatRange(min=1), default=50, show_default=True,
+              help="Target time of a password verify, in milliseconds.")
+@click.option('--max-memory', type=click.IntRange(8), default=None,
+              help="Max memory per hash, in KiB.  [default: HASH_CALIBRATE_MEMORY]")
+@click.option('--parallelism', '-p', type=click.IntRange(0), default=0,
+              help="Threads per hash.  [default: CPU count, up to 4]")
+def calibrate(target_ms:float, max_memory:t.Optional[int], parallelism:int) -> None:
+    """Pick Argon2 parameters for a target verify time on this machine.
+
+    Prints them as config file lines, and how many hashes fit HASH_MEMORY_BUDGET.
+    """
+    config = flask.current_app.config
+    if max_memory is None:
+        max_memory = config['HASH_CALIBRATE_MEMORY']
+    params, seconds = hasher.calibrate(target_ms / 1000, max_memory, parallelism)
+    for key, value in params.items():
+        click.echo(f"ARGON2_{key.upper():11} = {value}")
+    budget = config['HASH_MEMORY_BUDGET'] * 1024
+    workers = f", {budget // params['memory_cost']} concurrent within the memory budget" \
+        if budget else ""
+    click.echo(f"# {1000 * seconds:.1f}ms per verify{workers}", err=True)
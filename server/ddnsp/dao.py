@@ -2,104 +2,358 @@
 # Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
 # License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
 """
-Data Access Objects
+Data Access Objects, and storage engine selector
+
+The functions here are the storage interface used by the rest of the app.
+They delegate to the engine selected by STORAGE_ENGINE, and take care of
+what is common to all engines: password cache, listeners and logging.
 """
 
-import contextlib
+import importlib
 import logging
-import os
-import sqlite3
 import typing as t
 
 import flask
 
+from . import hasher
+from . import metrics
 from . import util as u
 
 log = logging.getLogger(__name__)
 
-Row: 't.TypeAlias' = sqlite3.Row
-R = t.TypeVar('R', bound=t.Union[Row, t.Dict[str, t.Any]])  # "Row-like"
+# {name: 'module:Class'}, relative to this package, as in dns.BACKENDS
+ENGINES: t.Dict[str, str] = {
+    'memory': '.engines.memory:MemoryEngine',
+    'sqlite': '.engines.sqlite:SQLiteEngine',
+}
+
+# Host and outbox records. sqlite3.Row, or anything else that can be read
+# by column name with row['column']
+Row: 't.TypeAlias' = t.Any
+
+# {hostname: (ip, ip6)}
+NewHosts: 't.TypeAlias' = t.Dict[str, t.Tuple[t.Optional[str], t.Optional[str]]]
+# {hostname, username, password, ip, ip6, changed}, changed may be None for now
+HostData: 't.TypeAlias' = t.Dict[str, t.Optional[str]]
+# {hostname: (ip, ip6, password)}
+HostChanges: 't.TypeAlias' = t.Dict[str, t.Tuple[t.Optional[str], t.Optional[str],
+                                                 t.Optional[str]]]
+
+engine: t.Optional['StorageBase'] = None
+
+# Called with (hostname, ip) after a host IP change is committed, once for each
+# changed address, IPv4 or IPv6. ip is None for deleted hosts. See subscribe()
+_listeners: t.List[t.Callable[[str, t.Optional[str]], None]] = []
+
+
+class StorageBase:
+    """Storage engine interface
+
+    Engines only store and fetch, the module functions wrapping them do the
+    rest. Timestamps are UTC strings in SQLite's CURRENT_TIMESTAMP format.
+    """
+    def __init__(self, app:flask.Flask):
+        self.app: flask.Flask = app
+        self.config: dict = app.config.get_namespace(f'{self.engine.upper()}_')
+        app.logger.info("Using storage engine: %s: %s.%s",
+                        self.engine,
+                        self.__class__.__module__,
+                        self.__class__.__name__)
+
+    @u.classproperty
+    def engine(self) -> str:
+        return self.__module__.split('.')[-1]
+
+    def start(self) -> None:
+        """Start threads and other per-process resources
+
+        Called in each worker process, after fork if the app was preloaded.
+        """
+
+    def after_fork(self) -> None:
+        """Drop state inherited from the parent process, in a forked child"""
+
+    def close(self) -> None:
+        pass
+
+    def flush(self) -> None:
+        """Write any buffered timestamps"""
+
+    def get_host(self, hostname:str) -> t.Optional[Row]:
+        return self.get_hosts([hostname]).get(hostname)
+
+    def get_hosts(self, hostnames:t.Collection[str]) -> t.Dict[str, Row]:
+        raise NotImplementedError
+
+    def get_ips(self) -> t.List[Row]:
+        raise NotImplementedError
 
+    def add_hosts(self, username, password, hosts:NewHosts, outbox=False) -> t.List[str]:
+        raise NotImplementedError
 
-def create_db():
-    app: flask.Flask = flask.current_app
-    with app.open_resource('schema.sql', 'rt') as f:
-        get_db().executescript(f.read())
-    app.logger.info("Database Created")
+    def import_hosts(self, hosts:t.List[HostData], outbox=False) -> t.List[str]:
+        raise NotImplementedError
+
+    def export_hosts(self) -> t.Iterable[Row]:
+        raise NotImplementedError
+
+    def update_hosts(self, changes:HostChanges, outbox=False) -> None:
+        """Write changes, all of them having at least one value set"""
+        raise NotImplementedError
+
+    def update_timestamp(self, hostname:str) -> None:
+        raise NotImplementedError
+
+    def update_password(self, hostname, password) -> None:
+        raise NotImplementedError
+
+    def replace_password(self, hostnames:t.Collection[str], old:str, new:str) -> t.List[str]:
+        raise NotImplementedError
+
+    def update_ip(self, hostname, ip, ip6=None) -> None:
+        raise NotImplementedError
+
+    def delete_host(self, hostname, outbox=False) -> None:
+        raise NotImplementedError
+
+    def expire_hosts(self, before:str, limit:int, outbox=False) -> t.List[str]:
+        raise NotImplementedError
+
+    def claim_outbox(self, limit:int, lease:float) -> t.List[Row]:
+        raise NotImplementedError
+
+    def done_outbox(self, hostname, version) -> None:
+        raise NotImplementedError
+
+    def retry_outbox(self, hostname, version, error, delay:float) -> None:
+        raise NotImplementedError
+
+    def outbox_status(self) -> Row:
+        """depth, failing, oldest and max_attempts of the outbox"""
+        raise NotImplementedError
+
+
+def get_engine(name:str) -> t.Type[StorageBase]:
+    """Import and return the class of engine, from the ENGINES registry"""
+    try:
+        modname, clsname = ENGINES[name].split(':')
+    except KeyError:
+        raise u.DDNSPError("Storage engine not found: %s, choose from %s",
+                           name, ', '.join(ENGINES))
+    return getattr(importlib.import_module(modname, __package__), clsname)
 
 
 def init_app(app: flask.Flask) -> None:
-    app.teardown_appcontext(close_db)
-    app.logger.info("Using database: %s", app.config['DATABASE'])
-    if not os.path.exists(app.config['DATABASE']):
-        with app.app_context():
-            create_db()
+    global engine
+    if engine is not None:
+        engine.close()
+    engine = get_engine(app.config['STORAGE_ENGINE'])(app)
 
 
-def get_db() -> sqlite3.Connection:
-    if 'db' not in flask.g:
-        flask.g.db = sqlite3.connect(
-            flask.current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES,
-        )
-    flask.g.db.row_factory = sqlite3.Row
-    return flask.g.db
+def start(app: flask.Flask) -> None:
+    """Start the storage engine threads of this process"""
+    engine.start()
 
 
-def close_db(_e=None) -> None:
-    db = flask.g.pop('db', None)
-    if db is not None:
-        db.close()
+def after_fork() -> None:
+    """Drop state inherited from the parent process, in a forked child"""
+    if engine is not None:
+        engine.after_fork()
 
 
-# -----------------------------------------------------------------------------
-def execute(query, args) -> t.Optional[int]:
-    """Execute an INSERT, UPDATE or DELETE, return inserted or updated row ID"""
-    # using conn's context manager for auto-commit
-    log.debug("Executing SQL: %r, %s", query, args)
-    with get_db() as conn, contextlib.closing(conn.execute(query, args)) as cur:
-        return cur.lastrowid
+def flush() -> None:
+    """Write buffered timestamps, if any"""
+    engine.flush()
 
 
-def fetch(query, args=()) -> t.List[Row]:
-    log.debug("Fetching  SQL: %r, %s", query, args)
-    with contextlib.closing(get_db().execute(query, args)) as cur:
-        return cur.fetchall()
+def subscribe(listener:t.Callable[[str, t.Optional[str]], None]) -> None:
+    """Register a function to be called after each committed IP change"""
+    if listener not in _listeners:
+        _listeners.append(listener)
 
 
-def fetchone(query, args=()) -> t.Optional[Row]:
-    rv = fetch(query, args)
-    return rv[0] if rv else None
+def unsubscribe(listener:t.Callable[[str, t.Optional[str]], None]) -> None:
+    if listener in _listeners:
+        _listeners.remove(listener)
 
 
-def _sql_insert(table:str, data: R) -> t.Tuple[str, R]:
-    keylist = ', :'.join(data.keys())
-    return (f"INSERT INTO {table} ({keylist.replace(':', '')})"
-            f" VALUES (:{keylist})",
-            data)
+def _notify(hostname:str, ip:t.Optional[str]) -> None:
+    for listener in _listeners:
+        try:
+            listener(hostname, ip)
+        except Exception as e:
+            log.exception("Error in IP change listener %r: %s", listener, e)
 
 
 # -----------------------------------------------------------------------------
+@metrics.timed('sqlite')
 def update_timestamp(hostname:str) -> None:
-    execute('UPDATE host'
-            ' SET changed = CURRENT_TIMESTAMP'
-            ' WHERE hostname = ?', [hostname])
+    engine.update_timestamp(hostname)
 
 
+@metrics.timed('sqlite')
 def get_host(hostname:str) -> t.Optional[Row]:
-    return fetchone('SELECT * FROM host WHERE hostname = ?', [hostname])
+    return engine.get_host(hostname)
+
+
+@metrics.timed('sqlite')
+def get_hosts(hostnames:t.Collection[str]) -> t.Dict[str, Row]:
+    """{hostname: row} of hostnames, in a single query. Unknown ones are omitted"""
+    return engine.get_hosts(hostnames)
 
 
-def add_host(username, password, hostname, ip) -> None:
-    execute(*_sql_insert('host', locals()))
-    log.info("Registered new account: %s", u.obfuscate(locals()))
+@metrics.timed('sqlite')
+def get_ips() -> t.List[Row]:
+    """Hostname, IPv4 and IPv6 of all hosts"""
+    return engine.get_ips()
 
 
+def add_host(username, password, hostname, ip, outbox=False, ip6=None) -> bool:
+    """Insert a new host, return False if hostname is already registered
+
+    If outbox, also queue its DNS change in the same transaction.
+    """
+    return bool(add_hosts(username, password, {hostname: (ip, ip6)}, outbox=outbox))
+
+
+@metrics.timed('sqlite')
+def add_hosts(username, password, hosts:NewHosts, outbox=False) -> t.List[str]:
+    """Insert new {hostname: (ip, ip6)} hosts in a single transaction
+
+    Return the hostnames inserted, skipping the ones already registered.
+    If outbox, also queue their DNS changes in the same transaction.
+    """
+    added = engine.add_hosts(username, password, hosts, outbox=outbox)
+    for hostname in added:
+        ip, ip6 = hosts[hostname]
+        log.info("Registered new account: %s", u.obfuscate(dict(
+            username=username, password=password, hostname=hostname, ip=ip, ip6=ip6)))
+        for address in (ip, ip6):
+            if address:
+                _notify(hostname, address)
+    return added
+
+
+@metrics.timed('sqlite')
+def import_hosts(hosts:t.List[HostData], outbox=False) -> t.List[str]:
+    """Insert hosts with already hashed passwords, in a single transaction
+
+    For bulk imports. Return the hostnames inserted, skipping the ones
+    already registered. If outbox, also queue the DNS changes of the ones
+    with an IP.
+    """
+    added = engine.import_hosts(hosts, outbox=outbox)
+    for host in hosts:
+        if host['hostname'] not in added:
+            continue
+        for address in (host['ip'], host['ip6']):
+            if address:
+                _notify(host['hostname'], address)
+    return added
+
+
+def export_hosts() -> t.Iterable[Row]:
+    """All hosts, with hashed passwords, ordered by hostname"""
+    return engine.export_hosts()
+
+
+def update_host(hostname, ip=None, password=None, outbox=False, ip6=None) -> None:
+    """Update IPs and/or password, along with timestamp, in a single transaction
+
+    If outbox and an IP is set, also queue the DNS change.
+    """
+    update_hosts({hostname: (ip, ip6, password)}, outbox=outbox)
+
+
+@metrics.timed('sqlite')
+def update_hosts(changes:HostChanges, outbox=False) -> None:
+    """Update {hostname: (ip, ip6, password)}, with timestamps, in a single transaction
+
+    None keeps the current value. Hosts with none only have their timestamp
+    updated. If outbox, also queue the DNS changes of hosts with a new IP.
+    """
+    writes = {hostname: change for hostname, change in changes.items() if any(change)}
+    for hostname in changes:
+        if hostname not in writes:
+            engine.update_timestamp(hostname)
+    if not writes:
+        return
+    engine.update_hosts(writes, outbox=outbox)
+    for hostname, (ip, ip6, password) in writes.items():
+        if password is not None:
+            hasher.forget(hostname)
+        for address in (ip, ip6):
+            if address is not None:
+                _notify(hostname, address)
+
+
+@metrics.timed('sqlite')
 def update_password(hostname, password) -> None:
-    execute('UPDATE host SET password = :password WHERE hostname = :hostname',
-            locals())
+    engine.update_password(hostname, password)
+    hasher.forget(hostname)
+
+
+@metrics.timed('sqlite')
+def replace_password(hostnames:t.Collection[str], old:str, new:str) -> t.List[str]:
+    """Set password to new on the hostnames whose password is still old
+
+    Return the hostnames updated, skipping the ones changed meanwhile.
+    """
+    done = engine.replace_password(hostnames, old, new)
+    for hostname in done:
+        hasher.forget(hostname)
+    return done
+
+
+@metrics.timed('sqlite')
+def delete_host(hostname, outbox=False) -> None:
+    engine.delete_host(hostname, outbox=outbox)
+    hasher.forget(hostname)
+    _notify(hostname, None)
+
+
+@metrics.timed('sqlite')
+def expire_hosts(before:str, limit:int, outbox=False) -> t.List[str]:
+    """Delete up to limit hosts not seen since before, oldest first
+
+    Each call is a short write, so updates are never blocked for long.
+    If outbox, also queue the removal of their DNS records.
+    """
+    hostnames = engine.expire_hosts(before, limit, outbox=outbox)
+    for hostname in hostnames:
+        hasher.forget(hostname)
+        _notify(hostname, None)
+    return hostnames
+
+
+@metrics.timed('sqlite')
+def update_ip(hostname, ip, ip6=None) -> None:
+    """Set both IPv4 and IPv6, None clearing them"""
+    engine.update_ip(hostname, ip, ip6)
+    for address in (ip, ip6):
+        if address is not None:
+            _notify(hostname, address)
+
+
+# -----------------------------------------------------------------------------
+# DNS outbox
+@metrics.timed('sqlite')
+def claim_outbox(limit:int, lease:float) -> t.List[Row]:
+    """Fetch due changes, postponing them by lease seconds so no one else does"""
+    return engine.claim_outbox(limit, lease)
+
+
+@metrics.timed('sqlite')
+def done_outbox(hostname, version) -> None:
+    """Remove a sent change, unless a newer one was queued meanwhile"""
+    engine.done_outbox(hostname, version)
+
+
+@metrics.timed('sqlite')
+def retry_outbox(hostname, version, error, delay:float) -> None:
+    engine.retry_outbox(hostname, version, error, delay)
 
 
-def update_ip(hostname, ip) -> None:
-    execute('UPDATE host SET ip = :ip WHERE hostname = :hostname',
-            locals())
+@metrics.timed('sqlite')
+def outbox_status() -> Row:
+    return engine.outbox_status()
@@ -5,23 +5,46 @@
 DNS base and backend selector
 """
 
+import concurrent.futures
 import importlib
 import logging
-import pkgutil
+import threading
+import time
 import typing as t
 
 import flask
 
+from . import metrics
 from . import util as u
 
 
 log = logging.getLogger(__name__)
 
-_backends: t.Dict[str,'DNSBase'] = {}
+# {name: 'module:Class'}, relative to this package. Only the selected backend
+# module, and its dependencies such as requests, is ever imported.
+BACKENDS: t.Dict[str, str] = {
+    'bind9':   '.backends.bind9:Bind9API',
+    'builtin': '.backends.builtin:BuiltinAPI',
+    'godaddy': '.backends.godaddy:GodaddyAPI',
+    'null':    '.backends.null:NullAPI',
+}
+
 api:       t.Optional['DNSBase'] = None
+batcher:   t.Optional['Batcher'] = None
+snapshot:  t.Optional['Snapshot'] = None
+
+Errors:  't.TypeAlias' = t.Dict[str, t.Optional[u.DDNSPError]]
+# {name: [ip, ...]}, at most one IPv4 and one IPv6, each replacing the
+# records of its type. Types not listed are left alone.
+Records: 't.TypeAlias' = t.Dict[str, t.List[str]]
 
 
 class DNSBase:
+    # Backend can update many records in fewer API calls than one per record
+    batch: bool = False
+    # Names used by the backend itself, which clients may not register
+    reserved: t.FrozenSet[str] = frozenset()
+
     def __init__(self, **kwargs):
         app: flask.Flask = kwargs.pop('app', None) or flask.current_app
         self.config: dict = app.config.get_namespace(f'DNS_{self.backend.upper()}_')
@@ -36,39 +59,208 @@ class DNSBase:
     def backend(self) -> str:
         return self.__module__.split('.')[-1]
 
+    def start(self) -> None:
+        """Start threads, sockets and other per-process resources
+
+        Called in each worker process, after fork if the app was preloaded.
+        """
+
+    def close(self) -> None:
+        pass
+
     def update_ip(self, domain:str, name:str, ip:str, ttl:float=0) -> None:
+        """Replace the A or AAAA records of name, depending on ip family"""
         raise NotImplementedError
 
+    def delete_ip(self, domain:str, name:str) -> None:
+        """Remove all address records of name"""
+        raise NotImplementedError
+
+    def delete_ips_batch(self, domain:str, names:t.Iterable[str]) -> Errors:
+        """Remove address records of names, returning the error, if any, for each"""
+        errors: Errors = {}
+        for name in names:
+            try:
+                self.delete_ip(domain=domain, name=name)
+                errors[name] = None
+            except u.DDNSPError as e:
+                errors[name] = e
+        return errors
+
+    def get_zone(self, domain:str) -> t.Dict[str, t.List[str]]:
+        """All address records of domain, as {name: [ip, ...]}, in one call"""
+        raise NotImplementedError
+
+    def get_ips(self, domain:str, name:str, ipv6=False) -> t.List[str]:
+        """Current A, or AAAA if ipv6, records of name"""
+        raise NotImplementedError
+
+    def update_ips_batch(self, domain:str, records:Records, ttl:float=0) -> Errors:
+        """Update records, returning the error, if any, for each name
+
+        Backends capable of bulk updates should override this and set batch.
+        """
+        errors: Errors = {}
+        for name, ips in records.items():
+            try:
+                for ip in ips:
+                    self.update_ip(domain=domain, name=name, ip=ip, ttl=ttl)
+                errors[name] = None
+            except u.DDNSPError as e:
+                errors[name] = e
+        return errors
+
+
+class Snapshot:
+    """Cached copy of the zone records, to skip writes the provider already has
+
+    Loaded in a single listing call, reloaded every ttl seconds, and kept
+    current after each successful write. Other workers, or edits by hand, may
+    have changed a record since, so a write is only skipped once a lookup of
+    the name confirms it: a stale copy costs a write, never skips a needed one.
+    A single thread lists the zone at a time, others use the current copy
+    meanwhile, and a failed listing is only retried after BACKOFF seconds.
+    """
+    BACKOFF: float = 30
+
+    def __init__(self, ttl:float):
+        self.ttl:     float                   = ttl
+        self.records: t.Dict[str, t.List[str]] = {}
+        self.expires: float                   = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def _refresh(self, domain:str) -> None:
+        if time.monotonic() < self.expires:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() < self.expires:
+                return
+            try:
+                records = get_api().get_zone(domain)
+            except u.DDNSPError:
+                self.expires = time.monotonic() + min(self.ttl, self.BACKOFF)
+                raise
+            with self._lock:
+                self.records = records
+                self.expires = time.monotonic() + self.ttl
+        finally:
+            self._refresh_lock.release()
+        log.debug("Loaded zone snapshot for %s: %s records", domain, len(records))
+
+    def has(self, domain:str, name:str, ip:str) -> bool:
+        """Whether ip is the only record of its type for name, as confirmed by a lookup"""
+        self._refresh(domain)
+        with self._lock:
+            if same_family(self.records.get(name, []), ip) != [ip]:
+                return False
+        return get_api().get_ips(domain=domain, name=name, ipv6=is_ipv6(ip)) == [ip]
+
+    def set(self, name:str, ip:t.Optional[str]) -> None:
+        """Record a successful write, or forget name if ip is None"""
+        with self._lock:
+            if ip is None:
+                self.records.pop(name, None)
+            else:
+                self.records[name] = [addr for addr in self.records.get(name, [])
+                                      if is_ipv6(addr) != is_ipv6(ip)] + [ip]
+
+
+class Batcher:
+    """Gather updates from concurrent requests and send them in bulk
+
+    The first pending update starts a window of up to window seconds, or until
+    size hosts are pending, then all are sent together and each caller gets
+    the result for its own host. Repeated updates for a host keep the latest
+    IP of each family.
+    """
+    def __init__(self, app:flask.Flask, window:float, size:int):
+        self.app:    flask.Flask = app
+        self.window: float       = window
+        self.size:   int         = size
+        self._pending: t.Dict[str, t.Tuple[t.List[str], t.List[concurrent.futures.Future]]] = {}
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='ddnsp-dns-batch',
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, hostname:str, ips:t.List[str]) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        with self._cond:
+            pending, futures = self._pending.get(hostname, ([], []))
+            futures.append(future)
+            merged = {is_ipv6(ip): ip for ip in pending + ips}
+            self._pending[hostname] = (list(merged.values()), futures)
+            self._cond.notify()
+        return future
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                pending, self._pending = self._pending, {}
+            try:
+                with self.app.app_context():
+                    errors = update_ips({host: ips for host, (ips, _) in pending.items()})
+            except Exception as e:
+                log.exception("Error in DNS batch: %s", e)
+                errors = dict.fromkeys(pending, u.DDNSPError(e))
+            for hostname, (_, futures) in pending.items():
+                for future in futures:
+                    future.set_result(errors.get(hostname))
+
+
+def get_backend(backend:str) -> t.Type[DNSBase]:
+    """Import and return the class of backend, from the BACKENDS registry"""
+    try:
+        modname, clsname = BACKENDS[backend].split(':')
+    except KeyError:
+        raise u.DDNSPError("DNS backend not found: %s, choose from %s",
+                           backend, ', '.join(BACKENDS))
+    return getattr(importlib.import_module(modname, __package__), clsname)
+
 
 def init_app(app:flask.Flask=None, backend:str="") -> DNSBase:
-    global _backends
     global api
+    global batcher
+    global snapshot
 
     if app is None:
         app = flask.current_app
 
     if not backend:
         backend = app.config['DNS_BACKEND']
-    try:
-        return _backends[backend]
-    except KeyError:
-        pass
+    if api is not None:
+        api.close()
+    api = get_backend(backend)(app=app)
+    snapshot = None
+    if app.config['DNS_SNAPSHOT_TTL'] > 0:
+        snapshot = Snapshot(app.config['DNS_SNAPSHOT_TTL'])
+    batcher = None
+    return api
 
-    from . import backends
-    modname = f'{backends.__name__}.{backend}'
-    for _, name, _ in pkgutil.iter_modules(backends.__path__):
-        if name == backend:
-            importlib.import_module(modname)
-            break
-    else:
-        raise u.DDNSPError("DNS backend not found: %s", backend)
 
-    _backends = {cls.backend: cls for cls in DNSBase.__subclasses__()}
-    try:
-        api = _backends[backend](app=app)
-        return api
-    except KeyError:
-        raise u.DDNSPError("No valid DNS backend for backend: %s", backend)
+def start(app:flask.Flask) -> None:
+    """Start the backend and the batcher threads of this process"""
+    global batcher
+    global snapshot
+    api.start()
+    if snapshot is not None:
+        # Locks inherited through fork may be held by threads that are gone
+        snapshot = Snapshot(snapshot.ttl)
+    batcher = None
+    if (api.batch and app.config['DNS_BATCH_WINDOW'] > 0
+            and not app.config['OUTBOX_ENABLED']):
+        batcher = Batcher(app, app.config['DNS_BATCH_WINDOW'],
+                          app.config['DNS_BATCH_SIZE'])
 
 
 def get_api() -> DNSBase:
@@ -77,13 +269,132 @@ def get_api() -> DNSBase:
     return api
 
 
-def update_ip(hostname, ip) -> None:
+def is_ipv6(ip:str) -> bool:
+    """Family of an already validated address"""
+    return ':' in ip
+
+
+def same_family(ips:t.Iterable[str], ip:str) -> t.List[str]:
+    """Addresses in ips of the same family as ip"""
+    return [addr for addr in ips if is_ipv6(addr) == is_ipv6(ip)]
+
+
+def _record_name(hostname:str) -> str:
+    subdomain = flask.current_app.config['DNS_SUBDOMAIN']
+    if subdomain:
+        return f'{hostname}.{subdomain}'
+    return hostname
+
+
+def _in_snapshot(domain:str, name:str, ip:str) -> bool:
+    """Whether provider is known to already have ip for name"""
+    global snapshot
+    if snapshot is None:
+        return False
+    try:
+        return snapshot.has(domain, name, ip)
+    except NotImplementedError:
+        log.info("DNS backend %s can not list or look up records, disabling zone"
+                 " snapshot", get_api().backend)
+        snapshot = None
+    except u.DDNSPError as e:
+        log.warning("Could not check zone snapshot: %s", e)
+    return False
+
+
+def _snapshot_set(name:str, ip:t.Optional[str]) -> None:
+    if snapshot is not None:
+        snapshot.set(name, ip)
+
+
+@metrics.timed('dns')
+def update_ip(hostname:str, *ips:str) -> None:
+    """Update the records of hostname to ips, an IPv4 and/or an IPv6"""
     config = flask.current_app.config
     domain    = config['DNS_DOMAIN']
-    subdomain = config['DNS_SUBDOMAIN']
     ttl       = config['DNS_TTL']
-    name = hostname
-    if subdomain:
-        name = f'{hostname}.{subdomain}'
-    get_api().update_ip(domain=domain, name=name, ip=ip, ttl=ttl)
-    log.info("Updated IP: %s.%s: %s", name, domain, ip)
+    name = _record_name(hostname)
+    pending = [ip for ip in ips if not _in_snapshot(domain, name, ip)]
+    if not pending:
+        log.debug("IP already in DNS: %s.%s: %s", name, domain, ', '.join(ips))
+        return
+    if batcher is not None:
+        error = batcher.submit(hostname, pending).result()
+        if error:
+            raise error
+        return
+    try:
+        if len(pending) == 1:
+            get_api().update_ip(domain=domain, name=name, ip=pending[0], ttl=ttl)
+        else:
+            error = get_api().update_ips_batch(domain=domain, records={name: pending},
+                                               ttl=ttl)[name]
+            if error:
+                raise error
+    except u.DDNSPError as e:
+        _snapshot_set(name, None)
+        metrics.dns_error(get_api().backend, e)
+        raise
+    for ip in pending:
+        _snapshot_set(name, ip)
+    log.info("Updated IP: %s.%s: %s", name, domain, ', '.join(pending))
+
+
+@metrics.timed('dns')
+def update_ips(hosts:t.Dict[str, t.List[str]]) -> Errors:
+    """Update {hostname: [ip, ...]} in bulk, returning the error, if any, for each host
+
+    Addresses the zone snapshot shows as already up-to-date are skipped, the
+    others are sent in chunks of DNS_BATCH_SIZE hosts per backend call.
+    """
+    config = flask.current_app.config
+    domain = config['DNS_DOMAIN']
+    ttl    = config['DNS_TTL']
+    size   = config['DNS_BATCH_SIZE']
+    errors: Errors = {}
+    names: t.Dict[str, str] = {}
+    records: Records = {}
+    for hostname, ips in hosts.items():
+        name = _record_name(hostname)
+        pending = [ip for ip in ips if not _in_snapshot(domain, name, ip)]
+        if not pending:
+            log.debug("IP already in DNS: %s.%s: %s", name, domain, ', '.join(ips))
+            errors[hostname] = None
+        else:
+            names[name] = hostname
+            records[name] = pending
+    items = list(records.items())
+    for i in range(0, len(items), size):
+        chunk = dict(items[i:i+size])
+        results = get_api().update_ips_batch(domain=domain, records=chunk, ttl=ttl)
+        for name, error in results.items():
+            errors[names[name]] = error
+            if error is None:
+                for ip in chunk[name]:
+                    _snapshot_set(name, ip)
+                log.info("Updated IP: %s.%s: %s", name, domain, ', '.join(chunk[name]))
+            else:
+                _snapshot_set(name, None)
+                metrics.dns_error(get_api().backend, error)
+    return errors
+
+
+@metrics.timed('dns')
+def delete_ips(hostnames:t.Iterable[str]) -> Errors:
+    """Remove records of hostnames in bulk, returning the error, if any, for each"""
+    config = flask.current_app.config
+    domain = config['DNS_DOMAIN']
+    size   = config['DNS_BATCH_SIZE']
+    names  = {_record_name(hostname): hostname for hostname in hostnames}
+    items  = list(names)
+    errors: Errors = {}
+    for i in range(0, len(items), size):
+        results = get_api().delete_ips_batch(domain=domain, names=items[i:i+size])
+        for name, error in results.items():
+            errors[names[name]] = error
+            _snapshot_set(name, None)
+            if error is None:
+                log.info("Removed IP: %s.%s", name, domain)
+            else:
+                metrics.dns_error(get_api().backend, error)
+    return errors
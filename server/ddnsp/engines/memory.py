@@ -0,0 +1,561 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+In-memory storage engine, made durable by an append-only journal
+
+Hosts and outbox entries are kept in dicts of immutable records, replaced on
+every change, so reads take no lock and never touch the disk. Each change is
+appended to the journal as a JSON line, and written by a background thread
+that fsyncs all changes queued meanwhile at once (group commit). Writers wait
+for their change to be durable, except last-seen timestamps, which are only
+written along with the next group. When the journal grows to MEMORY_COMPACT_RATIO
+times the live records, it is rewritten in the background as a snapshot.
+
+The journal is read at startup, and locked, so only a single worker process
+may use it. Run multi-process servers with the sqlite engine instead.
+"""
+
+import atexit
+import fcntl
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+import typing as t
+
+import flask
+
+from .. import dao
+from .. import util as u
+
+log = logging.getLogger(__name__)
+
+
+class Record:
+    """Immutable record, readable as a Row: record['column']"""
+    __slots__: t.Tuple[str, ...] = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __getitem__(self, key:str) -> t.Any:
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.asdict()})"
+
+    def keys(self) -> t.Tuple[str, ...]:
+        return self.__slots__
+
+    def asdict(self) -> t.Dict[str, t.Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def replace(self, **changes) -> 'Record':
+        return self.__class__(**{**self.asdict(), **changes})
+
+
+class Host(Record):
+    __slots__ = ('hostname', 'username', 'password', 'ip', 'ip6', 'changed')
+
+
+class Change(Record):
+    __slots__ = ('hostname', 'ip', 'ip6', 'version', 'queued', 'next_try',
+                 'attempts', 'error')
+
+
+def now() -> str:
+    """Current time in SQLite's CURRENT_TIMESTAMP format"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+
+
+class Journal:
+    """Append-only file of JSON lines, written and fsynced in groups
+
+    Lines are queued by append() and written by sync(), either from the
+    writer thread started by start(), or directly by wait() otherwise.
+    Writers wait up to timeout seconds, while the thread retries failed writes.
+    """
+    def __init__(self, path:str, fsync:bool=True, timeout:float=5):
+        self.path: str = path
+        self.fsync: bool = fsync
+        self.timeout: t.Optional[float] = timeout or None
+        self.error: t.Optional[OSError] = None  # of the last write, if it failed
+        self.lines: int = 0  # in the file, and queued
+        self._file: t.Optional[t.BinaryIO] = None
+        self._pending: t.List[t.Tuple[int, bytes]] = []
+        self._seq: int = 0     # last line queued
+        self._synced: int = 0  # last line written
+        self._capture: t.Optional[t.List[bytes]] = None  # lines written while compacting
+        self._capture_seq: int = 0
+        self._cond = threading.Condition()
+        self._io_lock = threading.Lock()
+        self._thread: t.Optional[threading.Thread] = None
+        self._stop: bool = False
+
+    def open(self) -> t.Iterator[dict]:
+        """Lock the journal and yield its entries, ready to append"""
+        self._file = self._lock(open(self.path, 'a+b'))
+        self._file.seek(0)
+        offset = 0
+        for line in self._file:
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError("Incomplete line")
+                entry = json.loads(line)
+            except ValueError:
+                if self._file.read(1):
+                    raise u.DDNSPError("Corrupt journal %s at offset %s", self.path, offset)
+                # Torn write of the last line, from a crash
+                log.warning("Discarding incomplete last line of journal %s", self.path)
+                self._file.truncate(offset)
+                break
+            offset += len(line)
+            self.lines += 1
+            yield entry
+        self._file.seek(0, os.SEEK_END)
+
+    def _lock(self, file:t.BinaryIO) -> t.BinaryIO:
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            raise u.DDNSPError("Journal %s is in use by another process, the memory"
+                               " storage engine needs a single worker process", self.path)
+        return file
+
+    def append(self, entry:dict) -> int:
+        """Queue entry, return the sequence number to wait() for"""
+        line = (json.dumps(entry, separators=(',', ':')) + '\n').encode()
+        with self._cond:
+            self._seq += 1
+            self.lines += 1
+            self._pending.append((self._seq, line))
+            self._cond.notify_all()
+            return self._seq
+
+    def wait(self, seq:int) -> None:
+        """Wait until line seq is written, or raise DDNSPError"""
+        if self._thread is None:
+            try:
+                self.sync()
+            except OSError as e:
+                raise u.DDNSPError("Error writing journal %s: %s", self.path, e)
+            return
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._synced >= seq, self.timeout):
+                # Still queued, so it is written if the writer recovers
+                raise u.DDNSPError("Timeout writing journal %s: %s", self.path,
+                                   self.error or "writer is stuck")
+
+    def sync(self) -> None:
+        """Write and fsync all queued lines"""
+        with self._io_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return
+            try:
+                self._file.write(b''.join(line for _, line in batch))
+                self._file.flush()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+            except OSError as e:
+                # Retried with the next group, writers keep waiting for it
+                with self._cond:
+                    self._pending[:0] = batch
+                    self.error = e
+                raise
+            if self._capture is not None:
+                self._capture.extend(line for seq, line in batch if seq > self._capture_seq)
+            with self._cond:
+                self._synced = batch[-1][0]
+                self.error = None
+                self._cond.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._stop:
+                    self._cond.wait()
+                if self._stop and not self._pending:
+                    return
+            try:
+                self.sync()
+            except OSError as e:
+                log.exception("Error writing journal %s: %s", self.path, e)
+                time.sleep(1)
+
+    def start(self) -> None:
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name='ddnsp-journal', daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        if self._thread is not None:
+            with self._cond:
+                self._stop = True
+                self._cond.notify_all()
+            self._thread.join()
+            self._thread = None
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def snapshot(self) -> int:
+        """Start capturing lines written from now on, return the last queued one
+
+        Call it along with taking a snapshot of the state, then compact() it.
+        """
+        with self._cond:
+            self._capture = []
+            self._capture_seq = self._seq
+            return self._seq
+
+    def compact(self, entries:t.List[dict]) -> None:
+        """Replace the journal with the snapshot entries, and lines written since"""
+        tmp = f'{self.path}.tmp'
+        try:
+            with open(tmp, 'wb') as file:
+                for entry in entries:
+                    file.write((json.dumps(entry, separators=(',', ':')) + '\n').encode())
+                file.flush()
+                os.fsync(file.fileno())
+            with self._io_lock:
+                new = self._lock(open(tmp, 'ab'))
+                new.write(b''.join(self._capture))
+                new.flush()
+                os.fsync(new.fileno())
+                os.replace(tmp, self.path)
+                self._fsync_dir()
+                self._file.close()
+                self._file = new
+                with self._cond:
+                    self.lines = (len(entries) + len(self._capture)
+                                  + len(self._pending))
+                self._capture = None
+        finally:
+            self._capture = None
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def _fsync_dir(self) -> None:
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class MemoryEngine(dao.StorageBase):
+    def __init__(self, app:flask.Flask):
+        super().__init__(app)
+        self.path: str = app.config['JOURNAL']
+        self.compact_ratio: float = self.config['compact_ratio']
+        self.compact_interval: float = self.config['compact_interval']
+        self.hosts:  t.Dict[str, Host] = {}
+        self.outbox: t.Dict[str, Change] = {}
+        self.journal: t.Optional[Journal] = None
+        self._compactor: t.Optional[u.PeriodicThread] = None
+        self._lock = threading.Lock()  # for changes and their journal order
+        self._load_lock = threading.Lock()
+        app.logger.info("Using journal: %s", self.path)
+
+    def load(self) -> None:
+        """Read the journal, once in each process, on first use"""
+        if self.journal is not None:
+            return
+        with self._load_lock:
+            if self.journal is not None:
+                return
+            hosts: t.Dict[str, Host] = {}
+            outbox: t.Dict[str, Change] = {}
+            journal = Journal(self.path, fsync=self.config['fsync'],
+                              timeout=self.config['timeout'])
+            start = time.perf_counter()
+            for entry in journal.open():
+                (op, value), = entry.items()
+                if op == 't':
+                    host = hosts.get(value[0])
+                    if host is not None:
+                        hosts[value[0]] = host.replace(changed=value[1])
+                elif op == 'h':
+                    hosts[value['hostname']] = Host(**value)
+                elif op == 'd':
+                    hosts.pop(value, None)
+                elif op == 'o':
+                    outbox[value['hostname']] = Change(**value)
+                elif op == 'x':
+                    outbox.pop(value, None)
+            self.hosts, self.outbox = hosts, outbox
+            log.info("Loaded %s hosts and %s outbox entries from %s journal lines"
+                     " in %.3fs", len(hosts), len(outbox), journal.lines,
+                     time.perf_counter() - start)
+            self.journal = journal
+            atexit.register(self.close)
+
+    def start(self) -> None:
+        self.load()
+        self.journal.start()
+        if self.compact_interval > 0:
+            self._compactor = u.PeriodicThread(self.maybe_compact, self.compact_interval,
+                                               name='ddnsp-journal-compact')
+            self._compactor.start()
+
+    def close(self) -> None:
+        atexit.unregister(self.close)
+        if self._compactor is not None:
+            self._compactor.stop()
+            self._compactor = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def after_fork(self) -> None:
+        # The journal lock and threads belong to the parent, load it anew
+        atexit.unregister(self.close)
+        self._compactor = None
+        self.journal = None
+        self.hosts, self.outbox = {}, {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    def _set_host(self, host:Host) -> int:
+        self.hosts[host.hostname] = host
+        return self.journal.append({'h': host.asdict()})
+
+    def _set_change(self, change:Change) -> int:
+        self.outbox[change.hostname] = change
+        return self.journal.append({'o': change.asdict()})
+
+    def _enqueue(self, hostname, ip, ip6=None) -> int:
+        """Queue a DNS change, replacing any pending one for the same host"""
+        queued = time.time()
+        old = self.outbox.get(hostname)
+        if old is None:
+            change = Change(hostname=hostname, ip=ip, ip6=ip6, version=1, queued=queued,
+                            next_try=queued, attempts=0)
+        else:
+            change = old.replace(ip=ip, ip6=ip6, version=old.version + 1,
+                                 next_try=queued, attempts=0, error=None)
+        return self._set_change(change)
+
+    # -------------------------------------------------------------------------
+    def update_timestamp(self, hostname:str) -> None:
+        self.load()
+        with self._lock:
+            host = self.hosts.get(hostname)
+            if host is None:
+                return
+            changed = now()
+            self.hosts[hostname] = host.replace(changed=changed)
+            self.journal.append({'t': [hostname, changed]})
+
+    def get_host(self, hostname:str) -> t.Optional[Host]:
+        self.load()
+        return self.hosts.get(hostname)
+
+    def get_hosts(self, hostnames:t.Collection[str]) -> t.Dict[str, Host]:
+        self.load()
+        hosts = self.hosts
+        return {hostname: hosts[hostname] for hostname in hostnames if hostname in hosts}
+
+    def get_ips(self) -> t.List[Host]:
+        self.load()
+        return list(self.hosts.values())
+
+    def add_hosts(self, username, password, hosts:dao.NewHosts, outbox=False) -> t.List[str]:
+        self.load()
+        added: t.List[str] = []
+        seq = 0
+        with self._lock:
+            changed = now()
+            for hostname, (ip, ip6) in hosts.items():
+                if hostname in self.hosts:
+                    continue
+                seq = self._set_host(Host(hostname=hostname, username=username,
+                                          password=password, ip=ip, ip6=ip6,
+                                          changed=changed))
+                added.append(hostname)
+                if outbox:
+                    seq = self._enqueue(hostname, ip, ip6)
+        if seq:
+            self.journal.wait(seq)
+        return added
+
+    def import_hosts(self, hosts:t.List[dao.HostData], outbox=False) -> t.List[str]:
+        self.load()
+        added: t.List[str] = []
+        seq = 0
+        with self._lock:
+            changed = now()
+            for host in hosts:
+                if host['hostname'] in self.hosts:
+                    continue
+                seq = self._set_host(Host(**{**host, 'changed': host['changed'] or changed}))
+                added.append(host['hostname'])
+                if outbox and (host['ip'] or host['ip6']):
+                    seq = self._enqueue(host['hostname'], host['ip'], host['ip6'])
+        if seq:
+            self.journal.wait(seq)
+        return added
+
+    def export_hosts(self) -> t.List[Host]:
+        self.load()
+        return sorted(self.hosts.values(), key=lambda host: host.hostname)
+
+    def update_hosts(self, changes:dao.HostChanges, outbox=False) -> None:
+        self.load()
+        seq = 0
+        with self._lock:
+            changed = now()
+            for hostname, (ip, ip6, password) in changes.items():
+                host = self.hosts.get(hostname)
+                if host is None:
+                    continue
+                host = host.replace(ip=host.ip if ip is None else ip,
+                                    ip6=host.ip6 if ip6 is None else ip6,
+                                    password=host.password if password is None else password,
+                                    changed=changed)
+                seq = self._set_host(host)
+                if outbox and (ip or ip6):
+                    seq = self._enqueue(hostname, host.ip, host.ip6)
+        if seq:
+            self.journal.wait(seq)
+
+    def _update(self, hostname, **changes) -> None:
+        self.load()
+        with self._lock:
+            host = self.hosts.get(hostname)
+            if host is None:
+                return
+            seq = self._set_host(host.replace(**changes))
+        self.journal.wait(seq)
+
+    def update_password(self, hostname, password) -> None:
+        self._update(hostname, password=password)
+
+    def replace_password(self, hostnames:t.Collection[str], old:str, new:str) -> t.List[str]:
+        self.load()
+        done: t.List[str] = []
+        seq = 0
+        with self._lock:
+            for hostname in hostnames:
+                host = self.hosts.get(hostname)
+                if host is None or host.password != old:
+                    continue
+                seq = self._set_host(host.replace(password=new))
+                done.append(hostname)
+        if seq:
+            self.journal.wait(seq)
+        return done
+
+    def update_ip(self, hostname, ip, ip6=None) -> None:
+        self._update(hostname, ip=ip, ip6=ip6)
+
+    def _delete(self, hostname, outbox=False) -> int:
+        del self.hosts[hostname]
+        seq = self.journal.append({'d': hostname})
+        if outbox:
+            seq = self._enqueue(hostname, None)
+        return seq
+
+    def delete_host(self, hostname, outbox=False) -> None:
+        self.load()
+        with self._lock:
+            if hostname not in self.hosts:
+                return
+            seq = self._delete(hostname, outbox)
+        self.journal.wait(seq)
+
+    def expire_hosts(self, before:str, limit:int, outbox=False) -> t.List[str]:
+        self.load()
+        with self._lock:
+            expired = heapq.nsmallest(limit, (host for host in self.hosts.values()
+                                              if host.changed < before),
+                                      key=lambda host: host.changed)
+            seq = 0
+            for host in expired:
+                seq = self._delete(host.hostname, outbox)
+        if seq:
+            self.journal.wait(seq)
+        return [host.hostname for host in expired]
+
+    # -------------------------------------------------------------------------
+    # DNS outbox
+    def claim_outbox(self, limit:int, lease:float) -> t.List[Change]:
+        self.load()
+        now_ = time.time()
+        with self._lock:
+            due = heapq.nsmallest(limit, (change for change in self.outbox.values()
+                                          if change.next_try <= now_),
+                                  key=lambda change: change.queued)
+            claimed = [change.replace(next_try=now_ + lease) for change in due]
+            seq = 0
+            for change in claimed:
+                seq = self._set_change(change)
+        if seq:
+            self.journal.wait(seq)
+        return claimed
+
+    def _outbox_update(self, hostname, version,
+                       update:t.Optional[t.Callable[[Change], Change]]=None) -> None:
+        """Replace the change with update(change), or delete it if None
+
+        Unless a newer version of it was queued meanwhile.
+        """
+        self.load()
+        with self._lock:
+            change = self.outbox.get(hostname)
+            if change is None or change.version != version:
+                return
+            if update is not None:
+                seq = self._set_change(update(change))
+            else:
+                del self.outbox[hostname]
+                seq = self.journal.append({'x': hostname})
+        self.journal.wait(seq)
+
+    def done_outbox(self, hostname, version) -> None:
+        self._outbox_update(hostname, version)
+
+    def retry_outbox(self, hostname, version, error, delay:float) -> None:
+        self._outbox_update(hostname, version, lambda change: change.replace(
+            attempts=change.attempts + 1, error=str(error), next_try=time.time() + delay))
+
+    def outbox_status(self) -> t.Dict[str, t.Any]:
+        self.load()
+        changes = list(self.outbox.values())
+        return {
+            'depth':        len(changes),
+            'failing':      sum(1 for change in changes if change.error is not None),
+            'oldest':       min((change.queued for change in changes), default=None),
+            'max_attempts': max((change.attempts for change in changes), default=None),
+        }
+
+    # -------------------------------------------------------------------------
+    def maybe_compact(self) -> None:
+        """Compact the journal if it grew too much over the live records"""
+        live = len(self.hosts) + len(self.outbox)
+        if self.journal is not None and self.journal.lines > self.compact_ratio * max(live, 100):
+            self.compact()
+
+    def compact(self) -> None:
+        journal = self.journal
+        start = time.perf_counter()
+        lines = journal.lines
+        with self._lock:
+            hosts, changes = list(self.hosts.values()), list(self.outbox.values())
+            journal.snapshot()
+        journal.compact([{'h': host.asdict()} for host in hosts] +
+                        [{'o': change.asdict()} for change in changes])
+        log.info("Compacted journal %s from %s to %s lines in %.3fs",
+                 self.path, lines, journal.lines, time.perf_counter() - start)
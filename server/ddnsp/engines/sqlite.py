@@ -0,0 +1,441 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+SQLite storage engine, shared by all worker processes
+"""
+
+import atexit
+import contextlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import typing as t
+
+import flask
+
+from .. import dao
+from .. import util as u
+
+log = logging.getLogger(__name__)
+
+Row: 't.TypeAlias' = sqlite3.Row
+R = t.TypeVar('R', bound=t.Union[Row, t.Dict[str, t.Any]])  # "Row-like"
+
+MIN_SQLITE_VERSION = (3, 35, 0)  # for RETURNING
+
+
+class ConnectionPool:
+    """Tuned SQLite connections, reused across requests of a worker process
+
+    Connections are not bound to a thread, as requests may be served by any.
+    Journal, sync, cache and mmap settings are set as PRAGMAs on each new
+    connection, and each one keeps its own prepared statement cache warm.
+    """
+    PRAGMAS = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size')
+
+    def __init__(self, database:str, *, pool_size:int=8, timeout:float=5,
+                 cached_statements:int=128, **pragmas):
+        self.database:          str = database
+        self.timeout:         float = timeout
+        self.cached_statements: int = cached_statements
+        self.pragmas:          dict = {k: v for k, v in pragmas.items()
+                                       if k in self.PRAGMAS and v is not None}
+        self._idle: 'queue.LifoQueue[sqlite3.Connection]' = queue.LifoQueue(pool_size)
+        self._inherited: t.List[sqlite3.Connection] = []
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            timeout=self.timeout,
+            cached_statements=self.cached_statements,
+            check_same_thread=False,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {pragma} = {value}').close()
+        log.debug("New database connection: %s %s", self.database, self.pragmas)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def release(self, conn:sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self) -> None:
+        """Close all idle connections"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def discard(self) -> None:
+        """Forget connections inherited from the parent process, after a fork
+
+        They are never used, nor closed, as SQLite connections must not cross
+        a fork, and closing them could disturb the parent's locks and journal.
+        """
+        while True:
+            try:
+                self._inherited.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    @contextlib.contextmanager
+    def connection(self) -> t.Iterator[sqlite3.Connection]:
+        """Connection for use outside of an app context, such as in threads"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+
+class TimestampBuffer:
+    """Write-behind buffer for hosts last-seen timestamps
+
+    Timestamps are collected in memory and written in a single transaction
+    every interval seconds, as soon as batch_size hosts are pending, or at exit.
+    """
+    def __init__(self, pool:ConnectionPool, interval:float, batch_size:int):
+        self.pool: ConnectionPool = pool
+        self.batch_size: int = batch_size
+        self._pending: t.Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._thread = u.PeriodicThread(self.flush, interval, name='ddnsp-timestamps')
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add(self, hostname:str) -> None:
+        # Same format as SQLite's CURRENT_TIMESTAMP
+        now = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        with self._lock:
+            self._pending[hostname] = now
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._thread.wake()
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            with self.pool.connection() as conn, conn:
+                conn.executemany('UPDATE host SET changed = ? WHERE hostname = ?',
+                                 [(ts, host) for host, ts in pending.items()])
+        except sqlite3.Error:
+            # Put them back, unless a newer timestamp arrived meanwhile
+            with self._lock:
+                self._pending = {**pending, **self._pending}
+            raise
+        log.debug("Flushed %s timestamps", len(pending))
+
+    def close(self) -> None:
+        atexit.unregister(self.close)
+        self._thread.stop()
+        self.flush()
+
+
+class SQLiteEngine(dao.StorageBase):
+    def __init__(self, app:flask.Flask):
+        if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+            raise u.DDNSPError("SQLite %s or later is required, Python uses %s. Use a"
+                               " newer Python build or STORAGE_ENGINE = 'memory'",
+                               '.'.join(map(str, MIN_SQLITE_VERSION)), sqlite3.sqlite_version)
+        super().__init__(app)
+        self.database: str = app.config['DATABASE']
+        self.timestamps: t.Optional[TimestampBuffer] = None
+        app.teardown_appcontext(self.close_db)
+        app.logger.info("Using database: %s", self.database)
+        self.pool: ConnectionPool = ConnectionPool(self.database, **self.config)
+        with app.app_context():
+            if not os.path.exists(self.database):
+                self.create_db()
+            else:
+                self.upgrade_db()
+        # Do not leave open connections behind for forked workers to inherit
+        self.pool.close()
+
+    def create_db(self) -> None:
+        self.run_schema()
+        flask.current_app.logger.info("Database Created")
+
+    def run_schema(self) -> None:
+        """Create tables and indexes, skipping the ones already existing"""
+        with flask.current_app.open_resource('schema.sql', 'rt') as f:
+            self.get_db().executescript(f.read())
+
+    def upgrade_db(self) -> None:
+        """Add tables, indexes and columns introduced after the database was created"""
+        db = self.get_db()
+        query = ("SELECT type, name FROM sqlite_master"
+                 " WHERE type IN ('table', 'index') AND name NOT LIKE 'sqlite_%'")
+        existing = {tuple(row) for row in db.execute(query)}
+        # Indexes on existing tables are built here, such as host_changed,
+        # which may take a while on large ones
+        self.run_schema()
+        for kind, name in sorted({tuple(row) for row in db.execute(query)} - existing):
+            flask.current_app.logger.info("Added %s %s to database", kind, name)
+        for table in ('host', 'outbox'):
+            columns = {row['name'] for row in db.execute(f'PRAGMA table_info({table})')}
+            if columns and 'ip6' not in columns:
+                db.execute(f'ALTER TABLE {table} ADD COLUMN ip6 TEXT')
+                flask.current_app.logger.info("Added column %s.ip6 to database", table)
+
+    def start(self) -> None:
+        self.stop_timestamps()
+        interval = self.app.config['TIMESTAMP_FLUSH_INTERVAL']
+        if interval > 0:
+            self.timestamps = TimestampBuffer(self.pool, interval,
+                                              self.app.config['TIMESTAMP_FLUSH_BATCH'])
+
+    def stop_timestamps(self) -> None:
+        if self.timestamps is not None:
+            self.timestamps.close()
+            self.timestamps = None
+
+    def close(self) -> None:
+        self.stop_timestamps()
+        self.pool.close()
+
+    def after_fork(self) -> None:
+        self.pool.discard()
+        if self.timestamps is not None:
+            # Its thread did not survive the fork, and pending ones are the parent's
+            atexit.unregister(self.timestamps.close)
+            self.timestamps = None
+
+    def flush(self) -> None:
+        if self.timestamps is not None:
+            self.timestamps.flush()
+
+    # -------------------------------------------------------------------------
+    def get_db(self) -> sqlite3.Connection:
+        if 'db' not in flask.g:
+            flask.g.db = self.pool.acquire()
+        return flask.g.db
+
+    def close_db(self, _e=None) -> None:
+        db = flask.g.pop('db', None)
+        if db is not None:
+            self.pool.release(db)
+
+    def execute(self, query, args) -> t.Optional[int]:
+        """Execute an INSERT, UPDATE or DELETE, return inserted or updated row ID"""
+        # using conn's context manager for auto-commit
+        log.debug("Executing SQL: %r, %s", query, args)
+        with self.get_db() as conn, contextlib.closing(conn.execute(query, args)) as cur:
+            return cur.lastrowid
+
+    def execute_returning(self, query, args) -> t.List[Row]:
+        """Execute an INSERT, UPDATE or DELETE with a RETURNING clause"""
+        log.debug("Executing SQL: %r, %s", query, args)
+        with self.get_db() as conn, contextlib.closing(conn.execute(query, args)) as cur:
+            return cur.fetchall()
+
+    @contextlib.contextmanager
+    def transaction(self) -> t.Iterator[sqlite3.Connection]:
+        """Run several statements in a single, auto-committed, transaction"""
+        with self.get_db() as conn:
+            yield conn
+
+    def fetch(self, query, args=()) -> t.List[Row]:
+        log.debug("Fetching  SQL: %r, %s", query, args)
+        with contextlib.closing(self.get_db().execute(query, args)) as cur:
+            return cur.fetchall()
+
+    def fetchone(self, query, args=()) -> t.Optional[Row]:
+        rv = self.fetch(query, args)
+        return rv[0] if rv else None
+
+    # -------------------------------------------------------------------------
+    def update_timestamp(self, hostname:str) -> None:
+        if self.timestamps is not None:
+            self.timestamps.add(hostname)
+            return
+        self.execute('UPDATE host'
+                     ' SET changed = CURRENT_TIMESTAMP'
+                     ' WHERE hostname = ?', [hostname])
+
+    def get_host(self, hostname:str) -> t.Optional[Row]:
+        return self.fetchone('SELECT * FROM host WHERE hostname = ?', [hostname])
+
+    def get_hosts(self, hostnames:t.Collection[str]) -> t.Dict[str, Row]:
+        if not hostnames:
+            return {}
+        marks = ', '.join('?' * len(hostnames))
+        rows = self.fetch(f'SELECT * FROM host WHERE hostname IN ({marks})', list(hostnames))
+        return {row['hostname']: row for row in rows}
+
+    def get_ips(self) -> t.List[Row]:
+        return self.fetch('SELECT hostname, ip, ip6 FROM host')
+
+    def add_hosts(self, username, password, hosts:dao.NewHosts, outbox=False) -> t.List[str]:
+        query, _ = _sql_insert('host', dict.fromkeys(('username', 'password', 'hostname',
+                                                      'ip', 'ip6')))
+        query = f'{query} ON CONFLICT(hostname) DO NOTHING RETURNING id'
+        added: t.List[str] = []
+        with self.transaction() as conn:
+            for hostname, (ip, ip6) in hosts.items():
+                args = dict(username=username, password=password, hostname=hostname,
+                            ip=ip, ip6=ip6)
+                log.debug("Executing SQL: %r, %s", query, u.obfuscate(args))
+                with contextlib.closing(conn.execute(query, args)) as cur:
+                    if not cur.fetchall():
+                        continue
+                added.append(hostname)
+                if outbox:
+                    self._enqueue(conn, hostname, ip, ip6)
+        return added
+
+    def import_hosts(self, hosts:t.List[dao.HostData], outbox=False) -> t.List[str]:
+        if not hosts:
+            return []
+        marks = ', '.join('?' * len(hosts))
+        with self.transaction() as conn:
+            with contextlib.closing(conn.execute(
+                    f'SELECT hostname FROM host WHERE hostname IN ({marks})',
+                    [host['hostname'] for host in hosts])) as cur:
+                existing = {row['hostname'] for row in cur.fetchall()}
+            new = [host for host in hosts if host['hostname'] not in existing]
+            conn.executemany('INSERT INTO host'
+                             ' (username, password, hostname, ip, ip6, changed)'
+                             ' VALUES (:username, :password, :hostname, :ip, :ip6,'
+                             '  COALESCE(:changed, CURRENT_TIMESTAMP))'
+                             ' ON CONFLICT(hostname) DO NOTHING', new).close()
+            if outbox:
+                for host in new:
+                    if host['ip'] or host['ip6']:
+                        self._enqueue(conn, host['hostname'], host['ip'], host['ip6'])
+        return [host['hostname'] for host in new]
+
+    def export_hosts(self) -> t.List[Row]:
+        return self.fetch('SELECT hostname, username, password, ip, ip6, changed'
+                          ' FROM host ORDER BY hostname')
+
+    def update_hosts(self, changes:dao.HostChanges, outbox=False) -> None:
+        with self.transaction() as conn:
+            conn.executemany('UPDATE host SET'
+                             ' ip       = COALESCE(:ip, ip),'
+                             ' ip6      = COALESCE(:ip6, ip6),'
+                             ' password = COALESCE(:password, password),'
+                             ' changed  = CURRENT_TIMESTAMP'
+                             ' WHERE hostname = :hostname',
+                             [dict(hostname=hostname, ip=ip, ip6=ip6, password=password)
+                              for hostname, (ip, ip6, password) in changes.items()]).close()
+            if outbox:
+                for hostname, (ip, ip6, _) in changes.items():
+                    if ip or ip6:
+                        self._enqueue_host(conn, hostname)
+
+    def update_password(self, hostname, password) -> None:
+        self.execute('UPDATE host SET password = :password WHERE hostname = :hostname',
+                     dict(hostname=hostname, password=password))
+
+    def replace_password(self, hostnames:t.Collection[str], old:str, new:str) -> t.List[str]:
+        if not hostnames:
+            return []
+        marks = ', '.join('?' * len(hostnames))
+        rows = self.execute_returning(f'UPDATE host SET password = ?'
+                                      f' WHERE hostname IN ({marks}) AND password = ?'
+                                      f' RETURNING hostname', [new, *hostnames, old])
+        return [row['hostname'] for row in rows]
+
+    def update_ip(self, hostname, ip, ip6=None) -> None:
+        self.execute('UPDATE host SET ip = :ip, ip6 = :ip6 WHERE hostname = :hostname',
+                     dict(hostname=hostname, ip=ip, ip6=ip6))
+
+    def delete_host(self, hostname, outbox=False) -> None:
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM host WHERE hostname = ?', [hostname]).close()
+            if outbox:
+                self._enqueue(conn, hostname, None)
+
+    def expire_hosts(self, before:str, limit:int, outbox=False) -> t.List[str]:
+        # Uses the index on changed, so each call is a short write transaction
+        with self.transaction() as conn:
+            with contextlib.closing(conn.execute(
+                    'DELETE FROM host WHERE id IN (SELECT id FROM host'
+                    ' WHERE changed < ? ORDER BY changed LIMIT ?)'
+                    ' RETURNING hostname', [before, limit])) as cur:
+                hostnames = [row['hostname'] for row in cur.fetchall()]
+            if outbox:
+                for hostname in hostnames:
+                    self._enqueue(conn, hostname, None)
+        return hostnames
+
+    # -------------------------------------------------------------------------
+    # DNS outbox
+    @staticmethod
+    def _enqueue(conn:sqlite3.Connection, hostname, ip, ip6=None) -> None:
+        """Queue a DNS change, replacing any pending one for the same host
+
+        Changes carry all addresses of the host, so the latest one is complete.
+        """
+        now = time.time()
+        conn.execute('INSERT INTO outbox (hostname, ip, ip6, queued, next_try)'
+                     ' VALUES (:hostname, :ip, :ip6, :now, :now)'
+                     ' ON CONFLICT(hostname) DO UPDATE SET'
+                     '  ip = excluded.ip,'
+                     '  ip6 = excluded.ip6,'
+                     '  version = version + 1,'
+                     '  next_try = excluded.next_try,'
+                     '  attempts = 0,'
+                     '  error = NULL',
+                     locals()).close()
+
+    def _enqueue_host(self, conn:sqlite3.Connection, hostname) -> None:
+        """Queue the current addresses of hostname, as just written in conn"""
+        with contextlib.closing(conn.execute('SELECT ip, ip6 FROM host WHERE hostname = ?',
+                                             [hostname])) as cur:
+            row = cur.fetchone()
+        if row is not None:
+            self._enqueue(conn, hostname, row['ip'], row['ip6'])
+
+    def claim_outbox(self, limit:int, lease:float) -> t.List[Row]:
+        now = time.time()
+        return self.execute_returning(
+            'UPDATE outbox SET next_try = :until'
+            ' WHERE hostname IN (SELECT hostname FROM outbox'
+            '  WHERE next_try <= :now ORDER BY queued LIMIT :limit)'
+            ' RETURNING *', dict(now=now, until=now + lease, limit=limit))
+
+    def done_outbox(self, hostname, version) -> None:
+        self.execute('DELETE FROM outbox WHERE hostname = ? AND version = ?',
+                     [hostname, version])
+
+    def retry_outbox(self, hostname, version, error, delay:float) -> None:
+        self.execute('UPDATE outbox SET'
+                     ' attempts = attempts + 1, error = :error, next_try = :next_try'
+                     ' WHERE hostname = :hostname AND version = :version',
+                     dict(hostname=hostname, version=version, error=str(error),
+                          next_try=time.time() + delay))
+
+    def outbox_status(self) -> Row:
+        return self.fetchone('SELECT COUNT(*) AS depth,'
+                             ' COUNT(error) AS failing,'
+                             ' MIN(queued) AS oldest,'
+                             ' MAX(attempts) AS max_attempts'
+                             ' FROM outbox')
+
+
+def _sql_insert(table:str, data: R) -> t.Tuple[str, R]:
+    keylist = ', :'.join(data.keys())
+    return (f"INSERT INTO {table} ({keylist.replace(':', '')})"
+            f" VALUES (:{keylist})",
+            data)
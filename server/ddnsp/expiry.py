@@ -0,0 +1,84 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Expiration of inactive hostnames
+"""
+
+import atexit
+import logging
+import time
+import typing as t
+
+import flask
+
+from . import dao
+from . import dns
+from . import outbox
+from . import util as u
+
+
+log = logging.getLogger(__name__)
+
+sweeper: t.Optional['Sweeper'] = None
+
+
+class Sweeper:
+    """Background thread deleting hosts not seen for max_age seconds
+
+    Hosts are deleted in batches of batch_size, each its own short transaction,
+    so updates are never blocked for long. Their DNS records are removed in
+    bulk, via the outbox if enabled.
+    """
+    def __init__(self, app:flask.Flask, max_age:float, interval:float, batch_size:int):
+        self.app:        flask.Flask = app
+        self.max_age:    float       = max_age
+        self.batch_size: int         = batch_size
+        self._thread = u.PeriodicThread(self.sweep, interval, name='ddnsp-expiry')
+        self._thread.start()
+        atexit.register(self.close)
+
+    def sweep(self) -> int:
+        # Buffered timestamps would make active hosts look expired
+        dao.flush()
+        before = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - self.max_age))
+        total = 0
+        with self.app.app_context():
+            while True:
+                hostnames = dao.expire_hosts(before, self.batch_size,
+                                             outbox=outbox.enabled())
+                if not hostnames:
+                    break
+                total += len(hostnames)
+                log.info("Expired %s hosts not seen since %s: %s",
+                         len(hostnames), before, ', '.join(hostnames))
+                if outbox.enabled():
+                    outbox.wake()
+                    continue
+                for hostname, error in dns.delete_ips(hostnames).items():
+                    if error is not None:
+                        log.error("Failed removing DNS for %s: %s", hostname, error)
+        return total
+
+    def close(self) -> None:
+        atexit.unregister(self.close)
+        self._thread.stop()
+
+
+def init_app(app:flask.Flask) -> None:
+    global sweeper
+    if sweeper is not None:
+        sweeper.close()
+        sweeper = None
+
+
+def start(app:flask.Flask) -> None:
+    """Start the sweeper thread of this process"""
+    global sweeper
+    init_app(app)
+    if app.config['HOST_EXPIRE_DAYS'] <= 0:
+        return
+    sweeper = Sweeper(app,
+                      max_age=app.config['HOST_EXPIRE_DAYS'] * 86400,
+                      interval=app.config['HOST_EXPIRE_INTERVAL'],
+                      batch_size=app.config['HOST_EXPIRE_BATCH_SIZE'])
@@ -0,0 +1,158 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Single-flight of concurrent identical updates, and per-hostname locks
+
+Clients retrying, or several behind a NAT sharing a hostname, send the same
+update at the same time. Within a worker, concurrent identical requests
+share a single run and its reply. With UPDATE_LOCK, updates of a hostname are
+also serialized across worker processes by a lock file, so a repeated update
+in another worker finds the work done, replying nochg with no DNS change,
+and registrations of the same new hostname do not race.
+"""
+
+import contextlib
+import fcntl
+import logging
+import os
+import threading
+import typing as t
+import zlib
+
+import flask
+
+from . import metrics
+
+
+log = logging.getLogger(__name__)
+
+R = t.TypeVar('R')
+
+flights: t.Optional['SingleFlight'] = None
+locks:   t.Optional['HostLocks'] = None
+
+
+class Call:
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done:    threading.Event           = threading.Event()
+        self.result:  t.Any                     = None
+        self.error:   t.Optional[BaseException] = None
+        self.waiters: int                       = 0
+
+
+class SingleFlight:
+    """Share the result of a call among concurrent callers with the same key
+
+    The first caller runs it, the others wait for its result, or exception.
+    Nothing is cached, a call made after it finishes runs again.
+    """
+    def __init__(self):
+        self._calls: t.Dict[t.Hashable, Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key:t.Hashable, func:t.Callable[..., R], *args) -> R:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+            else:
+                call.waiters += 1
+        if not leader:
+            metrics.coalesced()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+            if call.waiters:
+                log.debug("Shared update with %s concurrent requests", call.waiters)
+
+
+class HostLocks:
+    """Cross-process locks by hostname, on one byte of a lock file per slot
+
+    Hostnames are hashed to slots, so unrelated ones may share a lock. POSIX
+    record locks are owned by the process, not the thread, so each slot also
+    has a thread lock, held along with it.
+    """
+    def __init__(self, path:str, slots:int):
+        self.path:  str = path
+        self.slots: int = slots
+        self._fd:   int = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._locks: t.List[threading.Lock] = [threading.Lock() for _ in range(slots)]
+
+    def slot(self, hostname:str) -> int:
+        return zlib.crc32(hostname.encode()) % self.slots
+
+    @contextlib.contextmanager
+    def lock(self, hostnames:t.Iterable[str]) -> t.Iterator[None]:
+        """Hold the locks of all hostnames, taken in slot order to never deadlock"""
+        with contextlib.ExitStack() as stack:
+            for slot in sorted({self.slot(hostname) for hostname in hostnames}):
+                stack.enter_context(self._locks[slot])
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, slot)
+                stack.callback(fcntl.lockf, self._fd, fcntl.LOCK_UN, 1, slot)
+            yield
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+def init_app(app:flask.Flask) -> None:
+    global flights
+    close()
+    flights = SingleFlight() if app.config['UPDATE_SINGLE_FLIGHT'] else None
+
+
+def start(app:flask.Flask) -> None:
+    """Open the lock file of this process"""
+    global locks
+    close()
+    if app.config['UPDATE_LOCK']:
+        locks = HostLocks(app.config['UPDATE_LOCK_FILE'], app.config['UPDATE_LOCK_SLOTS'])
+
+
+def close() -> None:
+    global locks
+    if locks is not None:
+        locks.close()
+        locks = None
+
+
+def after_fork() -> None:
+    """Drop the locks inherited from the parent process, that might be held"""
+    global flights, locks
+    if flights is not None:
+        flights = SingleFlight()
+    if locks is not None:
+        # Record locks are not inherited, and closing the inherited fd only
+        # releases the locks of this process, none
+        locks.close()
+        locks = None
+
+
+def do(key:t.Hashable, func:t.Callable[..., R], *args) -> R:
+    """Run func(*args), or share the result of a concurrent run with the same key"""
+    if flights is None:
+        return func(*args)
+    return flights.do(key, func, *args)
+
+
+def locked(hostnames:t.Iterable[str]) -> t.ContextManager[None]:
+    """Hold the cross-process locks of hostnames, if enabled"""
+    if locks is None:
+        return contextlib.nullcontext()
+    return locks.lock(hostnames)
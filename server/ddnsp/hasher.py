@@ -5,32 +5,235 @@
 Password hashing and related functions
 """
 
+import collections
+import concurrent.futures
+import fcntl
+import hashlib
+import hmac
+import json
 import logging
+import os
+import threading
+import time
+import typing as t
 
-import argon2
 import flask
 
+from . import metrics
+from . import util as u
+
+if t.TYPE_CHECKING:
+    import argon2
+
 
 log = logging.getLogger(__name__)
 
+# Recently verified credentials: {hostname: (HMAC digest, expiration)}
+_verified: 't.OrderedDict[str, t.Tuple[bytes, float]]' = collections.OrderedDict()
+_verified_lock = threading.Lock()
+_secret: bytes = os.urandom(32)  # Fallback when app has no SECRET_KEY
+
+executor: t.Optional['HashExecutor'] = None
+_executor_lock = threading.Lock()
+_hasher: t.Optional['argon2.PasswordHasher'] = None
+
+
+class HashExecutor:
+    """Run Argon2 calls in a bounded pool, failing fast when too many are waiting
+
+    Each hash uses memory_cost KiB, so the number of workers is capped by the
+    memory budget. Callers beyond workers + queue_size, or waiting longer than
+    timeout, get a DDNSPBusyError instead of piling up.
+    """
+    def __init__(self, workers:int, queue_size:int, timeout:float):
+        self.workers:    int   = max(1, workers)
+        self.limit:      int   = self.workers + max(0, queue_size)
+        self.timeout:    float = timeout or None
+        self.pending:    int   = 0
+        self._lock = threading.Lock()
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            self.workers, thread_name_prefix='argon2'
+        )
+        log.info("Argon2 executor: %s workers, %s max pending",
+                 self.workers, self.limit)
+
+    def _done(self, _future) -> None:
+        with self._lock:
+            self.pending -= 1
+
+    def run(self, func:t.Callable, *args):
+        with self._lock:
+            if self.pending >= self.limit:
+                raise u.DDNSPBusyError("Argon2 queue full: %s pending", self.pending)
+            self.pending += 1
+        future = self._pool.submit(func, *args)
+        future.add_done_callback(self._done)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise u.DDNSPBusyError("Argon2 queue timeout: %s seconds", self.timeout)
+
+
+def max_workers(config:flask.Config) -> int:
+    """Concurrent Argon2 calls allowed by HASH_WORKERS and HASH_MEMORY_BUDGET"""
+    workers = config['HASH_WORKERS'] or os.cpu_count() or 1
+    budget = config['HASH_MEMORY_BUDGET'] * 1024  # MiB to KiB
+    if budget:
+        workers = min(workers, budget // get_hasher().memory_cost)
+    return max(1, workers)
+
+
+def get_executor() -> HashExecutor:
+    global executor
+    if executor is None:
+        with _executor_lock:
+            if executor is None:
+                config = flask.current_app.config
+                executor = HashExecutor(workers=max_workers(config),
+                                        queue_size=config['HASH_QUEUE_SIZE'],
+                                        timeout=config['HASH_QUEUE_TIMEOUT'])
+    return executor
+
+
+def init_app(app:flask.Flask) -> None:
+    """Import argon2 and build the hasher, once, before any worker is forked"""
+    global _hasher
+    # argon2 is only imported here, so merely importing the package stays cheap
+    import argon2
+    # For arguments and possible config keys:
+    # https://argon2-cffi.readthedocs.io/en/stable/api.html#argon2.PasswordHasher
+    # https://argon2-cffi.readthedocs.io/en/stable/parameters.html
+    params = app.config.get_namespace('ARGON2_')
+    if app.config['HASH_CALIBRATE_MS'] > 0:
+        params.update(load_calibration(app.config['HASH_CALIBRATION'],
+                                       target=app.config['HASH_CALIBRATE_MS'] / 1000,
+                                       max_memory=app.config['HASH_CALIBRATE_MEMORY'],
+                                       parallelism=params.get('parallelism', 0)))
+    _hasher = argon2.PasswordHasher(**params)
+
+
+def calibrate(target:float, max_memory:int, parallelism:int=0,
+              rounds:int=3) -> t.Tuple[t.Dict[str, int], float]:
+    """Argon2 parameters taking about target seconds per verify on this machine
+
+    Memory cost starts at max_memory KiB, halved until a single pass fits the
+    target, then time cost is raised as far as the target allows. Parallelism
+    defaults to the CPU count, up to 4. Return the parameters and the median
+    verify time with them.
+    """
+    import argon2
+    parallelism = parallelism or min(4, os.cpu_count() or 1)
+    min_memory = 8 * parallelism  # Argon2 minimum
+
+    def measure(time_cost:int, memory_cost:int) -> float:
+        ph = argon2.PasswordHasher(time_cost=time_cost, memory_cost=memory_cost,
+                                   parallelism=parallelism)
+        hashed = ph.hash('calibration')
+        samples = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            ph.verify(hashed, 'calibration')
+            samples.append(time.perf_counter() - start)
+        return sorted(samples)[rounds // 2]
+
+    memory_cost = max(min_memory, max_memory)
+    seconds = measure(1, memory_cost)
+    while seconds > target and memory_cost > min_memory:
+        memory_cost = max(min_memory, memory_cost // 2)
+        seconds = measure(1, memory_cost)
+
+    # Time grows linearly with passes, so estimate it and then adjust
+    time_cost = max(1, int(target / seconds))
+    if time_cost > 1:
+        seconds = measure(time_cost, memory_cost)
+        while seconds > target and time_cost > 1:
+            time_cost -= 1
+            seconds = measure(time_cost, memory_cost)
+    while True:
+        more = measure(time_cost + 1, memory_cost)
+        if more > target:
+            break
+        time_cost, seconds = time_cost + 1, more
+
+    params = dict(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+    log.info("Argon2 calibrated for %.0fms: %s, %.1fms per verify",
+             1000 * target, params, 1000 * seconds)
+    return params, seconds
+
 
-def get_hasher() -> argon2.PasswordHasher:
-    if 'hasher' not in flask.g:
-        # For arguments and possible config keys:
-        # https://argon2-cffi.readthedocs.io/en/stable/api.html#argon2.PasswordHasher
-        # https://argon2-cffi.readthedocs.io/en/stable/parameters.html
-        config = flask.current_app.config.get_namespace('ARGON2_')
-        flask.g.hasher = argon2.PasswordHasher(**config)
-    return flask.g.hasher
+def load_calibration(path:str, target:float, max_memory:int,
+                     parallelism:int=0) -> t.Dict[str, int]:
+    """Parameters saved in path for the same settings, or calibrate and save them
 
+    Calibrating once per machine, instead of on every start, keeps all workers
+    and restarts on the same parameters, so hashes are not needlessly rehashed.
+    The file is locked, so concurrent workers wait for a single calibration.
+    """
+    settings = dict(target=target, max_memory=max_memory, parallelism=parallelism)
+    with open(path, 'a+') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            saved = json.load(f)
+        except ValueError:
+            saved = {}
+        if saved.get('settings') == settings:
+            return saved['params']
+        params, seconds = calibrate(target, max_memory, parallelism)
+        f.seek(0)
+        f.truncate()
+        json.dump(dict(settings=settings, params=params, seconds=seconds), f, indent=2)
+    log.info("Saved Argon2 calibration to %s", path)
+    return params
 
+
+def after_fork() -> None:
+    """Drop the executor inherited from the parent process, its threads are gone"""
+    global executor, _executor_lock, _verified_lock
+    executor = None
+    _executor_lock = threading.Lock()
+    _verified_lock = threading.Lock()
+
+
+def get_hasher() -> 'argon2.PasswordHasher':
+    if _hasher is None:
+        init_app(flask.current_app)
+    return _hasher
+
+
+@metrics.timed('argon2')
 def hash_password(password:str) -> str:
-    return get_hasher().hash(password)
+    return get_executor().run(get_hasher().hash, password)
+
+
+def hash_passwords(passwords:t.Iterable[str], workers:int=0) -> t.List[str]:
+    """Hash many passwords in parallel, for bulk operations outside requests
+
+    Uses its own pool of workers, max_workers() by default, instead of the
+    request executor and its queue limits.
+    """
+    workers = workers or max_workers(flask.current_app.config)
+    with concurrent.futures.ThreadPoolExecutor(workers,
+                                               thread_name_prefix='argon2-bulk') as pool:
+        return list(pool.map(get_hasher().hash, passwords))
+
+
+def is_hash(value:str) -> bool:
+    """Whether value is an Argon2 hash, such as exported by another install"""
+    import argon2
+    try:
+        argon2.extract_parameters(value)
+    except argon2.exceptions.InvalidHash:
+        return False
+    return True
 
 
+@metrics.timed('argon2')
 def verify(hashed:str, plain:str) -> bool:
+    import argon2
     try:
-        return get_hasher().verify(hashed, plain)
+        return get_executor().run(get_hasher().verify, hashed, plain)
     except argon2.exceptions.VerifyMismatchError:
         # No match, fail silently
         pass
@@ -44,4 +247,51 @@ def verify(hashed:str, plain:str) -> bool:
 
 
 def needs_update(hashed:str) -> bool:
+    # Only parses the hash parameters, no need for the executor, nor timing it
+    # along with actual hashes in the argon2 stage
     return get_hasher().check_needs_rehash(hashed)
+
+
+# -----------------------------------------------------------------------------
+def _credential_mac(hashed:str, *creds:str) -> bytes:
+    """Keyed digest of a stored hash and plain credentials, safe to keep in memory"""
+    key = flask.current_app.config.get('SECRET_KEY') or _secret
+    if isinstance(key, str):
+        key = key.encode()
+    return hmac.new(key, '\0'.join((hashed,) + creds).encode(), hashlib.sha256).digest()
+
+
+def verify_cached(hashed:str, plain:str, hostname:str, username:str) -> bool:
+    """Like verify(), but skip Argon2 for recently verified credentials
+
+    The stored hash is part of the digest, so a password change by any worker
+    also invalidates the entry, even before forget() is called.
+    """
+    config = flask.current_app.config
+    ttl = config['AUTH_CACHE_TTL']
+    if ttl <= 0:
+        return verify(hashed, plain)
+
+    mac = _credential_mac(hashed, hostname, username, plain)
+    now = time.monotonic()
+    with _verified_lock:
+        entry = _verified.get(hostname)
+        if entry and entry[1] > now and hmac.compare_digest(entry[0], mac):
+            _verified.move_to_end(hostname)
+            return True
+
+    if not verify(hashed, plain):
+        return False
+
+    with _verified_lock:
+        _verified[hostname] = (mac, now + ttl)
+        _verified.move_to_end(hostname)
+        while len(_verified) > config['AUTH_CACHE_SIZE']:
+            _verified.popitem(last=False)
+    return True
+
+
+def forget(hostname:str) -> None:
+    """Invalidate any cached verification for hostname"""
+    with _verified_lock:
+        _verified.pop(hostname, None)
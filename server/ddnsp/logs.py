@@ -0,0 +1,147 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Request logging, optionally structured and written by a background thread
+
+With LOG_QUEUE, records of the app logger are handed to a QueueListener,
+so the request thread never waits for log I/O. With LOG_STRUCTURED, each
+update is logged as a single key=value line instead of REQ and RES lines,
+and plain nochg replies are only counted, logged every LOG_NOCHG_INTERVAL
+seconds as a summary line.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import typing as t
+
+import flask
+
+from . import util as u
+
+
+log = logging.getLogger(__name__)
+
+listener:  t.Optional[logging.handlers.QueueListener] = None
+nochg:     t.Optional['NochgCounter'] = None
+_handlers: t.List[logging.Handler] = []  # original handlers, while queued
+_logger:   t.Optional[logging.Logger] = None
+_structured: bool = False
+
+
+class NochgCounter:
+    """Count nochg replies, logging a summary every interval seconds"""
+    def __init__(self, interval:float):
+        self.interval: float = interval
+        self.count: int = 0
+        self.hosts: t.Set[str] = set()
+        self._lock = threading.Lock()
+        self._thread = u.PeriodicThread(self.flush, interval, name='ddnsp-nochg-log')
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add(self, hostname:str) -> None:
+        with self._lock:
+            self.count += 1
+            self.hosts.add(hostname)
+
+    def flush(self) -> None:
+        with self._lock:
+            count, hosts = self.count, len(self.hosts)
+            self.count, self.hosts = 0, set()
+        if count:
+            log.info("nochg count=%s hosts=%s interval=%s", count, hosts, self.interval)
+
+    def close(self) -> None:
+        atexit.unregister(self.close)
+        self._thread.stop()
+        self.flush()
+
+
+def init_app(app:flask.Flask) -> None:
+    global _structured
+    stop()
+    _structured = app.config['LOG_STRUCTURED']
+
+
+def start(app:flask.Flask) -> None:
+    """Start the log writer and nochg counter threads of this process"""
+    global listener, nochg, _handlers, _logger
+    stop()
+    if _structured and app.config['LOG_NOCHG_INTERVAL'] > 0:
+        nochg = NochgCounter(app.config['LOG_NOCHG_INTERVAL'])
+    if not app.config['LOG_QUEUE'] or not app.logger.handlers:
+        return
+    _logger = app.logger
+    _handlers = _logger.handlers[:]
+    records: 'queue.SimpleQueue[logging.LogRecord]' = queue.SimpleQueue()
+    for handler in _handlers:
+        _logger.removeHandler(handler)
+    _logger.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(records, *_handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(stop)
+
+
+def stop() -> None:
+    """Write pending records and restore the original handlers"""
+    global listener, nochg
+    if nochg is not None:
+        nochg.close()
+        nochg = None
+    if listener is not None:
+        atexit.unregister(stop)
+        listener.stop()
+        listener = None
+        _restore()
+
+
+def _restore() -> None:
+    global _logger
+    if _logger is None:
+        return
+    for handler in _logger.handlers[:]:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            _logger.removeHandler(handler)
+    for handler in _handlers:
+        _logger.addHandler(handler)
+    _logger = None
+
+
+def after_fork() -> None:
+    """Drop the threads inherited from the parent process, logging directly again"""
+    global listener, nochg
+    if nochg is not None:
+        atexit.unregister(nochg.close)
+        nochg = None
+    if listener is not None:
+        atexit.unregister(stop)
+        listener = None
+        _restore()
+
+
+def structured() -> bool:
+    return _structured
+
+
+def log_update(params:t.Mapping[str, str], res:str, seconds:float) -> None:
+    """Log an update request and its reply as a single key=value line"""
+    if not log.isEnabledFor(logging.INFO):
+        return
+    if nochg is not None and all(line.startswith('nochg') for line in res.splitlines()):
+        nochg.add(params['hostname'])
+        return
+    log.info("update host=%s user=%s ip=%s reply=%s ms=%.2f",
+             _quote(params['hostname']), _quote(params['username']),
+             _quote(params['ip']), _quote(res.replace('\n', ';')), 1000 * seconds)
+
+
+def _quote(value:str) -> str:
+    if value.isprintable() and value and not any(c in value for c in ' "=\\'):
+        return value
+    return json.dumps(value)
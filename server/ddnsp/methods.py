@@ -7,13 +7,18 @@ Business logic methods
 
 import logging
 import re
+import typing as t
 
 import flask
 
 
 from . import dns
 from . import dao
+from . import flight
 from . import hasher
+from . import metrics
+from . import outbox
+from . import rehash
 from . import util as u
 
 
@@ -24,47 +29,152 @@ USERNAME_RE = re.compile(r'[\da-z][-_\da-z]*', re.ASCII)
 
 
 def update_ip(username, password, hostname, ip) -> str:
-    """Main method for updating IP"""
+    """Main method for updating IP, of one or more comma-separated hostnames
+
+    Concurrent identical requests share a single run and its reply, and
+    with UPDATE_LOCK its hostnames are locked across workers. See flight.
+    """
+    return flight.do((username, password, hostname, ip), _update_ip_locked,
+                     username, password, hostname, ip)
+
+
+def _update_ip_locked(username, password, hostname, ip) -> str:
+    # Same hostnames as check_args, malformed ones only lock an unused slot
+    with flight.locked(name.split('.', 1)[0].strip() for name in hostname.split(',')):
+        return _update_ip(username, password, hostname, ip)
+
+
+def _update_ip(username, password, hostname, ip) -> str:
+    """Update IP of one or more comma-separated hostnames
+
+    Reply one line per hostname, in the order given. All hosts are read in a
+    single query and written in a single transaction, the password is
+    verified once per distinct stored hash, and inline DNS changes are sent
+    as one batch. IP may be an IPv4, an IPv6 or both as 'v4,v6', updating
+    the A and/or AAAA records together.
+    """
     try:
         args = check_args(flask.current_app.config, locals())
-        hostname = args['hostname']
         username = args['username']
-        password = args['hostname']
+        password = args['password']
         ip       = args['ip']
+        ip6      = args['ip6']
     except u.DDNSPError as e:
         return str(e)
+    myip = ','.join(filter(None, (ip, ip6)))
 
-    data = dao.get_host(hostname)
-    if not data:
-        register(**args)
-        return f'good {ip}'
-
-    if not check_auth(data, **args):
-        return 'badauth'
-
-    dao.update_timestamp(hostname)
-
-    if ip == data['ip']:
-        return f'nochg {ip}'
-
+    hostnames = [name for name in dict.fromkeys(args['hostnames']) if name]
+    results: t.Dict[str, str] = {}
+    # One read, then at most one write transaction
+    data = dao.get_hosts(hostnames)
     try:
-        dns.update_ip(hostname, ip)
-        dao.update_ip(hostname, ip)
+        new = [name for name in hostnames if name not in data]
+        # Only new names are checked in full, so hosts and users registered
+        # by older versions, which only checked a valid prefix, keep working
+        if new and not USERNAME_RE.fullmatch(username):
+            results.update(dict.fromkeys(new, 'badauth'))
+        reserved = dns.get_api().reserved
+        results.update({name: 'nohost' for name in new
+                        if name not in results and (name in reserved or
+                                                    not HOSTNAME_RE.fullmatch(name))})
+        new = [name for name in new if name not in results]
+        if new:
+            results.update(register(username, password, new, ip, ip6))
+            # Lost registration races, authenticate against the winners
+            data.update(dao.get_hosts([name for name in new if name not in results]))
+
+        owned: t.List[str] = []
+        verified: t.Dict[t.Tuple[str, str], bool] = {}
+        for hostname in (name for name in hostnames if name in data):
+            row = data[hostname]
+            key = (row['username'], row['password'])
+            if key not in verified:
+                verified[key] = check_auth(row, username=username, password=password)
+            if verified[key]:
+                owned.append(hostname)
+            else:
+                results[hostname] = 'badauth'
+
+        # Outdated hashes are rehashed in the background, the hosts sharing
+        # one will then share the new one
+        for hashed in {data[hostname]['password'] for hostname in owned}:
+            if hasher.needs_update(hashed):
+                rehash.submit(hashed, password, [hostname for hostname in owned
+                                                 if data[hostname]['password'] == hashed])
+    except u.DDNSPBusyError as e:
+        log.warning(e)
+        return '911'
+
+    changes: t.Dict[str, t.List[str]] = {}
+    for hostname in owned:
+        changed = [new for new, old in ((ip, data[hostname]['ip']),
+                                        (ip6, data[hostname]['ip6']))
+                   if new and new != old]
+        if changed:
+            changes[hostname] = changed
+    errors: dns.Errors = {}
+    if changes and not outbox.enabled():
+        errors = update_dns(changes)
+    updates: t.Dict[str, t.Tuple[t.Optional[str], t.Optional[str], t.Optional[str]]] = {}
+    for hostname in owned:
+        new_ips: t.Tuple[t.Optional[str], t.Optional[str]] = (None, None)
+        if hostname not in changes:
+            results[hostname] = f'nochg {myip}'
+        elif errors.get(hostname) is None:
+            new_ips = (ip, ip6)
+            results[hostname] = f'good {myip}'
+        else:
+            log.error("Failed updating DNS for %s: %s", hostname, errors[hostname])
+            results[hostname] = 'dnserr'
+        updates[hostname] = (*new_ips, None)
+
+    dao.update_hosts(updates, outbox=outbox.enabled())
+    if changes:
+        outbox.wake()
+    return '\n'.join(results.get(name, 'nohost') for name in args['hostnames'])
+
+
+def update_dns(hosts:t.Dict[str, t.List[str]]) -> dns.Errors:
+    """Update DNS of {hostname: [ip, ...]} now, returning the error, if any, for each"""
+    if len(hosts) == 1:
+        (hostname, ips), = hosts.items()
+        try:
+            dns.update_ip(hostname, *ips)
+        except u.DDNSPError as e:
+            return {hostname: e}
+        return {hostname: None}
+    try:
+        return dns.update_ips(hosts)
     except u.DDNSPError as e:
-        return 'dnserr'
+        return dict.fromkeys(hosts, e)
+
 
-    return f'good {ip}'
+def split_hostnames(hostname:str) -> t.List[str]:
+    """Hostnames of a comma-separated list, without their domain"""
+    return [name.split('.', 1)[0].strip() for name in hostname.split(',')]
 
 
+@metrics.timed('check_args')
 def check_args(config:flask.Config, args:dict) -> dict:
-    """Check for required and well-formed arguments"""
+    """Check for required and well-formed arguments
+
+    Hostname may be a comma-separated list, returned as the hostnames list,
+    where the malformed ones are replaced by an empty string.
+    """
     data = args.copy()
-    hostname = args.get('hostname', '').split('.', 1)[0].strip()
+    hostnames = split_hostnames(args.get('hostname', ''))
     username = args.get('username', '').strip()
     password = args.get('password', '').strip()
 
-    if not ((0 < len(hostname) <= config['HOSTNAME_MAX_LENGTH']) and
-            HOSTNAME_RE.match(hostname)):
+    if len(hostnames) > config['HOSTNAME_MAX_COUNT']:
+        raise u.DDNSPError("numhost")
+
+    # Only a valid prefix, as older versions did, names of new hosts are then
+    # checked in full by the update
+    hostnames = [name if ((0 < len(name) <= config['HOSTNAME_MAX_LENGTH']) and
+                          HOSTNAME_RE.match(name)) else ''
+                 for name in hostnames]
+    if not any(hostnames):
         raise u.DDNSPError("nohost")
 
     if not ((0 < len(username) <= config['USERNAME_MAX_LENGTH']) and
@@ -75,29 +185,48 @@ def check_args(config:flask.Config, args:dict) -> dict:
             config['PASSWORD_MAX_LENGTH']):
         raise u.DDNSPError("badauth")
 
-    if not u.is_ipv4(args['ip']):
+    ip, ip6 = u.parse_ips(args['ip'])
+    if not (ip or ip6):
         raise u.DDNSPError("badagent")  # no good choices for bad arguments
 
-    data['hostname'] = hostname
+    data['hostnames'] = hostnames
+    data['ip'] = ip
+    data['ip6'] = ip6
     data['username'] = username
     data['password'] = password
     return data
 
 
-def register(username, password, hostname, ip) -> None:
-    """Register a new hostname in Database and DNS"""
-    password = hasher.hash_password(password)
-    dns.update_ip(hostname=hostname, ip=ip)
-    dao.add_host(**locals())
-
+def register(username, password, hostnames, ip, ip6=None) -> t.Dict[str, str]:
+    """Register new hostnames in Database and DNS, sharing a single hash
+
+    Return the reply for each hostname registered, omitting the ones taken
+    meanwhile. Rows are inserted first to claim the hostnames, so concurrent
+    registrations do not both reach DNS. If DNS fails the host is kept
+    with no IP, so the client can retry and authenticate as the owner.
+    With the outbox, the DNS changes are queued along with the new rows.
+    """
+    ips = [address for address in (ip, ip6) if address]
+    myip = ','.join(ips)
+    added = dao.add_hosts(username=username, password=hasher.hash_password(password),
+                          hosts=dict.fromkeys(hostnames, (ip, ip6)), outbox=outbox.enabled())
+    if added and outbox.enabled():
+        outbox.wake()
+        return {hostname: f'good {myip}' for hostname in added}
+    results: t.Dict[str, str] = {}
+    for hostname, error in (update_dns(dict.fromkeys(added, ips)) if added else {}).items():
+        if error is None:
+            results[hostname] = f'good {myip}'
+            continue
+        log.error("Failed updating DNS for %s: %s", hostname, error)
+        dao.update_ip(hostname, None, None)
+        results[hostname] = 'dnserr'
+    return results
+
+
+def check_auth(data, username:str, password:str) -> bool:
+    """Check authentication data against supplied credentials"""
+    return (data['username'] == username and
+            hasher.verify_cached(data['password'], password,
+                                 data['hostname'], data['username']))
 
-def check_auth(data, **args) -> bool:
-    """Check authentication data against supplied args"""
-    password = args['password']
-    hashed   = data['password']
-    if not (all(data[k] == args[k] for k in ('hostname', 'username')) and
-            hasher.verify(hashed, password)):
-        return False
-    if hasher.needs_update(hashed):
-        dao.update_password(data['hostname'], hasher.hash_password(password))
-    return True
@@ -0,0 +1,164 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Latency histograms and counters, exposed in Prometheus text format
+
+Metrics are kept in memory by each worker process, so scrape each worker, or
+run a single one, to see them all.
+"""
+
+import bisect
+import functools
+import threading
+import time
+import typing as t
+
+import flask
+
+
+F = t.TypeVar('F', bound=t.Callable[..., t.Any])
+Labels: 't.TypeAlias' = t.Tuple[t.Tuple[str, str], ...]
+
+# {name: (type, help)}
+METRICS: t.Dict[str, t.Tuple[str, str]] = {
+    'ddnsp_update_duration_seconds': (
+        'histogram', "Update request latency, by reply code"),
+    'ddnsp_stage_duration_seconds':  (
+        'histogram', "Latency of each stage of the update path, by operation"),
+    'ddnsp_updates_total':           (
+        'counter',   "Updated hosts, by dyndns2 reply code"),
+    'ddnsp_dns_errors_total':        (
+        'counter',   "Failed DNS backend changes, by backend and error"),
+    'ddnsp_updates_coalesced_total': (
+        'counter',   "Update requests sharing the reply of a concurrent identical one"),
+}
+
+registry: t.Optional['Registry'] = None
+
+
+class Registry:
+    """Thread-safe store of labelled histograms and counters"""
+    def __init__(self, buckets:t.Iterable[float]):
+        self.buckets: t.Tuple[float, ...] = tuple(sorted(buckets))
+        # {name: {labels: [bucket counts..., +Inf count, sum]}}
+        self.histograms: t.Dict[str, t.Dict[Labels, t.List[float]]] = {}
+        self.counters:   t.Dict[str, t.Dict[Labels, float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name:str, value:float, **labels:str) -> None:
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            data = series.get(key)
+            if data is None:
+                data = series[key] = [0] * (len(self.buckets) + 2)
+            data[i] += 1
+            data[-1] += value
+
+    def inc(self, name:str, value:float=1, **labels:str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def render(self, gauges:t.Optional[t.Dict[str, t.Tuple[str, float]]]=None) -> str:
+        """Prometheus text exposition of all metrics, plus {name: (help, value)} gauges"""
+        lines: t.List[str] = []
+
+        def header(name, kind, text):
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            histograms = {k: {lk: list(v) for lk, v in s.items()}
+                          for k, s in self.histograms.items()}
+            counters = {k: dict(s) for k, s in self.counters.items()}
+
+        for name, (kind, text) in METRICS.items():
+            if kind == 'histogram' and name in histograms:
+                header(name, kind, text)
+                for labels, data in sorted(histograms[name].items()):
+                    total = 0
+                    for bound, count in zip(self.buckets + (float('inf'),), data):
+                        total += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{name}_bucket{_labels(labels, le=le)} {total}')
+                    lines.append(f'{name}_sum{_labels(labels)} {data[-1]!r}')
+                    lines.append(f'{name}_count{_labels(labels)} {total}')
+            elif kind == 'counter' and name in counters:
+                header(name, kind, text)
+                for labels, value in sorted(counters[name].items()):
+                    lines.append(f'{name}{_labels(labels)} {value!r}')
+        for name, (text, value) in (gauges or {}).items():
+            header(name, 'gauge', text)
+            lines.append(f'{name} {value!r}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels:Labels, **extra:str) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in items) + '}'
+
+
+def init_app(app:flask.Flask) -> None:
+    global registry
+    registry = None
+    if app.config['METRICS_ENABLED']:
+        registry = Registry(app.config['METRICS_BUCKETS'])
+
+
+def enabled() -> bool:
+    return registry is not None
+
+
+def timed(stage:str) -> t.Callable[[F], F]:
+    """Decorator recording the duration of each call in the stage histogram
+
+    When metrics are disabled the cost is a single global lookup per call.
+    """
+    def decorator(func:F) -> F:
+        op = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if registry is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.observe('ddnsp_stage_duration_seconds',
+                                 time.perf_counter() - start, stage=stage, op=op)
+        return t.cast(F, wrapper)
+    return decorator
+
+
+def observe_update(res:str, seconds:float) -> None:
+    if registry is None:
+        return
+    codes = [line.split(' ', 1)[0] for line in res.splitlines()]
+    for code in codes:
+        registry.inc('ddnsp_updates_total', code=code)
+    # Multi-host requests are labelled by their first reply
+    registry.observe('ddnsp_update_duration_seconds', seconds, code=codes[0])
+
+
+def coalesced() -> None:
+    if registry is not None:
+        registry.inc('ddnsp_updates_coalesced_total')
+
+
+def dns_error(backend:str, error:BaseException) -> None:
+    if registry is not None:
+        registry.inc('ddnsp_dns_errors_total', backend=backend,
+                     error=type(error).__name__)
+
+
+def render(gauges:t.Optional[t.Dict[str, t.Tuple[str, float]]]=None) -> str:
+    return registry.render(gauges) if registry is not None else ''
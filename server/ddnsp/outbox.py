@@ -0,0 +1,130 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Asynchronous DNS propagation from the outbox table
+"""
+
+import atexit
+import logging
+import time
+import typing as t
+
+import flask
+
+from . import dao
+from . import dns
+from . import metrics
+from . import util as u
+
+
+log = logging.getLogger(__name__)
+
+dispatcher: t.Optional['Dispatcher'] = None
+_enabled:   bool = False
+
+
+class Dispatcher:
+    """Background thread pushing queued DNS changes to the backend
+
+    Changes are claimed with a lease, so several worker processes can run a
+    dispatcher each without sending the same change twice. Failed changes are
+    retried with exponential backoff, and a newer change for the same host
+    replaces the pending one. When woken up, it waits window seconds so that
+    changes arriving together are sent in bulk.
+    """
+    def __init__(self, app:flask.Flask, interval:float, batch_size:int,
+                 lease:float, backoff_max:float, window:float=0):
+        self.app:         flask.Flask = app
+        self.interval:    float       = interval
+        self.batch_size:  int         = batch_size
+        self.lease:       float       = lease
+        self.backoff_max: float       = backoff_max
+        self.window:      float       = window
+        self._thread = u.PeriodicThread(self.dispatch, interval, name='ddnsp-outbox')
+        self._thread.start()
+        atexit.register(self.close)
+
+    def wake(self) -> None:
+        self._thread.wake()
+
+    def dispatch(self) -> None:
+        if self.window > 0:
+            time.sleep(self.window)  # let concurrent changes pile up
+        with self.app.app_context():
+            while True:
+                rows = dao.claim_outbox(limit=self.batch_size, lease=self.lease)
+                if not rows:
+                    return
+                self.send(rows)
+
+    def send(self, rows:t.List[dao.Row]) -> None:
+        errors: dns.Errors = {}
+        updates = {row['hostname']: [ip for ip in (row['ip'], row['ip6']) if ip]
+                   for row in rows if row['ip'] or row['ip6']}
+        deletes = [row['hostname'] for row in rows if not (row['ip'] or row['ip6'])]
+        for func, hosts in ((dns.update_ips, updates), (dns.delete_ips, deletes)):
+            if not hosts:
+                continue
+            try:
+                errors.update(func(hosts))
+            except u.DDNSPError as e:
+                metrics.dns_error(dns.get_api().backend, e)
+                errors.update(dict.fromkeys(hosts, e))
+        for row in rows:
+            error = errors.get(row['hostname'])
+            if error is None:
+                dao.done_outbox(row['hostname'], row['version'])
+                continue
+            delay = min(self.interval * 2 ** row['attempts'], self.backoff_max)
+            log.error("Failed sending DNS change for %s, retry in %.0f seconds: %s",
+                      row['hostname'], delay, error)
+            dao.retry_outbox(row['hostname'], row['version'], error, delay)
+
+    def close(self) -> None:
+        atexit.unregister(self.close)
+        self._thread.stop()
+
+
+def init_app(app:flask.Flask) -> None:
+    global dispatcher, _enabled
+    if dispatcher is not None:
+        dispatcher.close()
+        dispatcher = None
+    _enabled = app.config['OUTBOX_ENABLED']
+
+
+def start(app:flask.Flask) -> None:
+    """Start the dispatcher thread of this process"""
+    global dispatcher
+    if dispatcher is not None:
+        dispatcher.close()
+        dispatcher = None
+    if not _enabled:
+        return
+    dispatcher = Dispatcher(app,
+                            interval=app.config['OUTBOX_INTERVAL'],
+                            batch_size=app.config['OUTBOX_BATCH_SIZE'],
+                            lease=app.config['OUTBOX_LEASE'],
+                            backoff_max=app.config['OUTBOX_BACKOFF_MAX'],
+                            window=app.config['DNS_BATCH_WINDOW'])
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def wake() -> None:
+    """Hint the dispatcher that a change was just queued"""
+    if dispatcher is not None:
+        dispatcher.wake()
+
+
+def status() -> dict:
+    row = dao.outbox_status()
+    return {
+        'depth':        row['depth'],
+        'failing':      row['failing'],
+        'max_attempts': row['max_attempts'] or 0,
+        'lag':          round(time.time() - row['oldest'], 3) if row['oldest'] else 0,
+    }
@@ -0,0 +1,108 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+In-memory rate limiting of update requests
+"""
+
+import collections
+import logging
+import threading
+import time
+import typing as t
+
+import flask
+
+
+log = logging.getLogger(__name__)
+
+KEYS = ('ip', 'hostname', 'username')
+
+limiters: t.Dict[str, 'TokenBuckets'] = {}
+
+
+class TokenBuckets:
+    """Token buckets for many keys, in a bounded least-recently-used map
+
+    Each key may spend up to burst tokens at once, refilled at rate tokens per
+    second. Buckets idle long enough to be full again are indistinguishable
+    from new ones, so they are evicted, as are the oldest ones beyond max_keys.
+    """
+    def __init__(self, rate:float, burst:float, max_keys:int):
+        self.rate:     float = rate
+        self.burst:    float = burst
+        self.max_keys: int   = max_keys
+        self.idle:     float = burst / rate
+        # {key: (tokens, last update)}
+        self._buckets: 't.OrderedDict[str, t.Tuple[float, float]]' = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _tokens(self, key:str, now:float) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.burst
+        return min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+    def check(self, key:str) -> bool:
+        """If key has a token left, without spending it"""
+        with self._lock:
+            return self._tokens(key, time.monotonic()) >= 1
+
+    def spend(self, key:str) -> None:
+        """Spend a token for key, if it has one left"""
+        now = time.monotonic()
+        with self._lock:
+            tokens = self._tokens(key, now)
+            self._buckets.pop(key, None)
+            self._buckets[key] = (max(tokens - 1, 0), now)
+            self._evict(now)
+
+    def _evict(self, now:float) -> None:
+        buckets = self._buckets
+        while len(buckets) > self.max_keys:
+            buckets.popitem(last=False)
+        while buckets:
+            key, (_, last) = next(iter(buckets.items()))
+            if now - last < self.idle:
+                break
+            del buckets[key]
+
+
+def init_app(app:flask.Flask) -> None:
+    limiters.clear()
+    if not app.config['RATELIMIT_ENABLED']:
+        return
+    for key in KEYS:
+        per_minute = app.config[f'RATELIMIT_{key.upper()}_PER_MINUTE']
+        if per_minute > 0:
+            limiters[key] = TokenBuckets(rate=per_minute / 60,
+                                         burst=app.config[f'RATELIMIT_{key.upper()}_BURST'],
+                                         max_keys=app.config['RATELIMIT_MAX_KEYS'])
+
+
+def allow(**keys:t.Union[None, str, t.Iterable[str]]) -> bool:
+    """Check, and spend, the limits of each key=value, such as ip='1.2.3.4'
+
+    Value may also be several ones, such as the hostnames of a request, each
+    with its own limit. Tokens are only spent if all limits allow it, so a
+    request refused by one does not drain the others.
+    """
+    buckets: t.List[t.Tuple[str, TokenBuckets, str]] = []
+    for key, limiter in limiters.items():
+        values = keys.get(key) or ()
+        if isinstance(values, str):
+            values = (values,)
+        buckets.extend((key, limiter, value) for value in
+                       sorted({value.strip().lower() for value in values} - {''}))
+    allowed = True
+    for key, limiter, value in buckets:
+        if not limiter.check(value):
+            log.warning("Rate limit exceeded for %s: %s", key, value)
+            allowed = False
+    if allowed:
+        for _, limiter, value in buckets:
+            limiter.spend(value)
+    return allowed
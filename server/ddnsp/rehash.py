@@ -0,0 +1,113 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Background rehash of passwords hashed with outdated Argon2 parameters
+"""
+
+import atexit
+import collections
+import logging
+import threading
+import typing as t
+
+import flask
+
+from . import dao
+from . import hasher
+from . import util as u
+
+
+log = logging.getLogger(__name__)
+
+rehasher: t.Optional['Rehasher'] = None
+
+
+class Rehasher:
+    """Background thread rehashing verified passwords, one at a time
+
+    Update requests only queue them, so clients never wait for a second
+    Argon2 run. Hashes still share the request executor and its memory
+    budget. A new hash is only stored for hosts still having the old one,
+    so a password changed meanwhile is never overwritten. Queued passwords
+    are kept in memory only, up to queue_size, the others are rehashed on
+    a later update.
+    """
+    def __init__(self, app:flask.Flask, queue_size:int, interval:float):
+        self.app:        flask.Flask = app
+        self.queue_size: int         = queue_size
+        # {old hash: (password, hostnames)}
+        self._pending: 't.OrderedDict[str, t.Tuple[str, t.Set[str]]]' = \
+            collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = u.PeriodicThread(self.run, interval, name='ddnsp-rehash')
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, hashed:str, password:str, hostnames:t.Iterable[str]) -> bool:
+        """Queue a rehash of the hostnames having hashed, False if queue is full"""
+        with self._lock:
+            entry = self._pending.get(hashed)
+            if entry is not None:
+                entry[1].update(hostnames)
+            elif len(self._pending) < self.queue_size:
+                self._pending[hashed] = (password, set(hostnames))
+            else:
+                return False
+        self._thread.wake()
+        return True
+
+    def run(self) -> None:
+        while True:
+            with self._lock:
+                if not self._pending:
+                    return
+                hashed, (password, hostnames) = self._pending.popitem(last=False)
+            with self.app.app_context():
+                try:
+                    # Not hasher.hash_password(), so the argon2 stage only
+                    # times the hashes requests wait for
+                    new = hasher.get_executor().run(hasher.get_hasher().hash, password)
+                except u.DDNSPBusyError as e:
+                    # Requests come first, retry on the next interval
+                    log.debug("Postponing rehash: %s", e)
+                    with self._lock:
+                        self._pending.setdefault(hashed, (password, set()))[1].update(hostnames)
+                    return
+                done = dao.replace_password(sorted(hostnames), hashed, new)
+            if done:
+                log.info("Rehashed password of %s", ', '.join(done))
+
+    def close(self) -> None:
+        atexit.unregister(self.close)
+        self._thread.stop()
+
+
+def init_app(app:flask.Flask) -> None:
+    global rehasher
+    if rehasher is not None:
+        rehasher.close()
+        rehasher = None
+
+
+def start(app:flask.Flask) -> None:
+    """Start the rehash thread of this process"""
+    global rehasher
+    init_app(app)
+    rehasher = Rehasher(app,
+                        queue_size=app.config['HASH_REHASH_QUEUE_SIZE'],
+                        interval=app.config['HASH_REHASH_INTERVAL'])
+
+
+def after_fork() -> None:
+    """Drop the rehasher inherited from the parent process, its thread is gone"""
+    global rehasher
+    if rehasher is not None:
+        atexit.unregister(rehasher.close)
+        rehasher = None
+
+
+def submit(hashed:str, password:str, hostnames:t.Iterable[str]) -> None:
+    """Queue a rehash, if running, otherwise it is tried on a later update"""
+    if rehasher is not None and not rehasher.submit(hashed, password, hostnames):
+        log.debug("Rehash queue full, skipping %s", ', '.join(hostnames))
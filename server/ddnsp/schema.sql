@@ -1,10 +1,28 @@
-DROP TABLE IF EXISTS host;
+-- Idempotent, also run on existing databases to add new tables and indexes
 
-CREATE TABLE host (
+CREATE TABLE IF NOT EXISTS host (
 	id INTEGER PRIMARY KEY AUTOINCREMENT,
 	username TEXT      NOT NULL,
 	password TEXT      NOT NULL,
 	hostname TEXT      NOT NULL UNIQUE,
 	ip       TEXT,
+	ip6      TEXT,
 	changed  TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
+
+-- For expiring inactive hosts without a full table scan
+CREATE INDEX IF NOT EXISTS host_changed ON host (changed);
+
+-- Pending DNS changes, at most one per hostname, latest IP wins.
+-- NULL ip and ip6 removes the host records.
+-- Times are Unix epoch, version is bumped on every change.
+CREATE TABLE IF NOT EXISTS outbox (
+	hostname TEXT    PRIMARY KEY,
+	ip       TEXT,
+	ip6      TEXT,
+	version  INTEGER NOT NULL DEFAULT 1,
+	queued   REAL    NOT NULL,
+	next_try REAL    NOT NULL,
+	attempts INTEGER NOT NULL DEFAULT 0,
+	error    TEXT
+);
@@ -5,15 +5,20 @@
 Miscellaneous functions and classes.
 """
 
+import logging
+import socket
+import threading
 import typing as t
 
-import requests
 
+log = logging.getLogger(__name__)
 
 # For the purposes of REST APIs only!
 JsonDict: 't.TypeAlias' = t.Dict[str, t.Any]
 Json:     't.TypeAlias' = t.Union[JsonDict, t.List[JsonDict]]
 
+IPV4_MAPPED_PREFIX = bytes(10) + b'\xff\xff'  # ::ffff:0:0/96
+
 
 class DDNSPError(Exception):
     """Base class for custom exceptions, with errno and %-formatting for args.
@@ -28,8 +33,8 @@ class DDNSPError(Exception):
         self.errno = errno
 
 
-class DDNSPRequestError(DDNSPError, requests.RequestException):
-    """HTTP Request error"""
+class DDNSPBusyError(DDNSPError):
+    """Server is overloaded and request should be retried later"""
 
 
 # noinspection PyPep8Naming
@@ -42,6 +47,34 @@ class classproperty:
         return self.fget(owner_cls)
 
 
+class PeriodicThread(threading.Thread):
+    """Daemon thread calling func every interval seconds, or when woken up"""
+    def __init__(self, func:t.Callable[[], t.Any], interval:float, name:str=None):
+        super().__init__(name=name, daemon=True)
+        self.func:     t.Callable      = func
+        self.interval: float           = interval
+        self._wakeup:  threading.Event = threading.Event()
+        self._stopped: threading.Event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.func()
+            except Exception as e:
+                log.exception("Error in %s: %s", self.name, e)
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def stop(self, timeout:float=None) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
 def obfuscate(d:dict, keys:list=None) -> dict:
     if keys is None:
         keys = ['password']
@@ -49,11 +82,44 @@ def obfuscate(d:dict, keys:list=None) -> dict:
 
 
 def is_ipv4(address:str) -> bool:
-    # Alternatives:
-    # - ipaddress.ip_address(address)
-    # - socket.inet_aton(address)
+    # inet_pton() is strict, unlike inet_aton() which takes '1' or '0x7f.1',
+    # and much faster than ipaddress.ip_address() or split() and int()
     try:
-        octets = address.split('.')
-        return 4 == len(octets) == len([b for b in octets if 0 <= int(b) <= 255])
-    except ValueError:
+        socket.inet_pton(socket.AF_INET, address)
+        return True
+    except (OSError, ValueError):
         return False
+
+
+def parse_ips(value:str) -> t.Tuple[t.Optional[str], t.Optional[str]]:
+    """IPv4 and IPv6 addresses, either may be None, from 'v4', 'v6' or 'v4,v6'
+
+    IPv6 is normalized to its compressed form, and an IPv4-mapped IPv6 such
+    as '::ffff:192.0.2.1', as seen on dual-stack sockets, is taken as IPv4.
+    Return (None, None) if value is malformed or has two of the same family.
+    """
+    ipv4: t.Optional[str] = None
+    ipv6: t.Optional[str] = None
+    addresses = value.split(',')
+    if len(addresses) > 2:
+        return None, None
+    for address in addresses:
+        address = address.strip()
+        if is_ipv4(address):
+            if ipv4:
+                return None, None
+            ipv4 = address
+            continue
+        try:
+            packed = socket.inet_pton(socket.AF_INET6, address)
+        except (OSError, ValueError):
+            return None, None
+        if packed[:12] == IPV4_MAPPED_PREFIX:
+            if ipv4:
+                return None, None
+            ipv4 = socket.inet_ntop(socket.AF_INET, packed[12:])
+        elif ipv6:
+            return None, None
+        else:
+            ipv6 = socket.inet_ntop(socket.AF_INET6, packed)
+    return ipv4, ipv6
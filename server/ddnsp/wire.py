@@ -0,0 +1,261 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Minimal DNS wire format: messages, resource records and TSIG signatures
+
+Just enough of RFC 1035, RFC 2136 and RFC 8945 for dynamic updates and a
+small authoritative responder, without external dependencies.
+"""
+
+import hashlib
+import hmac
+import socket
+import struct
+import time
+import typing as t
+
+from . import util as u
+
+
+TYPE_A     = 1
+TYPE_NS    = 2
+TYPE_SOA   = 6
+TYPE_AAAA  = 28
+TYPE_TSIG  = 250
+TYPE_ANY   = 255
+
+CLASS_IN   = 1
+CLASS_NONE = 254
+CLASS_ANY  = 255
+
+OPCODE_QUERY  = 0
+OPCODE_UPDATE = 5
+
+RCODE_NOERROR  = 0
+RCODE_FORMERR  = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP   = 4
+RCODE_REFUSED  = 5
+RCODE_NOTAUTH  = 9
+
+RCODES = ('NOERROR', 'FORMERR', 'SERVFAIL', 'NXDOMAIN', 'NOTIMP', 'REFUSED',
+          'YXDOMAIN', 'YXRRSET', 'NXRRSET', 'NOTAUTH', 'NOTZONE')
+
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+
+TSIG_ALGORITHMS: t.Dict[str, t.Callable] = {
+    'hmac-md5.sig-alg.reg.int': hashlib.md5,
+    'hmac-sha1':                hashlib.sha1,
+    'hmac-sha256':              hashlib.sha256,
+    'hmac-sha512':              hashlib.sha512,
+}
+
+HEADER = struct.Struct('!HHHHHH')  # id, flags, qd, an/pr/zo, ns/up, ar
+
+
+class DNSWireError(u.DDNSPError):
+    """Malformed DNS message or failed TSIG verification"""
+
+
+class RR(t.NamedTuple):
+    name:   str
+    rtype:  int
+    rclass: int
+    ttl:    int
+    rdata:  bytes
+    offset: int  # start of this RR in message, to strip TSIG
+
+
+class Message(t.NamedTuple):
+    id:         int
+    flags:      int
+    questions:  t.List[t.Tuple[str, int, int]]
+    answers:    t.List[RR]
+    authority:  t.List[RR]
+    additional: t.List[RR]
+
+    @property
+    def opcode(self) -> int:
+        return (self.flags >> 11) & 0xF
+
+    @property
+    def rcode(self) -> int:
+        return self.flags & 0xF
+
+
+def rcode_text(rcode:int) -> str:
+    return RCODES[rcode] if rcode < len(RCODES) else str(rcode)
+
+
+# -----------------------------------------------------------------------------
+def encode_name(name:str) -> bytes:
+    out = bytearray()
+    for label in name.strip('.').split('.'):
+        if not label:
+            continue
+        data = label.encode('idna' if not label.isascii() else 'ascii')
+        if len(data) > 63:
+            raise DNSWireError("Label too long: %s", label)
+        out.append(len(data))
+        out += data
+    out.append(0)
+    return bytes(out)
+
+
+def decode_name(data:bytes, offset:int) -> t.Tuple[str, int]:
+    """Return the name at offset and the offset right after it"""
+    labels: t.List[str] = []
+    end = 0
+    jumps = 0
+    try:
+        while True:
+            length = data[offset]
+            if length & 0xC0 == 0xC0:  # compression pointer
+                if not end:
+                    end = offset + 2
+                offset = ((length & 0x3F) << 8) | data[offset + 1]
+                jumps += 1
+                if jumps > 64:
+                    raise DNSWireError("Compression loop in name")
+                continue
+            offset += 1
+            if not length:
+                break
+            labels.append(data[offset:offset + length].decode('ascii', 'replace'))
+            offset += length
+    except IndexError:
+        raise DNSWireError("Truncated name")
+    return '.'.join(labels), (end or offset)
+
+
+def pack_rr(name:t.Union[str, bytes], rtype:int, rclass:int, ttl:int,
+            rdata:bytes=b'') -> bytes:
+    if isinstance(name, str):
+        name = encode_name(name)
+    return name + struct.pack('!HHIH', rtype, rclass, ttl, len(rdata)) + rdata
+
+
+def pack_question(name:str, qtype:int, qclass:int=CLASS_IN) -> bytes:
+    return encode_name(name) + struct.pack('!HH', qtype, qclass)
+
+
+def address_rdata(ip:str) -> t.Tuple[int, bytes]:
+    """Record type and rdata for an IPv4 or IPv6 address"""
+    if ':' in ip:
+        return TYPE_AAAA, socket.inet_pton(socket.AF_INET6, ip)
+    return TYPE_A, socket.inet_pton(socket.AF_INET, ip)
+
+
+def parse(data:bytes) -> Message:
+    if len(data) < HEADER.size:
+        raise DNSWireError("Message too short: %s bytes", len(data))
+    msgid, flags, qd, an, ns, ar = HEADER.unpack_from(data)
+    offset = HEADER.size
+    questions = []
+    for _ in range(qd):
+        name, offset = decode_name(data, offset)
+        if offset + 4 > len(data):
+            raise DNSWireError("Truncated question")
+        qtype, qclass = struct.unpack_from('!HH', data, offset)
+        offset += 4
+        questions.append((name, qtype, qclass))
+    sections: t.List[t.List[RR]] = []
+    for count in (an, ns, ar):
+        rrs = []
+        for _ in range(count):
+            start = offset
+            name, offset = decode_name(data, offset)
+            if offset + 10 > len(data):
+                raise DNSWireError("Truncated resource record")
+            rtype, rclass, ttl, rdlen = struct.unpack_from('!HHIH', data, offset)
+            offset += 10
+            rdata = data[offset:offset + rdlen]
+            if len(rdata) != rdlen:
+                raise DNSWireError("Truncated resource record data")
+            offset += rdlen
+            rrs.append(RR(name, rtype, rclass, ttl, rdata, start))
+        sections.append(rrs)
+    return Message(msgid, flags, questions, *sections)
+
+
+# -----------------------------------------------------------------------------
+# TSIG, RFC 8945
+def _tsig_variables(key_name:str, algorithm:str, time_signed:int, fudge:int,
+                    error:int=0, other:bytes=b'') -> bytes:
+    return (encode_name(key_name.lower()) + struct.pack('!HI', CLASS_ANY, 0) +
+            encode_name(algorithm.lower()) +
+            struct.pack('!HIHHH', time_signed >> 32, time_signed & 0xFFFFFFFF,
+                        fudge, error, len(other)) + other)
+
+
+def _tsig_mac(secret:bytes, algorithm:str, *parts:bytes) -> bytes:
+    try:
+        digest = TSIG_ALGORITHMS[algorithm.lower()]
+    except KeyError:
+        raise DNSWireError("Unsupported TSIG algorithm: %s", algorithm)
+    return hmac.new(secret, b''.join(parts), digest).digest()
+
+
+def tsig_sign(message:bytes, key_name:str, secret:bytes, algorithm:str,
+              fudge:int=300, request_mac:bytes=b'') -> t.Tuple[bytes, bytes]:
+    """Append a TSIG record to message, return the signed message and its MAC
+
+    request_mac is given when signing a response to a signed request.
+    """
+    time_signed = int(time.time())
+    prefix = struct.pack('!H', len(request_mac)) + request_mac if request_mac else b''
+    mac = _tsig_mac(secret, algorithm, prefix, message,
+                    _tsig_variables(key_name, algorithm, time_signed, fudge))
+    msgid = struct.unpack_from('!H', message)[0]
+    rdata = (encode_name(algorithm.lower()) +
+             struct.pack('!HIHH', time_signed >> 32, time_signed & 0xFFFFFFFF,
+                         fudge, len(mac)) + mac +
+             struct.pack('!HHH', msgid, 0, 0))
+    header = bytearray(message[:HEADER.size])
+    arcount = struct.unpack_from('!H', header, 10)[0]
+    struct.pack_into('!H', header, 10, arcount + 1)
+    signed = (bytes(header) + message[HEADER.size:] +
+              pack_rr(key_name, TYPE_TSIG, CLASS_ANY, 0, rdata))
+    return signed, mac
+
+
+def tsig_verify(data:bytes, message:Message, key_name:str, secret:bytes,
+                algorithm:str, request_mac:bytes=b'') -> None:
+    """Verify the TSIG record of a parsed message, raising on failure"""
+    if not (message.additional and message.additional[-1].rtype == TYPE_TSIG):
+        raise DNSWireError("Message is not TSIG signed")
+    tsig = message.additional[-1]
+    if tsig.name.lower() != key_name.strip('.').lower():
+        raise DNSWireError("Unknown TSIG key: %s", tsig.name)
+    rdata = tsig.rdata
+    try:
+        alg, offset = decode_name(rdata, 0)
+        hi, lo, fudge, maclen = struct.unpack_from('!HIHH', rdata, offset)
+        offset += 10
+        mac = rdata[offset:offset + maclen]
+        offset += maclen
+        orig_id, error, otherlen = struct.unpack_from('!HHH', rdata, offset)
+    except struct.error:
+        raise DNSWireError("Truncated TSIG record")
+    other = rdata[offset + 6:offset + 6 + otherlen]
+    time_signed = (hi << 32) | lo
+
+    header = bytearray(data[:HEADER.size])
+    struct.pack_into('!H', header, 0, orig_id)
+    struct.pack_into('!H', header, 10, len(message.additional) - 1)
+    unsigned = bytes(header) + data[HEADER.size:tsig.offset]
+    prefix = struct.pack('!H', len(request_mac)) + request_mac if request_mac else b''
+    expected = _tsig_mac(secret, alg, prefix, unsigned,
+                         _tsig_variables(key_name, alg, time_signed, fudge,
+                                         error, other))
+    if not hmac.compare_digest(mac, expected):
+        raise DNSWireError("TSIG signature mismatch for key %s", key_name)
+    if abs(time.time() - time_signed) > fudge:
+        raise DNSWireError("TSIG time outside fudge window for key %s", key_name)
+    if error:
+        raise DNSWireError("TSIG error: %s", error)
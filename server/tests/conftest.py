@@ -0,0 +1,59 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Test fixtures. Run from the server directory with: python -m pytest
+"""
+
+import base64
+
+import flask
+import pytest
+
+import ddnsp
+from ddnsp import dao
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """App factory, with its instance files in tmp_path and no background services
+
+    Cheap Argon2 parameters and no DNS, the app context of the last one is pushed.
+    """
+    contexts = []
+
+    def make_app(**config):
+        app = ddnsp.create_app({**dict(
+            DATABASE=str(tmp_path / 'ddnsp.db'),
+            JOURNAL=str(tmp_path / 'ddnsp.journal'),
+            DNS_BACKEND='null',
+            DNS_DOMAIN='example.com',
+            ARGON2_TIME_COST=1,
+            ARGON2_MEMORY_COST=1024,
+            ARGON2_PARALLELISM=1,
+            RATELIMIT_ENABLED=False,
+            PRELOAD=True,  # never forked, so services are not started
+        ), **config})
+        if contexts:
+            contexts.pop().pop()
+        ctx = app.app_context()
+        ctx.push()
+        contexts.append(ctx)
+        return app
+
+    yield make_app
+    for ctx in contexts:
+        ctx.pop()
+    if dao.engine is not None:
+        dao.engine.close()
+
+
+@pytest.fixture
+def update(make_app):
+    """Send an update with basic auth to the last app made, return its reply"""
+    def update(query:str, username:str='bob', password:str='secret1') -> str:
+        auth = base64.b64encode(f'{username}:{password}'.encode()).decode()
+        client = flask.current_app.test_client()
+        return client.get(f'/update?{query}',
+                          headers={'Authorization': f'Basic {auth}'}).get_data(as_text=True)
+    return update
@@ -0,0 +1,52 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+
+import asyncio
+import base64
+import threading
+
+from ddnsp import asgi
+
+
+async def request(app:asgi.AsyncApp, path:str, query:str='') -> dict:
+    """Send a request, return its response status and body"""
+    auth = b'Basic ' + base64.b64encode(b'bob:secret1')
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+             'headers': [(b'authorization', auth)], 'client': ('127.0.0.1', 1234)}
+    response: dict = {}
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        else:
+            response['body'] = message['body'].decode()
+
+    await app(scope, receive, send)
+    return response
+
+
+def test_queue_full(make_app):
+    app = asgi.AsyncApp(make_app(ASGI_THREADS=1, ASGI_QUEUE_SIZE=1))
+    release = threading.Event()
+
+    async def main():
+        # One running, one waiting for the thread
+        busy = [asyncio.ensure_future(app.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert await request(app, '/update', 'hostname=alpha&myip=1.2.3.4') == \
+            {'status': 200, 'body': '911'}
+        assert (await request(app, '/status'))['status'] == 503
+        release.set()
+        await asyncio.gather(*busy)
+        assert (await request(app, '/update', 'hostname=alpha&myip=1.2.3.4'))['body'] == \
+            'good 1.2.3.4'
+
+    try:
+        asyncio.run(main())
+    finally:
+        release.set()
+    assert app.pending == 0
@@ -0,0 +1,157 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+"""
+Bind9API against a local stand-in for a DNS server accepting dynamic updates
+"""
+
+import base64
+import socketserver
+import struct
+import threading
+import typing as t
+
+import flask
+import pytest
+
+from ddnsp import util as u
+from ddnsp import wire
+from ddnsp.backends.bind9 import Bind9API
+
+KEY = 'ddnsp-key'
+SECRET = b'0123456789abcdef0123456789abcdef'
+ALGORITHM = 'hmac-sha256'
+
+
+class UpdateServer(socketserver.ThreadingTCPServer):
+    """Applies the update RRs it receives to records, and replies as configured"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), UpdateHandler)
+        self.records: t.Dict[t.Tuple[str, int], bytes] = {}
+        self.messages: int = 0
+        self.rcode: int = wire.RCODE_NOERROR
+        self.refuse: t.Optional[str] = None  # refuse updates of this name
+        self.sign: bool = True
+        self.secret: bytes = SECRET  # signing the replies
+
+    def apply(self, message:wire.Message) -> int:
+        if self.rcode != wire.RCODE_NOERROR:
+            return self.rcode
+        names = {rr.name for rr in message.authority}
+        if self.refuse in names:
+            return wire.RCODE_REFUSED
+        for rr in message.authority:  # atomic, as it is checked first
+            if rr.rclass == wire.CLASS_ANY:
+                self.records.pop((rr.name, rr.rtype), None)
+            else:
+                self.records[(rr.name, rr.rtype)] = rr.rdata
+        return wire.RCODE_NOERROR
+
+
+class UpdateHandler(socketserver.BaseRequestHandler):
+    server: UpdateServer
+
+    def recv(self, size:int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def handle(self) -> None:
+        srv = self.server
+        while True:
+            try:
+                data = self.recv(struct.unpack('!H', self.recv(2))[0])
+            except EOFError:
+                return
+            message = wire.parse(data)
+            wire.tsig_verify(data, message, KEY, SECRET, ALGORITHM)
+            srv.messages += 1
+            rcode = srv.apply(message)
+            reply = (wire.HEADER.pack(message.id, wire.FLAG_QR | message.flags | rcode,
+                                      1, 0, 0, 0) +
+                     wire.pack_question(*message.questions[0]))
+            if srv.sign:
+                reply, _ = wire.tsig_sign(reply, KEY, srv.secret, ALGORITHM,
+                                          request_mac=request_mac(message))
+            self.request.sendall(struct.pack('!H', len(reply)) + reply)
+
+
+def request_mac(message:wire.Message) -> bytes:
+    rdata = message.additional[-1].rdata
+    _, offset = wire.decode_name(rdata, 0)
+    maclen = struct.unpack_from('!H', rdata, offset + 8)[0]
+    return rdata[offset + 10:offset + 10 + maclen]
+
+
+@pytest.fixture
+def server():
+    srv = UpdateServer()
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture
+def api(server):
+    api = Bind9API(app=flask.Flask(__name__), server='127.0.0.1', port=server.server_address[1],
+                   zone='example.com', key_name=KEY, algorithm=ALGORITHM, timeout=5,
+                   key_secret=base64.b64encode(SECRET).decode())
+    yield api
+    api.close()
+
+
+def addresses(server) -> t.Dict[str, t.List[str]]:
+    records: t.Dict[str, t.List[str]] = {}
+    for (name, rtype), rdata in sorted(server.records.items()):
+        family = wire.socket.AF_INET6 if rtype == wire.TYPE_AAAA else wire.socket.AF_INET
+        records.setdefault(name, []).append(wire.socket.inet_ntop(family, rdata))
+    return records
+
+
+def test_update_batch(api, server):
+    errors = api.update_ips_batch('example.com', {'alpha': ['1.2.3.4', '2001:db8::1'],
+                                                  'beta': ['1.2.3.5']})
+    assert errors == {'alpha': None, 'beta': None}
+    assert server.messages == 1
+    assert addresses(server) == {'alpha.example.com': ['1.2.3.4', '2001:db8::1'],
+                                 'beta.example.com': ['1.2.3.5']}
+
+    api.update_ip('example.com', 'alpha', '1.2.3.6')
+    assert api.delete_ips_batch('example.com', ['beta']) == {'beta': None}
+    assert addresses(server) == {'alpha.example.com': ['1.2.3.6', '2001:db8::1']}
+    assert server.messages == 3  # on the same connection
+
+
+def test_refused_batch_retried_one_by_one(api, server):
+    server.refuse = 'beta.example.com'
+    errors = api.update_ips_batch('example.com', {'alpha': ['1.2.3.4'], 'beta': ['1.2.3.5']})
+    assert errors['alpha'] is None
+    assert errors['beta'].errno == wire.RCODE_REFUSED
+    assert addresses(server) == {'alpha.example.com': ['1.2.3.4']}
+
+
+def test_error_rcode(api, server):
+    server.rcode = wire.RCODE_NOTAUTH
+    with pytest.raises(u.DDNSPError, match='NOTAUTH'):
+        api.update_ip('example.com', 'alpha', '1.2.3.4')
+
+
+@pytest.mark.parametrize('reply, error', [
+    ('unsigned', 'not TSIG signed'),
+    ('forged', 'mismatch'),
+])
+def test_reply_not_trusted(api, server, reply, error):
+    if reply == 'unsigned':
+        server.sign = False
+    else:
+        server.secret = b'not the shared secret'
+    with pytest.raises(wire.DNSWireError, match=error):
+        api.update_ip('example.com', 'alpha', '1.2.3.4')
@@ -0,0 +1,45 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+
+import socket
+
+import pytest
+
+from ddnsp import dns
+from ddnsp import wire
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app(DNS_BACKEND='builtin', DNS_SUBDOMAIN='d', OUTBOX_ENABLED=False,
+                   DNS_BUILTIN_ADDRESS='127.0.0.1', DNS_BUILTIN_PORT=0,
+                   DNS_BUILTIN_NS_IPS=['192.0.2.53', '2001:db8::53'])
+    yield app
+    dns.get_api().close()
+
+
+def resolve(name:str, rtype:int) -> wire.Message:
+    data = (wire.HEADER.pack(1, 0, 1, 0, 0, 0) + wire.pack_question(name, rtype))
+    return wire.parse(dns.get_api().answer(data))
+
+
+def addresses(message:wire.Message) -> list:
+    return [socket.inet_ntop(socket.AF_INET6 if len(rr.rdata) == 16 else socket.AF_INET,
+                             rr.rdata) for rr in message.answers]
+
+
+def test_reserved_names(app, update):
+    assert update('hostname=ns,hostmaster,alpha&myip=1.2.3.4') == \
+        'nohost\nnohost\ngood 1.2.3.4'
+    assert addresses(resolve('alpha.d.example.com', wire.TYPE_A)) == ['1.2.3.4']
+
+
+def test_nameserver_addresses(app):
+    assert addresses(resolve('ns.d.example.com', wire.TYPE_A)) == ['192.0.2.53']
+    assert addresses(resolve('NS.d.example.com', wire.TYPE_AAAA)) == ['2001:db8::53']
+    # Not overwritten by a host of the same name, as registered by older versions
+    dns.get_api().set_host('ns', '1.2.3.4')
+    dns.get_api().load()
+    assert addresses(resolve('ns.d.example.com', wire.TYPE_ANY)) == \
+        ['192.0.2.53', '2001:db8::53']
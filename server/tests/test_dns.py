@@ -0,0 +1,44 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+
+import pytest
+
+from ddnsp import dns
+from ddnsp import util as u
+
+
+@pytest.fixture
+def api(make_app):
+    make_app(DNS_SNAPSHOT_TTL=300, DNS_BATCH_WINDOW=0, OUTBOX_ENABLED=False)
+    api = dns.get_api()
+    api.zone[dns._record_name('alpha')] = ['1.2.3.4']
+    return api
+
+
+def test_snapshot_skips_confirmed(api):
+    dns.update_ip('alpha', '1.2.3.4')
+    dns.update_ip('alpha', '1.2.3.4')
+    assert api.calls == 3  # a listing and two lookups, no writes
+
+
+def test_snapshot_stale(api):
+    dns.update_ip('alpha', '1.2.3.4')
+    # Changed meanwhile by another worker
+    api.zone[dns._record_name('alpha')] = ['1.2.3.5']
+    dns.update_ip('alpha', '1.2.3.4')
+    assert api.zone[dns._record_name('alpha')] == ['1.2.3.4']
+
+
+def test_snapshot_backoff(api, monkeypatch):
+    listings = []
+
+    def get_zone(domain):
+        listings.append(domain)
+        raise u.DDNSPError("API down")
+
+    monkeypatch.setattr(api, 'get_zone', get_zone)
+    dns.update_ip('alpha', '1.2.3.5')
+    dns.update_ip('alpha', '1.2.3.6')
+    assert len(listings) == 1
+    assert api.zone[dns._record_name('alpha')] == ['1.2.3.6']
@@ -0,0 +1,65 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+
+import concurrent.futures
+import threading
+
+import pytest
+
+from ddnsp import flight
+
+CALLERS = 8
+
+
+def wait_waiters(flights, key):
+    """Wait until all other callers joined the running call of key"""
+    while flights._calls.get(key) is None or flights._calls[key].waiters < CALLERS - 1:
+        threading.Event().wait(0.01)
+
+
+def test_coalesce():
+    flights = flight.SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def slow(value):
+        calls.append(value)
+        release.wait(5)
+        return value * 2
+
+    with concurrent.futures.ThreadPoolExecutor(CALLERS) as pool:
+        futures = [pool.submit(flights.do, 'key', slow, 21) for _ in range(CALLERS)]
+        # All callers join the first one, still running
+        wait_waiters(flights, 'key')
+        other = pool.submit(flights.do, 'other', lambda: 'other')
+        assert other.result(5) == 'other'  # other keys are not held up
+        release.set()
+        assert [future.result(5) for future in futures] == [42] * CALLERS
+    assert calls == [21]
+    assert flights._calls == {}
+
+    # Nothing is cached, a later call runs again
+    assert flights.do('key', slow, 1) == 2
+    assert calls == [21, 1]
+
+
+def test_shared_error():
+    flights = flight.SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fail():
+        calls.append(1)
+        release.wait(5)
+        raise ValueError("boom")
+
+    with concurrent.futures.ThreadPoolExecutor(CALLERS) as pool:
+        futures = [pool.submit(flights.do, 'key', fail) for _ in range(CALLERS)]
+        wait_waiters(flights, 'key')
+        release.set()
+        for future in futures:
+            with pytest.raises(ValueError, match='boom'):
+                future.result(5)
+    assert calls == [1]
+    assert flights._calls == {}
@@ -0,0 +1,107 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+
+import pytest
+
+from ddnsp import dao
+from ddnsp import util as u
+
+
+@pytest.fixture
+def memory_app(make_app):
+    def memory_app(**config):
+        return make_app(STORAGE_ENGINE='memory', OUTBOX_ENABLED=True, **config)
+    return memory_app
+
+
+def restart(memory_app, **config):
+    dao.engine.close()
+    return memory_app(**config)
+
+
+def test_replay(memory_app):
+    memory_app()
+    dao.add_hosts('bob', 'hash1', {'alpha': ('1.2.3.4', None),
+                                   'beta': ('1.2.3.5', '2001:db8::1'),
+                                   'gamma': (None, '2001:db8::2')}, outbox=True)
+    dao.update_host('alpha', ip='1.2.3.6', password='hash2', outbox=True)
+    dao.delete_host('gamma', outbox=True)
+    row = dao.claim_outbox(limit=1, lease=60)[0]
+    dao.done_outbox(row['hostname'], row['version'])
+    hosts = {host['hostname']: host.asdict() for host in dao.export_hosts()}
+    status = dao.outbox_status()
+
+    restart(memory_app)
+    assert {host['hostname']: host.asdict() for host in dao.export_hosts()} == hosts
+    assert set(hosts) == {'alpha', 'beta'}
+    assert (hosts['alpha']['ip'], hosts['alpha']['password']) == ('1.2.3.6', 'hash2')
+    assert dict(dao.outbox_status()) == dict(status)
+
+
+def test_replay_after_compact(memory_app):
+    memory_app()
+    for i in range(5):
+        dao.add_host('bob', 'hash', f'host{i}', f'1.2.3.{i}')
+        dao.update_host(f'host{i}', ip=f'1.2.4.{i}')
+    dao.delete_host('host0')
+    lines = dao.engine.journal.lines
+    dao.engine.compact()
+    assert dao.engine.journal.lines < lines
+    dao.update_host('host1', ip='1.2.5.1')
+
+    restart(memory_app)
+    assert {host['hostname']: host['ip'] for host in dao.export_hosts()} == {
+        'host1': '1.2.5.1', 'host2': '1.2.4.2', 'host3': '1.2.4.3', 'host4': '1.2.4.4'}
+
+
+def test_torn_last_line(memory_app):
+    app = memory_app()
+    dao.add_host('bob', 'hash', 'alpha', '1.2.3.4')
+    dao.engine.close()
+    with open(app.config['JOURNAL'], 'ab') as file:
+        file.write(b'{"h":{"hostname":"beta"')  # crashed mid-write
+
+    restart(memory_app)
+    assert [host['hostname'] for host in dao.export_hosts()] == ['alpha']
+    dao.add_host('bob', 'hash', 'beta', '1.2.3.5')
+    restart(memory_app)
+    assert [host['hostname'] for host in dao.export_hosts()] == ['alpha', 'beta']
+
+
+def test_corrupt_line(memory_app):
+    app = memory_app()
+    dao.add_host('bob', 'hash', 'alpha', '1.2.3.4')
+    dao.engine.close()
+    with open(app.config['JOURNAL'], 'rb') as file:
+        data = file.read()
+    with open(app.config['JOURNAL'], 'wb') as file:
+        file.write(b'garbage\n' + data)
+
+    memory_app()
+    with pytest.raises(u.DDNSPError, match='Corrupt journal'):
+        dao.get_host('alpha')
+
+
+class FullDisk:
+    def write(self, data):
+        raise OSError(28, "No space left on device")
+
+
+@pytest.mark.parametrize('writer', [False, True])
+def test_write_error(memory_app, monkeypatch, writer):
+    memory_app(MEMORY_TIMEOUT=0.2)
+    dao.add_host('bob', 'hash', 'alpha', '1.2.3.4')
+    journal = dao.engine.journal
+    if writer:
+        journal.start()
+    file = journal._file
+    monkeypatch.setattr(journal, '_file', FullDisk())
+    with pytest.raises(u.DDNSPError, match='No space left'):
+        dao.add_host('bob', 'hash', 'beta', '1.2.3.5')
+    # Written once the disk recovers
+    monkeypatch.setattr(journal, '_file', file)
+    journal.timeout = 5  # the writer retries every second
+    dao.add_host('bob', 'hash', 'gamma', '1.2.3.6')
+    restart(memory_app)
+    assert [host['hostname'] for host in dao.export_hosts()] == ['alpha', 'beta', 'gamma']
@@ -0,0 +1,69 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+
+import time
+
+import pytest
+
+from ddnsp import dao
+
+
+@pytest.fixture(params=sorted(dao.ENGINES))
+def app(request, make_app):
+    return make_app(STORAGE_ENGINE=request.param, OUTBOX_ENABLED=True)
+
+
+def test_claim_lease(app):
+    dao.add_hosts('bob', 'hash', {'alpha': ('1.2.3.4', None),
+                                  'beta': (None, '2001:db8::1')}, outbox=True)
+    rows = dao.claim_outbox(limit=1, lease=60)
+    assert [row['hostname'] for row in rows] == ['alpha']  # oldest first
+    assert rows[0]['ip'] == '1.2.3.4' and rows[0]['next_try'] > time.time() + 50
+    rows = dao.claim_outbox(limit=10, lease=60)
+    assert [(row['hostname'], row['ip6']) for row in rows] == [('beta', '2001:db8::1')]
+    # Both leased, so no one else gets them
+    assert dao.claim_outbox(limit=10, lease=60) == []
+    assert dao.outbox_status()['depth'] == 2
+
+
+def test_lease_expires(app):
+    dao.add_host('bob', 'hash', 'alpha', '1.2.3.4', outbox=True)
+    assert len(dao.claim_outbox(limit=10, lease=0.05)) == 1
+    assert dao.claim_outbox(limit=10, lease=0.05) == []
+    time.sleep(0.1)
+    assert [row['hostname'] for row in dao.claim_outbox(limit=10, lease=60)] == ['alpha']
+
+
+def test_retry(app):
+    dao.add_host('bob', 'hash', 'alpha', '1.2.3.4', outbox=True)
+    row, = dao.claim_outbox(limit=10, lease=0)
+    dao.retry_outbox('alpha', row['version'], 'boom', delay=60)
+    status = dao.outbox_status()
+    assert (status['depth'], status['failing'], status['max_attempts']) == (1, 1, 1)
+    assert dao.claim_outbox(limit=10, lease=0) == []  # backing off
+
+    dao.retry_outbox('alpha', row['version'], 'boom', delay=0)
+    row, = dao.claim_outbox(limit=10, lease=60)
+    assert (row['attempts'], row['error']) == (2, 'boom')
+    dao.done_outbox('alpha', row['version'])
+    assert dao.outbox_status()['depth'] == 0
+
+
+def test_newer_change_wins(app):
+    dao.add_host('bob', 'hash', 'alpha', '1.2.3.4', outbox=True)
+    old, = dao.claim_outbox(limit=10, lease=60)
+    dao.update_host('alpha', ip='1.2.3.5', outbox=True)
+    # The change sent is outdated, the new one stays queued, and due right away
+    dao.retry_outbox('alpha', old['version'], 'boom', delay=60)
+    dao.done_outbox('alpha', old['version'])
+    new, = dao.claim_outbox(limit=10, lease=60)
+    assert (new['ip'], new['attempts'], new['error']) == ('1.2.3.5', 0, None)
+    assert new['version'] > old['version']
+
+
+def test_delete_queues_removal(app):
+    dao.add_host('bob', 'hash', 'alpha', '1.2.3.4', outbox=False)
+    dao.delete_host('alpha', outbox=True)
+    row, = dao.claim_outbox(limit=10, lease=60)
+    assert (row['hostname'], row['ip'], row['ip6']) == ('alpha', None, None)
@@ -0,0 +1,45 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+
+import pytest
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app(RATELIMIT_ENABLED=True,
+                    RATELIMIT_IP_PER_MINUTE=0,
+                    RATELIMIT_HOSTNAME_PER_MINUTE=1,
+                    RATELIMIT_HOSTNAME_BURST=3,
+                    RATELIMIT_USERNAME_PER_MINUTE=1,
+                    RATELIMIT_USERNAME_BURST=100)
+
+
+def test_hostname_variants_share_a_limit(app, update):
+    assert update('hostname=victim&myip=1.2.3.4', 'alice') == 'good 1.2.3.4'
+    # Wrong guesses, spelled differently, all spend the victim's tokens
+    assert update('hostname=victim.a&myip=1.2.3.4', 'eve', 'guess1') == 'badauth'
+    assert update('hostname=VICTIM,x1&myip=1.2.3.4', 'eve', 'guess2') == 'nohost\ngood 1.2.3.4'
+    assert update('hostname=victim.d.example.com&myip=1.2.3.4', 'eve', 'guess3') == 'abuse'
+    assert update('hostname=x2,victim.b&myip=1.2.3.4', 'eve', 'guess4') == 'abuse'
+    assert update('hostname=other&myip=1.2.3.4', 'eve', 'guess5') == 'good 1.2.3.4'
+
+
+def test_refused_spends_nothing(make_app, update):
+    make_app(RATELIMIT_ENABLED=True,
+             RATELIMIT_IP_PER_MINUTE=0,
+             RATELIMIT_HOSTNAME_PER_MINUTE=1,
+             RATELIMIT_HOSTNAME_BURST=1,
+             RATELIMIT_USERNAME_PER_MINUTE=1,
+             RATELIMIT_USERNAME_BURST=1)
+    assert update('hostname=alpha&myip=1.2.3.4', 'eve') == 'good 1.2.3.4'
+    # Refused by eve's limit, so beta's is left untouched
+    assert update('hostname=beta&myip=1.2.3.4', 'eve') == 'abuse'
+    assert update('hostname=beta&myip=1.2.3.4', 'bob') == 'good 1.2.3.4'
+    assert update('hostname=beta&myip=1.2.3.4', 'carol') == 'abuse'
+
+
+def test_disabled(make_app, update):
+    make_app(RATELIMIT_ENABLED=False)
+    for _ in range(20):
+        assert update('hostname=alpha&myip=1.2.3.4') in ('good 1.2.3.4', 'nochg 1.2.3.4')
@@ -0,0 +1,81 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+
+import pytest
+
+from ddnsp import dao
+from ddnsp import hasher
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app(OUTBOX_ENABLED=False, HOSTNAME_MAX_COUNT=5)
+
+
+def test_multiple_hostnames(app, update):
+    assert update('hostname=alpha&myip=1.2.3.4', 'eve', 'secret2') == 'good 1.2.3.4'
+    # One reply line per hostname, in the order given
+    assert update('hostname=beta,alpha,bad!,gamma.d.example.com,&myip=1.2.3.5') == \
+        'good 1.2.3.5\nbadauth\nnohost\ngood 1.2.3.5\nnohost'
+    assert update('hostname=beta,gamma&myip=1.2.3.5') == 'nochg 1.2.3.5\nnochg 1.2.3.5'
+    assert update('hostname=gamma,beta&myip=1.2.3.6,2001:db8::1') == \
+        'good 1.2.3.6,2001:db8::1\ngood 1.2.3.6,2001:db8::1'
+    assert update('hostname=a,b,c,d,e,f&myip=1.2.3.4') == 'numhost'
+    assert {host['hostname']: (host['username'], host['ip'], host['ip6'])
+            for host in dao.export_hosts()} == {
+        'alpha': ('eve', '1.2.3.4', None),
+        'beta':  ('bob', '1.2.3.6', '2001:db8::1'),
+        'gamma': ('bob', '1.2.3.6', '2001:db8::1'),
+    }
+
+
+def test_legacy_names(app, update):
+    # Registered by older versions, which only checked a valid prefix
+    dao.add_host('john.doe', hasher.hash_password('secret1'), 'old!', '1.2.3.4')
+    assert update('hostname=old!&myip=1.2.3.5', 'john.doe') == 'good 1.2.3.5'
+    assert update('hostname=old!&myip=1.2.3.5', 'john') == 'badauth'
+    # But no new ones
+    assert update('hostname=new&myip=1.2.3.5', 'john.doe') == 'badauth'
+    assert update('hostname=new!,new&myip=1.2.3.5') == 'nohost\ngood 1.2.3.5'
+    assert dao.get_host('new!') is None
+
+
+@pytest.fixture
+def verifies(monkeypatch):
+    """Passwords given to Argon2 verify calls"""
+    calls = []
+    verify = hasher.verify
+
+    def counting_verify(hashed, plain):
+        calls.append(plain)
+        return verify(hashed, plain)
+
+    monkeypatch.setattr(hasher, 'verify', counting_verify)
+    return calls
+
+
+def test_auth_cache(app, update, verifies):
+    assert update('hostname=alpha&myip=1.2.3.4') == 'good 1.2.3.4'
+    for _ in range(3):
+        assert update('hostname=alpha&myip=1.2.3.4') == 'nochg 1.2.3.4'
+    assert verifies == ['secret1']
+    # Wrong passwords are never cached, nor spoil the cached one
+    assert update('hostname=alpha&myip=1.2.3.4', password='wrong1') == 'badauth'
+    assert update('hostname=alpha&myip=1.2.3.4', password='wrong1') == 'badauth'
+    assert update('hostname=alpha&myip=1.2.3.4') == 'nochg 1.2.3.4'
+    assert verifies == ['secret1', 'wrong1', 'wrong1']
+    # A new password invalidates it
+    dao.update_password('alpha', hasher.hash_password('secret2'))
+    assert update('hostname=alpha&myip=1.2.3.4') == 'badauth'
+    assert update('hostname=alpha&myip=1.2.3.4', password='secret2') == 'nochg 1.2.3.4'
+    assert update('hostname=alpha&myip=1.2.3.4', password='secret2') == 'nochg 1.2.3.4'
+    assert verifies == ['secret1', 'wrong1', 'wrong1', 'secret1', 'secret2']
+
+
+def test_auth_cache_disabled(make_app, update, verifies):
+    make_app(AUTH_CACHE_TTL=0)
+    assert update('hostname=alpha&myip=1.2.3.4') == 'good 1.2.3.4'
+    for _ in range(3):
+        assert update('hostname=alpha&myip=1.2.3.4') == 'nochg 1.2.3.4'
+    assert verifies == ['secret1'] * 3
@@ -0,0 +1,64 @@
+# This file is part of ddnsp, see <https://github.com/MestreLion/ddnsp>
+# Copyright (C) 2022 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later. See <http://www.gnu.org/licenses/gpl.html>
+
+import pytest
+
+from ddnsp import wire
+
+KEY = 'ddnsp-key.'
+SECRET = b'0123456789abcdef0123456789abcdef'
+
+
+def query(msgid:int=0x1234) -> bytes:
+    return (wire.HEADER.pack(msgid, 0, 1, 0, 0, 0) +
+            wire.pack_question('host.example.com', wire.TYPE_A))
+
+
+@pytest.mark.parametrize('algorithm', sorted(wire.TSIG_ALGORITHMS))
+def test_tsig_round_trip(algorithm):
+    signed, mac = wire.tsig_sign(query(), KEY, SECRET, algorithm)
+    message = wire.parse(signed)
+    assert message.id == 0x1234
+    assert message.questions == [('host.example.com', wire.TYPE_A, wire.CLASS_IN)]
+    assert message.additional[-1].rtype == wire.TYPE_TSIG
+    wire.tsig_verify(signed, message, KEY, SECRET, algorithm)
+
+    # A response is signed along with the MAC of its request
+    response, _ = wire.tsig_sign(query(), KEY, SECRET, algorithm, request_mac=mac)
+    wire.tsig_verify(response, wire.parse(response), KEY, SECRET, algorithm,
+                     request_mac=mac)
+    with pytest.raises(wire.DNSWireError, match='mismatch'):
+        wire.tsig_verify(response, wire.parse(response), KEY, SECRET, algorithm)
+
+
+def test_tsig_verify_rejects():
+    algorithm = 'hmac-sha256'
+    signed, _ = wire.tsig_sign(query(), KEY, SECRET, algorithm)
+    message = wire.parse(signed)
+    with pytest.raises(wire.DNSWireError, match='mismatch'):
+        wire.tsig_verify(signed, message, KEY, b'wrong secret', algorithm)
+    with pytest.raises(wire.DNSWireError, match='Unknown TSIG key'):
+        wire.tsig_verify(signed, message, 'other-key', SECRET, algorithm)
+    with pytest.raises(wire.DNSWireError, match='not TSIG signed'):
+        wire.tsig_verify(query(), wire.parse(query()), KEY, SECRET, algorithm)
+
+    # Tampered question, host.example.com -> hosu.example.com
+    tampered = bytearray(signed)
+    tampered[tampered.index(b'host') + 3] ^= 1
+    with pytest.raises(wire.DNSWireError, match='mismatch'):
+        wire.tsig_verify(bytes(tampered), wire.parse(bytes(tampered)), KEY, SECRET,
+                         algorithm)
+
+
+def test_tsig_truncated():
+    algorithm = 'hmac-sha256'
+    signed, _ = wire.tsig_sign(query(), KEY, SECRET, algorithm)
+    message = wire.parse(signed)
+    tsig = message.additional[-1]
+    # Cut the record data short, right after the algorithm name
+    short = tsig.rdata[:len(wire.encode_name(algorithm)) + 4]
+    truncated = (signed[:tsig.offset] +
+                 wire.pack_rr(KEY, wire.TYPE_TSIG, wire.CLASS_ANY, 0, short))
+    with pytest.raises(wire.DNSWireError, match='Truncated TSIG'):
+        wire.tsig_verify(truncated, wire.parse(truncated), KEY, SECRET, algorithm)